@@ -0,0 +1,465 @@
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <bolacha - http library for python, with cookies and upload support>
+# Copyright (C) <2010>  Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Runs the benchmark scenarios and reports, for each of them, the
+throughput, latency percentiles and peak memory:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --requests 1000 --latency 0.005 \\
+                             --scenario get_small --scenario cached_get \\
+                             --output results.json
+
+The server is started on a thread of this process, unless --subprocess
+or --server URL (of a "python -m benchmarks.server") is given. Every
+scenario builds what it needs once and then times the same operation
+--requests times, after a few warm-up rounds. An operation may have
+'details', such as how many bytes it sent, which are reported along.
+
+Each scenario runs in a process of its own, so that its peak memory is
+its own too. With --in-process they all run in this one, which is
+quicker to start, but the peak memory is then that of the whole run so
+far. The "memory" field of the results says which it is.
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import optparse
+from optparse import OptionParser
+
+import bolacha
+from bolacha import Bolacha, BOUNDARY, RequestCompression
+from bolacha.asynchronous import AsyncBolacha
+from bolacha.httplib2 import FileCache, ShardedFileCache, SqliteCache
+from bolacha.httplib2.iri2uri import iri2uri
+from bolacha.multipart import MultipartEncoder
+
+from benchmarks import server
+
+SCENARIOS = []
+
+def scenario(function):
+    """Registers a scenario: a function that takes the Context and
+    returns a callable doing one timed operation."""
+    SCENARIOS.append(function)
+    return function
+
+class Context(object):
+    def __init__(self, base_url, options):
+        self.base_url = base_url
+        self.options = options
+        self.directory = tempfile.mkdtemp(prefix='bolacha-bench-')
+
+    def url(self, path):
+        return self.base_url + path
+
+    def upload(self, size):
+        """A file of 'size' bytes to upload"""
+        path = os.path.join(self.directory, 'upload-%d' % size)
+        if not os.path.exists(path):
+            upload = open(path, 'wb')
+            chunk = 'x' * 65536
+            for start in range(0, size, len(chunk)):
+                upload.write(chunk[:size - start])
+            upload.close()
+        return path
+
+    def json_payload(self):
+        """About a megabyte of JSON records, as logs and metrics are"""
+        if not hasattr(self, '_json_payload'):
+            self._json_payload = json.dumps([
+                {'id': number, 'sensor': 'sensor-%d' % (number % 50),
+                 'value': (number * 37 % 1000) / 10.0, 'unit': 'celsius',
+                 'time': '2010-06-01T12:%02d:%02dZ' % (number / 60 % 60, number % 60)}
+                for number in range(12000)])
+        return self._json_payload
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+@scenario
+def get_small(context):
+    browser = Bolacha()
+    url = context.url('/bytes?size=1024')
+    return lambda: browser.get(url)
+
+@scenario
+def get_large(context):
+    browser = Bolacha()
+    url = context.url('/bytes?size=%d' % (1024 * 1024))
+    return lambda: browser.get(url)
+
+@scenario
+def get_gzip(context):
+    browser = Bolacha()
+    url = context.url('/bytes?size=%d&gzip=1' % (256 * 1024))
+    return lambda: browser.get(url)
+
+@scenario
+def get_cookies(context):
+    browser = Bolacha()
+    url = context.url('/bytes?size=1024&cookies=10')
+    return lambda: browser.get(url)
+
+@scenario
+def post_form(context):
+    browser = Bolacha()
+    url = context.url('/echo')
+    body = dict([('field%d' % number, 'value %d' % number) for number in range(20)])
+    return lambda: browser.post(url, body=body)
+
+@scenario
+def cached_get(context):
+    browser = Bolacha(cache=FileCache(os.path.join(context.directory, 'cache')))
+    url = context.url('/bytes?size=16384&cache=3600')
+    browser.get(url)
+    return lambda: browser.get(url)
+
+@scenario
+def cached_get_sharded(context):
+    browser = Bolacha(cache=ShardedFileCache(os.path.join(context.directory, 'sharded')))
+    url = context.url('/bytes?size=16384&cache=3600')
+    browser.get(url)
+    return lambda: browser.get(url)
+
+@scenario
+def cached_get_sqlite(context):
+    browser = Bolacha(cache=SqliteCache(os.path.join(context.directory, 'cache.db')))
+    url = context.url('/bytes?size=16384&cache=3600')
+    browser.get(url)
+    return lambda: browser.get(url)
+
+@scenario
+def cached_get_large(context):
+    browser = Bolacha(cache=FileCache(os.path.join(context.directory, 'large')))
+    url = context.url('/bytes?size=%d&cache=3600' % (32 * 1024 * 1024))
+    browser.get(url)
+    return lambda: browser.get(url)
+
+@scenario
+def cached_get_large_mmap(context):
+    cache = FileCache(os.path.join(context.directory, 'mapped'), mmap_threshold=1024 * 1024)
+    browser = Bolacha(cache=cache)
+    url = context.url('/bytes?size=%d&cache=3600' % (32 * 1024 * 1024))
+    browser.get(url)
+    return lambda: browser.get(url)
+
+@scenario
+def upload_json(context):
+    browser = Bolacha()
+    url = context.url('/echo?size_only=1')
+    payload = context.json_payload()
+    upload = lambda: browser.post(url, body=payload, headers={'Content-Type': 'application/json'})
+    upload.details = {'bytes': len(payload), 'sent_bytes': len(payload)}
+    return upload
+
+@scenario
+def upload_json_gzip(context):
+    compression = RequestCompression()
+    browser = Bolacha(compression=compression)
+    url = context.url('/echo?size_only=1')
+    payload = context.json_payload()
+    headers = {'Content-Type': 'application/json'}
+    upload = lambda: browser.post(url, body=payload, headers=headers)
+    upload.details = {'bytes': len(payload),
+                      'sent_bytes': len(compression.compress(payload, headers)[0])}
+    return upload
+
+def _gzip_json(level):
+    def gzip_json(context):
+        compression = RequestCompression(level=level)
+        payload = context.json_payload()
+        headers = {'Content-Type': 'application/json'}
+        compress = lambda: compression.compress(payload, headers)
+        compress.details = {'bytes': len(payload), 'sent_bytes': len(compress()[0])}
+        return compress
+    gzip_json.__name__ = 'gzip_json_level%d' % level
+    return scenario(gzip_json)
+
+for level in (1, 6, 9):
+    _gzip_json(level)
+
+@scenario
+def redirect_chain(context):
+    browser = Bolacha()
+    url = context.url('/redirect?hops=5&size=1024')
+    return lambda: browser.get(url)
+
+@scenario
+def multipart_encode(context):
+    path = context.upload(4 * 1024 * 1024)
+    def encode():
+        upload = open(path, 'rb')
+        try:
+            encoder = MultipartEncoder(BOUNDARY, {'file': upload, 'name': 'value'})
+            while encoder.read(65536):
+                pass
+        finally:
+            upload.close()
+    return encode
+
+@scenario
+def multipart_upload(context):
+    browser = Bolacha()
+    path = context.upload(4 * 1024 * 1024)
+    url = context.url('/echo?size_only=1')
+    def upload():
+        upload = open(path, 'rb')
+        try:
+            browser.post(url, body={'file': upload, 'name': 'value'})
+        finally:
+            upload.close()
+    return upload
+
+@scenario
+def multipart_upload_gzip(context):
+    browser = Bolacha(compression=RequestCompression(level=1))
+    path = context.upload(4 * 1024 * 1024)
+    url = context.url('/echo?size_only=1')
+    def upload():
+        upload = open(path, 'rb')
+        try:
+            browser.post(url, body={'file': upload, 'name': 'value'})
+        finally:
+            upload.close()
+    return upload
+
+@scenario
+def map_get(context):
+    browser = Bolacha()
+    urls = [context.url('/bytes?size=1024&n=%d' % number) for number in range(50)]
+    return lambda: browser.map(urls, concurrency=10)
+
+@scenario
+def pipeline_get(context):
+    http = Bolacha().http
+    urls = [context.url('/bytes?size=1024&n=%d' % number) for number in range(50)]
+    return lambda: http.pipeline(urls)
+
+@scenario
+def async_map_get(context):
+    browser = AsyncBolacha()
+    urls = [context.url('/bytes?size=1024&n=%d' % number) for number in range(50)]
+    return lambda: browser.map(urls, concurrency=10)
+
+@scenario
+def iri2uri_ascii(context):
+    iris = [u'http://www.example.com/some/path/%d?query=value&other=%d#top' % (number, number)
+            for number in range(1000)]
+    return lambda: [iri2uri(iri) for iri in iris]
+
+@scenario
+def iri2uri_unicode(context):
+    iris = [u'http://www.example.com/caf\xe9/%d/\u2604?q=\u00e7\u00e3o' % number
+            for number in range(1000)]
+    return lambda: [iri2uri(iri) for iri in iris]
+
+# What peak_memory_kb means in the results, by how scenarios were run
+MEMORY_SCOPES = {
+    'process': 'peak RSS of a process that ran only this scenario',
+    'cumulative': 'peak RSS of the benchmark process, '
+                  'up to the end of this scenario',
+}
+
+def peak_memory():
+    """Peak resident memory of this process, in kilobytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes there, kilobytes everywhere else
+        peak /= 1024
+    return peak
+
+def percentile(durations, percent):
+    """The nearest-rank percentile of sorted 'durations'"""
+    if not durations:
+        return None
+    rank = int(round(percent / 100.0 * len(durations) + 0.5)) - 1
+    return durations[max(0, min(rank, len(durations) - 1))]
+
+def measure(operation, requests, warmup):
+    for number in range(warmup):
+        operation()
+
+    durations = []
+    started = time.time()
+    for number in range(requests):
+        began = time.time()
+        operation()
+        durations.append(time.time() - began)
+    elapsed = time.time() - started
+
+    durations.sort()
+    return {
+        'requests': requests,
+        'seconds': elapsed,
+        'throughput': elapsed and requests / elapsed or None,
+        'mean': sum(durations) / len(durations),
+        'p50': percentile(durations, 50),
+        'p90': percentile(durations, 90),
+        'p99': percentile(durations, 99),
+        'max': durations[-1],
+        'peak_memory_kb': peak_memory(),
+    }
+
+def start_subprocess(latency):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.server',
+                                '--latency', str(latency)],
+                               stdout=subprocess.PIPE, cwd=root)
+    return process, process.stdout.readline().strip()
+
+def run_scenario(function, base_url, options):
+    """Times the scenario 'function' and returns its results and the
+    details of its operation"""
+    context = Context(base_url, options)
+    try:
+        operation = function(context)
+        result = measure(operation, options.requests, options.warmup)
+        details = getattr(operation, 'details', {})
+        result.update(details)
+    finally:
+        context.cleanup()
+    return result, details
+
+def run_in_subprocess(name, base_url, options):
+    """Runs the scenario called 'name' in a process of its own, by
+    running this module with --worker"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.run', '--worker',
+                                '--server', base_url, '--scenario', name,
+                                '--requests', str(options.requests),
+                                '--warmup', str(options.warmup)],
+                               stdout=subprocess.PIPE, cwd=root)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('scenario %s failed with status %d' % (name, process.returncode))
+    result, details = json.loads(output)
+    return result, details
+
+def work(options):
+    """Runs the one scenario of --worker and writes its results to
+    stdout, for run_in_subprocess()"""
+    function = [function for function in SCENARIOS
+                if function.__name__ == options.scenarios[0]][0]
+    json.dump(run_scenario(function, options.server.rstrip('/'), options), sys.stdout)
+
+def run(options):
+    process = local = None
+    if options.server:
+        base_url = options.server.rstrip('/')
+    elif options.subprocess:
+        process, base_url = start_subprocess(options.latency)
+    else:
+        local = server.start(latency=options.latency)
+        base_url = local.url
+
+    names = options.scenarios or [function.__name__ for function in SCENARIOS]
+    results = {}
+    try:
+        for function in SCENARIOS:
+            name = function.__name__
+            if name not in names:
+                continue
+            if options.in_process:
+                result, details = run_scenario(function, base_url, options)
+            else:
+                result, details = run_in_subprocess(name, base_url, options)
+            results[name] = result
+            report(name, result, details)
+    finally:
+        if local is not None:
+            local.stop()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    return {
+        'bolacha': bolacha.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options': {'requests': options.requests, 'warmup': options.warmup,
+                    'latency': options.latency},
+        'memory': MEMORY_SCOPES[options.in_process and 'cumulative' or 'process'],
+        'results': results,
+    }
+
+def report(name, result, details=None):
+    print '%-18s %9.1f req/s   p50 %8.3fms   p90 %8.3fms   p99 %8.3fms   peak %7dKB' % (
+        name, result['throughput'] or 0, result['p50'] * 1000,
+        result['p90'] * 1000, result['p99'] * 1000, result['peak_memory_kb'])
+    if details:
+        print '%-18s %s' % ('', '   '.join(['%s %s' % item for item in sorted(details.items())]))
+    sys.stdout.flush()
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--requests', type='int', default=200,
+                      help='timed operations per scenario')
+    parser.add_option('--warmup', type='int', default=5,
+                      help='untimed operations before timing')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds the server waits before every response')
+    parser.add_option('--scenario', action='append', dest='scenarios',
+                      help='run only this scenario, may be repeated')
+    parser.add_option('--list', action='store_true',
+                      help='list the scenarios and exit')
+    parser.add_option('--server', help='url of a server already running')
+    parser.add_option('--subprocess', action='store_true',
+                      help='run the server in a process of its own')
+    parser.add_option('--in-process', action='store_true',
+                      help='run every scenario in this process, '
+                           'so peak memory adds up over the run')
+    parser.add_option('--worker', action='store_true',
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option('--output', help='write the results to this JSON file')
+    options, args = parser.parse_args(args)
+
+    if options.list:
+        for function in SCENARIOS:
+            print function.__name__
+        return
+
+    if options.worker:
+        return work(options)
+
+    results = run(options)
+    if options.output:
+        output = open(options.output, 'w')
+        try:
+            json.dump(results, output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+
+if __name__ == '__main__':
+    main()
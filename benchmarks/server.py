@@ -0,0 +1,240 @@
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <bolacha - http library for python, with cookies and upload support>
+# Copyright (C) <2010>  Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A small HTTP/1.1 server to benchmark bolacha against, with nothing but
+the standard library. Every response is shaped by the query string:
+
+    /bytes?size=1024        a body of 'size' bytes
+    &gzip=1                 gzip encoded
+    &cache=300              with Cache-Control: max-age, Date and ETag
+    &cookies=3              and that many Set-Cookie headers
+    &latency=0.05           waiting that many seconds before answering
+    /redirect?hops=3        redirects 'hops' times, then to /bytes
+    /echo                   POST, answers with the request body (or
+                            its size, with &size_only=1), which may be
+                            chunked and gzip encoded
+
+Run it on its own with "python -m benchmarks.server --port 8000", or
+start it in the current process with start().
+"""
+
+import cgi
+import gzip
+import socket
+import sys
+import threading
+import time
+import urlparse
+import zlib
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from StringIO import StringIO
+
+class BenchmarkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # pipelined requests get their responses in back to back writes,
+        # which Nagle's algorithm would hold back for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self):
+        url = urlparse.urlparse(self.path)
+        params = dict([(key, values[-1]) for key, values
+                       in cgi.parse_qs(url.query).items()])
+        return url.path, params
+
+    def _wait(self, params):
+        latency = self.server.latency + float(params.get('latency', 0))
+        if latency:
+            time.sleep(latency)
+
+    def _reply(self, status, body, headers=()):
+        # one write per response, so that small responses are not
+        # delayed by Nagle's algorithm on the client's side
+        lines = ['%s %d %s' % (self.protocol_version, status,
+                               self.responses[status][0])]
+        for key, value in headers:
+            lines.append('%s: %s' % (key, value))
+        lines.append('Content-Length: %d' % len(body))
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        if self.command == 'HEAD':
+            body = ''
+        self.wfile.write(head + body)
+
+    def do_GET(self):
+        path, params = self._params()
+        self._wait(params)
+
+        if path == '/redirect':
+            hops = int(params.get('hops', 1))
+            if hops > 1:
+                location = '/redirect?hops=%d' % (hops - 1)
+            else:
+                location = '/bytes?size=%s' % params.get('size', 0)
+            return self._reply(302, '', [('Location', location)])
+
+        if path != '/bytes':
+            return self._reply(404, 'not found')
+
+        body = 'x' * int(params.get('size', 0))
+        headers = []
+        if params.get('gzip'):
+            buffer = StringIO()
+            compressed = gzip.GzipFile(fileobj=buffer, mode='wb')
+            compressed.write(body)
+            compressed.close()
+            body = buffer.getvalue()
+            headers.append(('Content-Encoding', 'gzip'))
+        if params.get('cache'):
+            headers.append(('Cache-Control', 'max-age=%s' % params['cache']))
+            headers.append(('Date', self.date_time_string()))
+            headers.append(('ETag', '"%s"' % self.path))
+        for number in range(int(params.get('cookies', 0))):
+            headers.append(('Set-Cookie', 'cookie%d=%d; Path=/' % (number, number)))
+        self._reply(200, body, headers)
+
+    do_HEAD = do_GET
+
+    def _read(self, length):
+        body = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, 64 * 1024))
+            if not chunk:
+                break
+            body.append(chunk)
+            length -= len(chunk)
+        return ''.join(body)
+
+    def _read_chunked(self):
+        body = []
+        while True:
+            length = int(self.rfile.readline().split(';')[0], 16)
+            if not length:
+                # no trailers are sent to us
+                self.rfile.readline()
+                return ''.join(body)
+            body.append(self._read(length))
+            self.rfile.readline()
+
+    def do_POST(self):
+        path, params = self._params()
+        self._wait(params)
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = self._read_chunked()
+        else:
+            body = self._read(int(self.headers.get('content-length', 0)))
+        if self.headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if params.get('size_only'):
+            body = str(len(body))
+        self._reply(200, body)
+
+class BenchmarkServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    # seconds added to every response
+    latency = 0.0
+
+    def __init__(self, *args, **kw):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kw)
+        self.open_requests = set()
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        self._lock.acquire()
+        try:
+            self.open_requests.add(request)
+        finally:
+            self._lock.release()
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self._lock.acquire()
+        try:
+            self.open_requests.discard(request)
+        finally:
+            self._lock.release()
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        # clients that go away are not worth a traceback
+        pass
+
+    def stop(self):
+        """Stops serving, and hangs up on kept-alive connections so that
+        their threads finish too."""
+        self.shutdown()
+        self.server_close()
+        self._lock.acquire()
+        try:
+            requests = list(self.open_requests)
+        finally:
+            self._lock.release()
+        for request in requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+def start(host='127.0.0.1', port=0, latency=0.0):
+    """Starts a server on a thread of this process and returns it. Its
+    address is server.url, and server.stop() stops it."""
+    server = BenchmarkServer((host, port), BenchmarkHandler)
+    server.latency = latency
+    server.url = 'http://%s:%d' % server.server_address
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=0,
+                      help='0 picks a free port, which is printed')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds to wait before every response')
+    options, args = parser.parse_args(args)
+
+    server = start(options.host, options.port, options.latency)
+    print server.url
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
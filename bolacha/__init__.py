@@ -24,9 +24,18 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import threading
+from collections import deque
+
+from bolacha.cookies import CookieJar
+from bolacha.compression import RequestCompression
+from bolacha.session import SessionFile, SESSION_VERSION
+
 from bolacha.httplib2 import Http as HTTPClass
 from bolacha.multipart import BOUNDARY
 from bolacha.multipart import encode_multipart
+from bolacha.multipart import MultipartEncoder
 from bolacha.multipart import urlencode
 from bolacha.multipart import is_file
 from bolacha.multipart import expand_items
@@ -48,9 +57,20 @@ HTTP_METHODS = (
 RFC_LOCATION = 'Take a look at http://www.w3.org/Protocols/rfc2616/' \
                'rfc2616-sec9.html to see valid method definitions'
 
+# How many requests Bolacha.map runs at once, by default
+DEFAULT_CONCURRENCY = 10
+
+def _store_key(store):
+    """What identifies a session store: the path of its file, if it has
+    one, so that SessionFiles made for the same path are one store"""
+    path = getattr(store, 'path', None)
+    if isinstance(path, basestring):
+        return os.path.abspath(path)
+    return store
+
 class Bolacha(object):
     headers = None
-    def __init__(self, http=None, persistent=True, **kw):
+    def __init__(self, http=None, persistent=True, compression=None, **kw):
         if http is not None and not isinstance(http, type) and not callable(http):
             raise TypeError, 'Bolacha takes a class or callable as parameter, ' \
                   'got %s' % repr(http)
@@ -61,24 +81,146 @@ class Bolacha(object):
             self.http = HTTPClass(**kw)
 
         self.persistent = persistent
+        # a RequestCompression, to gzip request bodies
+        self.compression = compression
         self.headers = {}
+        self.cookies = CookieJar()
+        # guards self.headers, which concurrent requests read and update
+        self._lock = threading.RLock()
+        # the session state last loaded from or saved to each store, to
+        # tell what changed since when saving to it again
+        self._session_bases = {}
+
+    def post(self, url, body=None, headers=None, **kw):
+        return self.request(url, 'POST', body=body, headers=headers, **kw)
+
+    def get(self, url, body=None, headers=None, **kw):
+        return self.request(url, 'GET', body=body, headers=headers, **kw)
+
+    def put(self, url, body=None, headers=None, **kw):
+        return self.request(url, 'PUT', body=body, headers=headers, **kw)
+
+    def delete(self, url, body=None, headers=None, **kw):
+        return self.request(url, 'DELETE', body=body, headers=headers, **kw)
+
+    def head(self, url, body=None, headers=None, **kw):
+        return self.request(url, 'HEAD', body=body, headers=headers, **kw)
+
+    def map(self, requests, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Runs many requests at once, on 'concurrency' threads sharing
+        this session, and returns their results in the same order.
+
+        Each request is either an url to GET, a tuple of arguments to
+        request(), such as (url, 'POST', body), or a dict of keyword
+        arguments to it. A request that fails has its exception in the
+        results, in place of the (response, content) tuple, so one
+        failure doesn't stop the others.
+        """
+        if concurrency < 1:
+            raise ValueError, 'Bolacha.map, parameter concurrency must be ' \
+                  'at least 1, got %r' % concurrency
+
+        pending = deque(enumerate(requests))
+        results = [None] * len(pending)
+
+        def work():
+            while True:
+                try:
+                    index, request = pending.popleft()
+                except IndexError:
+                    return
+                results[index] = self._map_one(request)
+
+        # plain threads: a multiprocessing ThreadPool takes up to a
+        # tenth of a second to join
+        threads = [threading.Thread(target=work)
+                   for number in range(min(concurrency, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
 
-    def post(self, url, body=None, headers=None):
-        return self.request(url, 'POST', body=body, headers=headers)
+    def _map_one(self, request):
+        if isinstance(request, basestring):
+            args, kw = (request, 'GET'), {}
+        elif isinstance(request, dict):
+            args, kw = (), request
+        else:
+            args, kw = tuple(request), {}
+            if len(args) == 1:
+                args += ('GET',)
+        try:
+            return self.request(*args, **kw)
+        except Exception, e:
+            return e
+
+    def save_session(self, store):
+        """
+        Saves the cookies and the authorizations learned by this session
+        in 'store', a path or an object like bolacha.session.SessionFile,
+        so that load_session() can pick them up in another process
+        instead of logging in again. Passwords are not saved.
+        """
+        if isinstance(store, basestring):
+            store = SessionFile(store)
+
+        authorizations = []
+        if hasattr(self.http, 'get_authorizations_state'):
+            authorizations = self.http.get_authorizations_state()
+
+        state = {'version': SESSION_VERSION,
+                 'cookies': self.cookies.get_state(),
+                 'authorizations': authorizations}
+        base = self._session_bases.get(_store_key(store))
+        if base is not None and hasattr(store, 'save_changes'):
+            # what was deleted since then is deleted from the store too
+            store.save_changes(state, base)
+        else:
+            store.save(state)
+        self._session_bases[_store_key(store)] = state
+
+    def load_session(self, store):
+        """
+        Adds the cookies and authorizations saved in 'store' by
+        save_session() to this session, and tells whether there were
+        any. Authorizations are only restored for the user names that
+        were given to add_credentials() of self.http.
+        """
+        if isinstance(store, basestring):
+            store = SessionFile(store)
+
+        state = store.load()
+        if not state or state.get('version') != SESSION_VERSION:
+            return False
 
-    def get(self, url, body=None, headers=None):
-        return self.request(url, 'GET', body=body, headers=headers)
+        self._session_bases[_store_key(store)] = state
 
-    def put(self, url, body=None, headers=None):
-        return self.request(url, 'PUT', body=body, headers=headers)
+        self.cookies.restore(state.get('cookies', []))
+        if hasattr(self.http, 'restore_authorizations'):
+            self.http.restore_authorizations(state.get('authorizations', []))
+        return True
 
-    def delete(self, url, body=None, headers=None):
-        return self.request(url, 'DELETE', body=body, headers=headers)
+    def request(self, url, method, body=None, headers=None, stream=False):
+        rbody, rheaders = self._prepare_request(url, method, body, headers)
 
-    def head(self, url, body=None, headers=None):
-        return self.request(url, 'HEAD', body=body, headers=headers)
+        if stream:
+            # content will be a file-like object, read as it is consumed
+            response, content = self.http.request(url, method, rbody,
+                                                  rheaders, stream=True)
+        else:
+            response, content = self.http.request(url, method, rbody, rheaders)
+
+        self._remember_response(url, response)
+        return response, content
 
-    def request(self, url, method, body=None, headers=None):
+    def _prepare_request(self, url, method, body, headers):
+        """
+        Validates the arguments of a request and returns the body and
+        headers to be sent, with this session's cookies.
+        """
         if not isinstance(url, basestring):
             raise TypeError, 'Bolacha.request, parameter url must be ' \
                   'a string. Got %s' % repr(url)
@@ -107,7 +249,9 @@ class Bolacha(object):
 
         if isinstance(body, dict):
             if body_has_file:
-                rbody = encode_multipart(BOUNDARY, body)
+                rbody = MultipartEncoder(BOUNDARY, body)
+                if not rbody.is_streaming:
+                    rbody = rbody.read()
             else:
                 rbody = urlencode(body, doseq=True)
                 is_urlencoded = True
@@ -121,12 +265,19 @@ class Bolacha(object):
             raise TypeError, 'Bolacha.request, parameter headers must be ' \
                   'a dict or NoneType. Got %s' % repr(headers)
 
-        rheaders = self.headers.copy()
+        self._lock.acquire()
+        try:
+            session = self.headers.copy()
+        finally:
+            self._lock.release()
+
+        rheaders = session.copy()
         rheaders.update(headers)
 
         if self.persistent:
-            if 'set-cookie' in self.headers:
-                rheaders['Cookie'] = self.headers['set-cookie']
+            cookie = self.cookies.header_for(url)
+            if cookie:
+                rheaders['Cookie'] = cookie
 
         if 'set-cookie' in rheaders:
             del rheaders['set-cookie']
@@ -137,13 +288,34 @@ class Bolacha(object):
             rheaders['Content-type'] = 'multipart/form-data; boundary=%s' % BOUNDARY
             rheaders['content-length'] = '%d' % len(rbody)
 
-        response, content = self.http.request(url, method, rbody, rheaders)
+        if self.compression is not None:
+            rbody, rheaders = self.compression.compress(rbody, rheaders)
 
-        if self.persistent and 'set-cookie' in response:
-            self.headers['set-cookie'] = response['set-cookie']
+        return rbody, rheaders
 
-        if not self.persistent:
-            if 'connection' in response:
-                self.headers['connection'] = response['connection']
+    def _remember_response(self, url, response):
+        if self.persistent:
+            # redirects followed on the way have cookies too
+            hops = []
+            hop = response
+            while hop is not None:
+                hops.insert(0, hop)
+                hop = getattr(hop, 'previous', None)
+            for hop in hops:
+                if 'set-cookie' in hop:
+                    # never Content-Location, which the server chooses
+                    location = getattr(hop, 'requested_uri', None) or url
+                    self.cookies.set_from_header(location, hop['set-cookie'])
 
-        return response, content
+        self._lock.acquire()
+        try:
+            # kept for code that read the last Set-Cookie from here
+            # before there was a jar; it is never sent back
+            if self.persistent and 'set-cookie' in response:
+                self.headers['set-cookie'] = response['set-cookie']
+
+            if not self.persistent:
+                if 'connection' in response:
+                    self.headers['connection'] = response['connection']
+        finally:
+            self._lock.release()
@@ -0,0 +1,970 @@
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <bolacha - http library for python, with cookies and upload support>
+# Copyright (C) <2010>  Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A non-blocking Bolacha, built on asyncore.
+
+AsyncBolacha has the same methods as Bolacha, but they return an
+AsyncRequest right away instead of blocking. Every request made by the
+same AsyncBolacha shares one event loop, which runs whenever result()
+is called on any of them (or on run()), so hundreds of requests can be
+in flight from a single thread:
+
+    browser = AsyncBolacha(cache=MemoryCache())
+    requests = [browser.get(url) for url in urls]
+    for request in requests:
+        response, content = request.result()
+
+Caching, redirects, authentication and cookies behave just like in
+Bolacha, since the decisions are left to its Http object. HTTPS and
+proxies are not supported.
+"""
+
+import asyncore
+import copy
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import httplib
+from collections import deque
+
+from bolacha import Bolacha
+from bolacha import DEFAULT_CONCURRENCY
+from bolacha.httplib2 import DEFAULT_MAX_CONNECTIONS_PER_HOST
+from bolacha.httplib2 import DEFAULT_MAX_REDIRECTS
+from bolacha.httplib2 import RESPONSE_CHUNK_SIZE
+from bolacha.httplib2 import HttpLib2Error
+from bolacha.httplib2 import RequestTimings
+from bolacha.httplib2 import Response
+from bolacha.httplib2 import ResponseStream
+from bolacha.httplib2 import ServerNotFoundError
+from bolacha.httplib2 import _body_reader
+from bolacha.httplib2 import _decompressContent
+from bolacha.httplib2 import _flight_key
+from bolacha.httplib2 import _shareable
+from bolacha.httplib2 import normalize_uri
+
+# How long the event loop waits for sockets at most before checking
+# request timeouts again.
+POLL_INTERVAL = 1.0
+
+# How long it waits at most while host names are being resolved on
+# threads, before checking whether they are.
+RESOLVE_POLL_INTERVAL = 0.005
+
+class ResponseParser(object):
+    """Parses an HTTP response as its bytes arrive through feed().
+
+    Bodies may be delimited by Content-Length, chunked, or by the server
+    closing the connection, in which case eof() must be called."""
+    def __init__(self, method):
+        self.method = method
+        self.status = None
+        self.reason = None
+        self.version = 11
+        self.headers = []
+        self.done = False
+        self.received = False
+        self._buffer = ""
+        self._body = []
+        self._state = "status"
+        self._length = None
+        self._chunked = False
+
+    def _readline(self):
+        end = self._buffer.find("\n")
+        if end < 0:
+            return None
+        line = self._buffer[:end].rstrip("\r")
+        self._buffer = self._buffer[end + 1:]
+        return line
+
+    def feed(self, data):
+        self.received = True
+        self._buffer += data
+        while not self.done:
+            if self._state == "status":
+                line = self._readline()
+                if line is None:
+                    return
+                self._parse_status(line)
+            elif self._state == "headers":
+                line = self._readline()
+                if line is None:
+                    return
+                self._parse_header(line)
+            elif self._state == "chunk-size":
+                line = self._readline()
+                if line is None:
+                    return
+                try:
+                    self._length = int(line.split(";", 1)[0], 16)
+                except ValueError:
+                    raise httplib.IncompleteRead("".join(self._body))
+                self._state = self._length and "body" or "trailer"
+            elif self._state == "chunk-end":
+                line = self._readline()
+                if line is None:
+                    return
+                self._state = "chunk-size"
+            elif self._state == "trailer":
+                line = self._readline()
+                if line is None:
+                    return
+                if not line:
+                    self.done = True
+            elif self._state == "body":
+                if not self._buffer:
+                    return
+                if self._length is None:
+                    # read until the server closes the connection
+                    self._body.append(self._buffer)
+                    self._buffer = ""
+                    return
+                data = self._buffer[:self._length]
+                self._buffer = self._buffer[self._length:]
+                self._body.append(data)
+                self._length -= len(data)
+                if not self._length:
+                    if self._chunked:
+                        self._state = "chunk-end"
+                    else:
+                        self.done = True
+
+    def _parse_status(self, line):
+        if not line:
+            # tolerate blank lines left over from a previous response
+            return
+        try:
+            version, rest = line.split(None, 1)
+            status, self.reason = (rest.split(None, 1) + [""])[:2]
+            self.status = int(status)
+        except ValueError:
+            raise httplib.BadStatusLine(line)
+        if not version.startswith("HTTP/"):
+            raise httplib.BadStatusLine(line)
+        self.version = version == "HTTP/1.0" and 10 or 11
+        self.headers = []
+        self._state = "headers"
+
+    def _parse_header(self, line):
+        if line:
+            if line[0] in " \t" and self.headers:
+                key, value = self.headers[-1]
+                self.headers[-1] = (key, value + " " + line.strip())
+            elif ":" in line:
+                key, value = line.split(":", 1)
+                self.headers.append((key.strip().lower(), value.strip()))
+            return
+
+        if 100 <= self.status < 200:
+            # an interim response, the real one follows
+            self._state = "status"
+            return
+
+        headers = dict(self.headers)
+        if self.method == "HEAD" or self.status in (204, 304):
+            self.done = True
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            self._chunked = True
+            self._state = "chunk-size"
+        elif "content-length" in headers:
+            try:
+                self._length = int(headers["content-length"])
+            except ValueError:
+                self._length = None
+            self._state = "body"
+            if self._length == 0:
+                self.done = True
+        else:
+            self._state = "body"
+
+    def eof(self):
+        """Called when the server closes the connection. Returns True if
+        that completed the response."""
+        if not self.done and self._state == "body" and self._length is None:
+            self.done = True
+        return self.done
+
+    @property
+    def unread(self):
+        """Bytes the server sent past the end of the response"""
+        return len(self._buffer)
+
+    @property
+    def will_close(self):
+        connection = dict(self.headers).get("connection", "").lower()
+        if self._state == "body" and self._length is None:
+            return True
+        if self.version == 11:
+            return "close" in connection
+        return "keep-alive" not in connection
+
+    def response(self):
+        info = {}
+        for key, value in self.headers:
+            if key in info:
+                info[key] = "%s, %s" % (info[key], value)
+            else:
+                info[key] = value
+        info["status"] = str(self.status)
+        response = Response(info)
+        response.reason = self.reason
+        response.version = self.version
+        return response
+
+    def content(self):
+        return "".join(self._body)
+
+class AsyncRequest(object):
+    """The result of a request made through an AsyncBolacha. It runs the
+    client's event loop until the response arrives."""
+    def __init__(self, client):
+        self.client = client
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def add_done_callback(self, callback):
+        """Calls callback(request) once the request is done, or right
+        away if it already is."""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self):
+        """Returns the (response, content) tuple, raising whatever
+        exception the request failed with."""
+        self.client._run_until(self.done)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        self.client._run_until(self.done)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def _resolve(self, result):
+        self._finish(result, None)
+
+    def _fail(self, exc_info):
+        self._finish(None, exc_info)
+
+    def _copy(self, other):
+        self._finish(other._result, other._exc_info)
+
+    def _finish(self, result, exc_info):
+        if self._done:
+            return
+        self._done = True
+        self._result = result
+        self._exc_info = exc_info
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                # one broken callback must not keep the others from running
+                traceback.print_exc()
+
+class _Exchange(object):
+    """One request on the wire, as handed to a connection."""
+    def __init__(self, key, host, port, method, head, body, timings):
+        self.key = key
+        self.host = host
+        self.port = port
+        self.method = method
+        self.head = head
+        self.body = body
+        self.timings = timings
+        self.attempts = 0
+        self.request = None
+        self.sent_at = None
+        self.first_byte_at = None
+
+class AsyncConnection(asyncore.dispatcher):
+    """A keep-alive connection owned by an AsyncBolacha, which sends one
+    request at a time and parses its response.
+
+    It has no socket until the client has resolved its host and called
+    connect_to() with the addresses, which are tried one after the
+    other until one can be connected to."""
+    def __init__(self, client, key, host, port):
+        asyncore.dispatcher.__init__(self, map=client._map)
+        self.client = client
+        self.key = key
+        self.host = host
+        self.port = port
+        self.exchange = None
+        self.parser = None
+        self.deadline = None
+        self.discarded = False
+        self.dns_time = self.connect_time = self.tls_time = 0.0
+        self._addresses = []
+        self._connect_started = None
+        self._out = ""
+        self._body = None
+
+    def connect_to(self, addresses, dns_time):
+        """Connects to the first of 'addresses', as getaddrinfo() returns
+        them, that can be connected to"""
+        self.dns_time = dns_time
+        if self.exchange is not None:
+            self.exchange.timings.dns += dns_time
+        self._addresses = list(addresses)
+        self._connect_next(socket.error("getaddrinfo returns an empty list"))
+
+    def _connect_next(self, error):
+        """Starts connecting to the next address, or fails with 'error',
+        why the last one could not be connected to, if there is none"""
+        while self._addresses:
+            family, socktype, proto, canonname, address = self._addresses.pop(0)
+            # the new socket is made before the old one is closed, so
+            # that it can't get the descriptor the loop may still have
+            # events for
+            old = self.socket
+            if old is not None:
+                self.del_channel()
+            try:
+                self.create_socket(family, socktype)
+            finally:
+                if old is not None:
+                    old.close()
+            self._connect_started = time.time()
+            try:
+                self.connect(address)
+                return
+            except socket.error, error:
+                continue
+        self._fail((socket.error, error, None))
+
+    def start(self, exchange):
+        exchange.attempts += 1
+        self.exchange = exchange
+        self.parser = ResponseParser(exchange.method)
+        if isinstance(exchange.body, basestring):
+            self._out = exchange.head + exchange.body
+            self._body = None
+        else:
+            # streamed bodies are consumed while being sent
+            exchange.body.rewind()
+            self._out = exchange.head
+            self._body = exchange.body
+        exchange.sent_at = time.time()
+        self._touch()
+
+    def _touch(self):
+        if self.client.timeout is not None:
+            self.deadline = time.time() + self.client.timeout
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        if self.exchange is None:
+            return False
+        return self.connecting or bool(self._out) or self._body is not None
+
+    def handle_connect_event(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._connect_next(socket.error(error, os.strerror(error)))
+        else:
+            asyncore.dispatcher.handle_connect_event(self)
+
+    def handle_connect(self):
+        self.connect_time = time.time() - self._connect_started
+        if self.exchange is not None:
+            self.exchange.timings.connect += self.connect_time
+            # the time to first byte starts now
+            self.exchange.sent_at = time.time()
+
+    def handle_write(self):
+        if not self._out and self._body is not None:
+            self._out = self._body.read(RESPONSE_CHUNK_SIZE)
+            if not self._out:
+                self._body = None
+                return
+        sent = self.send(self._out)
+        if self.exchange is None:
+            # the connection was closed while sending
+            return
+        self._out = self._out[sent:]
+        self._touch()
+
+    def handle_read(self):
+        if not self.connected:
+            # moved on to the next address
+            return
+        data = self.recv(RESPONSE_CHUNK_SIZE)
+        if not data:
+            return
+        if self.exchange is None:
+            # nothing was asked, so there is nothing sensible to read
+            self.client._discard(self)
+            return
+        self._touch()
+        exchange = self.exchange
+        if exchange.first_byte_at is None:
+            exchange.first_byte_at = time.time()
+            exchange.timings.ttfb += exchange.first_byte_at - exchange.sent_at
+        try:
+            self.parser.feed(data)
+        except Exception:
+            self._fail(sys.exc_info())
+            return
+        if self.parser.done:
+            self._complete()
+
+    def handle_close(self):
+        if self.exchange is None:
+            self.client._discard(self)
+        elif self.connecting and not self.connected:
+            self._connect_next(socket.error("Connection closed while connecting"))
+        elif self.parser.eof():
+            self._complete()
+        elif not self.parser.received and self.exchange.attempts < 2:
+            # a kept-alive connection the server had already given up on
+            exchange = self.exchange
+            self.exchange = None
+            self.client._discard(self)
+            self.client._send(exchange)
+        elif not self.parser.received:
+            self._fail((httplib.BadStatusLine, httplib.BadStatusLine(""), None))
+        else:
+            error = httplib.IncompleteRead(self.parser.content())
+            self._fail((httplib.IncompleteRead, error, None))
+
+    def handle_error(self):
+        if self.connecting and not self.connected:
+            self._connect_next(sys.exc_info()[1])
+        else:
+            self._fail(sys.exc_info())
+
+    def timed_out(self):
+        self._fail((socket.timeout, socket.timeout("timed out"), None))
+
+    def close(self):
+        # no socket yet while the host is being resolved
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+
+    def _complete(self):
+        exchange, parser = self.exchange, self.parser
+        self.exchange = None
+        self.deadline = None
+        if exchange.first_byte_at is not None:
+            exchange.timings.transfer += time.time() - exchange.first_byte_at
+        if parser.will_close or parser.unread or not self.connected:
+            self.client._discard(self)
+        else:
+            self.client._release(self)
+        exchange.request._resolve((parser.response(), parser.content()))
+
+    def _fail(self, exc_info):
+        exchange = self.exchange
+        self.exchange = None
+        self.client._discard(self)
+        if exchange is not None:
+            exchange.request._fail(exc_info)
+
+class AsyncBolacha(Bolacha):
+    """A Bolacha whose requests return AsyncRequest objects and share a
+    single asyncore event loop.
+
+    The Http object is still built from the same arguments, and makes
+    the same caching, redirect and authentication decisions, with its
+    cache, credentials, timeout and other settings. Connections are kept
+    in a pool of their own, bounded by 'max_connections_per_host';
+    further requests to the same host wait for a connection to be free.
+    Host names that its DNSCache doesn't know yet are resolved on a
+    thread, so that the event loop doesn't wait for them."""
+    def __init__(self, http=None, persistent=True, **kw):
+        super(AsyncBolacha, self).__init__(http, persistent, **kw)
+        self.max_connections_per_host = kw.get('max_connections_per_host',
+                                               DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self._map = {}
+        self._idle = {}
+        self._counts = {}
+        self._queued = {}
+        self._flights = {}
+        # connections waiting for their host to be resolved, and the
+        # (connection, addresses, seconds) of those that were
+        self._resolving = set()
+        self._resolved = deque()
+
+    @property
+    def timeout(self):
+        return getattr(self.http, 'timeout', None)
+
+    def request(self, url, method, body=None, headers=None, stream=False):
+        """Like Bolacha.request. With 'stream' the content is a file-like
+        object, but the body has been read whole by then."""
+        rbody, rheaders = self._prepare_request(url, method, body, headers)
+
+        def remember(response, content):
+            self._remember_response(url, response)
+            for hook in getattr(self.http, 'timing_hooks', ()):
+                hook(response.timings)
+            if stream:
+                content = ResponseStream(_body_reader(content))
+            return (response, content)
+
+        # the body is read whole, so even streamed responses can be shared
+        if self.http._coalesces(method, rbody, False, rheaders):
+            request = self._coalesced_fetch(url, method, rheaders, DEFAULT_MAX_REDIRECTS)
+        else:
+            request = self._fetch(url, method, rbody, rheaders, DEFAULT_MAX_REDIRECTS)
+        return self._then(request, remember)
+
+    def map(self, requests, concurrency=DEFAULT_CONCURRENCY):
+        """Like Bolacha.map, but the requests share the event loop instead
+        of threads, with at most 'concurrency' of them in flight."""
+        if concurrency < 1:
+            raise ValueError, 'AsyncBolacha.map, parameter concurrency ' \
+                  'must be at least 1, got %r' % concurrency
+
+        pending = deque(enumerate(requests))
+        results = [None] * len(pending)
+        running = []
+
+        def start():
+            while pending and len(running) < concurrency:
+                index, request = pending.popleft()
+                result = self._map_one(request)
+                if isinstance(result, AsyncRequest):
+                    running.append(index)
+                    result.add_done_callback(finished(index))
+                else:
+                    results[index] = result
+
+        def finished(index):
+            def done(request):
+                running.remove(index)
+                if request._exc_info is not None:
+                    results[index] = request._exc_info[1]
+                else:
+                    results[index] = request._result
+                start()
+            return done
+
+        start()
+        self._run_until(lambda: not pending and not running)
+        return results
+
+    def run(self):
+        """Runs the event loop until every request is done."""
+        self._run_until(lambda: not self._busy())
+
+    def close(self):
+        """Closes every connection, failing the requests still using
+        them."""
+        self._queued.clear()
+        error = HttpLib2Error("AsyncBolacha was closed")
+        for conn in self._connections():
+            conn._fail((HttpLib2Error, error, None))
+
+    def _connections(self):
+        return self._map.values() + list(self._resolving)
+
+    def _busy(self):
+        return any([conn.exchange is not None for conn in self._connections()])
+
+    def _run_until(self, condition):
+        while not condition():
+            if not self._busy():
+                raise HttpLib2Error("AsyncBolacha has no request left to wait for")
+            now = time.time()
+            deadlines = [conn.deadline for conn in self._connections()
+                         if conn.deadline is not None and conn.exchange is not None]
+            wait = POLL_INTERVAL
+            if deadlines:
+                wait = max(0, min(min(deadlines) - now, POLL_INTERVAL))
+            if self._resolving:
+                wait = min(wait, RESOLVE_POLL_INTERVAL)
+            if self._map:
+                asyncore.loop(timeout=wait, map=self._map, count=1)
+            else:
+                time.sleep(wait)
+            self._connect_resolved()
+            now = time.time()
+            for conn in self._connections():
+                if conn.exchange is not None and conn.deadline is not None \
+                   and conn.deadline <= now:
+                    conn.timed_out()
+
+    def _then(self, request, transform):
+        """Returns an AsyncRequest resolved with transform(response,
+        content) once 'request' is done. transform may return another
+        AsyncRequest, whose result is then passed along."""
+        chained = AsyncRequest(self)
+
+        def done(request):
+            if request._exc_info is not None:
+                chained._fail(request._exc_info)
+                return
+            try:
+                result = transform(*request._result)
+            except Exception:
+                chained._fail(sys.exc_info())
+                return
+            if isinstance(result, AsyncRequest):
+                result.add_done_callback(chained._copy)
+            else:
+                chained._resolve(result)
+
+        request.add_done_callback(done)
+        return chained
+
+    def _done(self, result):
+        """An AsyncRequest that is already resolved with 'result'"""
+        request = AsyncRequest(self)
+        request._resolve(result)
+        return request
+
+    def _send(self, exchange):
+        key = exchange.key
+        if self._idle.get(key):
+            conn = self._idle[key].pop()
+        elif self._counts.get(key, 0) < self.max_connections_per_host:
+            conn = AsyncConnection(self, key, exchange.host, exchange.port)
+            self._counts[key] = self._counts.get(key, 0) + 1
+            conn.start(exchange)
+            self._resolve(conn)
+            return
+        else:
+            self._queued.setdefault(key, deque()).append(exchange)
+            return
+        conn.start(exchange)
+
+    def _resolve(self, conn):
+        """Resolves the host of 'conn' and connects it: right away if the
+        DNSCache of self.http knows the host, else once a thread has
+        looked it up"""
+        resolver = getattr(self.http, 'dns_cache', None)
+        started = time.time()
+        try:
+            addresses = resolver is not None and \
+                        resolver.cached(conn.host, conn.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror:
+            self._unresolved(conn)
+            return
+        if addresses:
+            conn.connect_to(addresses, time.time() - started)
+            return
+
+        def lookup():
+            try:
+                if resolver is not None:
+                    addresses = resolver.lookup(conn.host, conn.port, 0, socket.SOCK_STREAM)
+                else:
+                    addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+            except socket.gaierror:
+                addresses = None
+            self._resolved.append((conn, addresses, time.time() - started))
+
+        self._resolving.add(conn)
+        thread = threading.Thread(target=lookup)
+        thread.daemon = True
+        thread.start()
+
+    def _connect_resolved(self):
+        """Connects the connections whose host was resolved meanwhile"""
+        while self._resolved:
+            conn, addresses, dns_time = self._resolved.popleft()
+            self._resolving.discard(conn)
+            if conn.discarded:
+                # failed, timed out or closed while it was resolved
+                continue
+            if addresses is None:
+                self._unresolved(conn)
+            else:
+                conn.connect_to(addresses, dns_time)
+
+    def _unresolved(self, conn):
+        error = ServerNotFoundError("Unable to find the server at %s" % conn.host)
+        conn._fail((ServerNotFoundError, error, None))
+
+    def _release(self, conn):
+        queued = self._queued.get(conn.key)
+        if queued:
+            conn.start(queued.popleft())
+        else:
+            self._idle.setdefault(conn.key, []).append(conn)
+
+    def _discard(self, conn):
+        key = conn.key
+        if conn in self._idle.get(key, []):
+            self._idle[key].remove(conn)
+        self._resolving.discard(conn)
+        if not conn.discarded:
+            conn.discarded = True
+            conn.close()
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                del self._counts[key]
+        queued = self._queued.get(key)
+        if queued:
+            self._send(queued.popleft())
+
+    def _coalesced_fetch(self, uri, method, headers, redirections):
+        """Like _fetch, but a request identical to one in flight gets a
+        copy of its response instead of being sent, as Http does"""
+        key = _flight_key(method, uri, headers)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = self._fetch(uri, method, None, headers, redirections)
+
+            def landed(request):
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.add_done_callback(landed)
+            return flight
+
+        started = time.time()
+
+        def copied(response, content):
+            if not _shareable(response):
+                return self._fetch(uri, method, None, headers, redirections)
+            response = copy.copy(response)
+            response.timings = timings = RequestTimings(method, uri)
+            timings.status = response.status
+            timings.coalesced = True
+            timings.total = time.time() - started
+            return (response, content)
+
+        return self._then(flight, copied)
+
+    def _fetch(self, uri, method, body, headers, redirections, revalidating=False):
+        """The asynchronous counterpart of Http._cached_request"""
+        started = time.time()
+        timings = RequestTimings(method, uri)
+        try:
+            request = self._fetch_or_raise(uri, method, body, headers, redirections,
+                                           timings, started, revalidating)
+        except Exception:
+            request = AsyncRequest(self)
+            request._fail(sys.exc_info())
+            return request
+
+        def finished(response, content):
+            timings.status = response.status
+            timings.total = time.time() - started
+            response.timings = timings
+            if response.requested_uri is None:
+                response.requested_uri = timings.uri
+            return (response, content)
+
+        return self._then(request, finished)
+
+    def _fetch_or_raise(self, uri, method, body, headers, redirections, timings, started, revalidating):
+        http = self.http
+        if normalize_uri(uri).scheme != 'http':
+            raise HttpLib2Error("AsyncBolacha only supports http URIs, got %s" % uri)
+
+        check = http._check_cache(uri, method, headers, timings, revalidating)
+        headers = check.headers
+
+        if check.action == "fresh":
+            response = Response(check.info)
+            response.fromcache = True
+            response.requested_uri = check.normalized.uri
+            return self._done((response, check.content))
+
+        if check.action == "stale":
+            self._revalidate_later(check.normalized.uri, dict(headers), redirections, check.cachekey)
+            return self._done(http._serve_stale(check.info, check.content, False, timings, started))
+
+        if check.action == "send":
+            return self._exchange(check, method, body, redirections, timings)
+
+        if check.action == "redirect":
+            def redirected(response, new_content):
+                response.previous = Response(check.info)
+                response.previous.fromcache = True
+                response.previous.requested_uri = check.normalized.uri
+                timings.add(response.timings)
+                timings.redirects += 1
+                return (response, new_content)
+            request = self._then(self._fetch(check.info['-x-permanent-redirect-url'], "GET", None,
+                                             headers, redirections - 1), redirected)
+        else:
+            request = self._exchange(check, method, body, redirections, timings)
+            if check.stale_if_error:
+                request = self._or_stale(request, check, timings, started)
+
+        def revalidated(response, new_content):
+            if response.stale:
+                # served instead of an error
+                return (response, new_content)
+            result = http._revalidated(check, method, response, new_content, timings)
+            if result is None:
+                return self._exchange(check, method, body, redirections, timings)
+            return result
+
+        return self._then(request, revalidated)
+
+    def _revalidate_later(self, uri, headers, redirections, cachekey):
+        """Revalidates the stale entry for 'uri' along with the other
+        requests on the event loop, unless that is already being done"""
+        if not self.http._start_revalidation(cachekey):
+            return
+        request = self._fetch(uri, "GET", None, headers, redirections, revalidating=True)
+        request.add_done_callback(lambda request: self.http._end_revalidation(cachekey))
+
+    def _or_stale(self, request, check, timings, started):
+        """'request', unless it fails or gets a 5xx response and the stale
+        entry of 'check' is to be served instead"""
+        http = self.http
+        chained = AsyncRequest(self)
+
+        def done(request):
+            exc_info = request._exc_info
+            if exc_info is not None and \
+               not issubclass(exc_info[0], (socket.error, httplib.HTTPException, ServerNotFoundError)):
+                chained._copy(request)
+                return
+            response = exc_info is None and request._result[0] or None
+            try:
+                stale_content = http._stale_on_error(check, response, timings)
+                if stale_content is not None:
+                    chained._resolve(http._serve_stale(check.info, stale_content, False, timings, started))
+                    return
+            except Exception:
+                chained._fail(sys.exc_info())
+                return
+            chained._copy(request)
+
+        request.add_done_callback(done)
+        return chained
+
+    def _exchange(self, check, method, body, redirections, timings):
+        """The asynchronous counterpart of Http._request: sends the
+        request 'check' prepared, answers authentication challenges and
+        follows redirects"""
+        http = self.http
+        (normalized, headers) = (check.normalized, check.headers)
+
+        auth = http._authorization_for(normalized)
+        if auth:
+            auth.request(method, normalized.request_uri, headers, body)
+        request = self._send_request(normalized, method, body, headers, timings)
+
+        def authorized(response, content):
+            if auth and auth.response(response, body):
+                auth.request(method, normalized.request_uri, headers, body)
+                timings.auth_retries += 1
+
+                def retried(response, content):
+                    response._stale_digest = 1
+                    return self._challenged(check, method, body, timings, response, content)
+                return self._then(self._send_request(normalized, method, body, headers, timings), retried)
+            return self._challenged(check, method, body, timings, response, content)
+
+        def received(response, content):
+            if not http._redirects(method, response):
+                http._store_response(normalized.uri, method, headers, response, content, check.cachekey, timings)
+                return (response, content)
+            redirect = http._redirect(normalized.uri, method, headers, response, content,
+                                      redirections, check.cachekey, timings)
+            if redirect is None:
+                return (response, content)
+            (location, redirect_method, old_response) = redirect
+
+            def redirected(response, content):
+                response.previous = old_response
+                timings.add(response.timings)
+                timings.redirects += 1
+                return (response, content)
+
+            return self._then(self._fetch(location, redirect_method, body, headers, redirections - 1), redirected)
+
+        return self._then(self._then(request, authorized), received)
+
+    def _challenged(self, check, method, body, timings, response, content, challenges=None):
+        """Answers the 401 'response' with the credentials of self.http,
+        trying the authorizations of 'challenges' one after the other"""
+        if response.status != 401:
+            return (response, content)
+        http = self.http
+        (normalized, headers) = (check.normalized, check.headers)
+        if challenges is None:
+            challenges = http._auth_from_challenge(normalized.authority, normalized, headers, response, content)
+        for authorization in challenges:
+            authorization.request(method, normalized.request_uri, headers, body)
+            timings.auth_retries += 1
+
+            def answered(response, content):
+                if response.status == 401:
+                    return self._challenged(check, method, body, timings, response, content, challenges)
+                http.authorizations.append(authorization)
+                authorization.response(response, body)
+                return (response, content)
+
+            return self._then(self._send_request(normalized, method, body, headers, timings), answered)
+        return (response, content)
+
+    def _send_request(self, normalized, method, body, headers, timings):
+        """Sends one request to the NormalizedURI 'normalized' and reads
+        its response, which is decompressed"""
+        http = self.http
+        authority = normalized.authority
+        host, port = authority, 80
+        if ':' in authority:
+            host, port = authority.rsplit(':', 1)
+            port = int(port)
+
+        lines = ["%s %s HTTP/1.1" % (method, normalized.request_uri)]
+        # headers were lower-cased by Http._check_cache()
+        if 'host' not in headers:
+            lines.append("Host: %s" % authority)
+        if 'content-length' not in headers and 'transfer-encoding' not in headers and \
+               (body or method in ["POST", "PUT"]):
+            lines.append("content-length: %d" % len(body))
+        for key, value in headers.items():
+            lines.append("%s: %s" % (key, value))
+        head = "\r\n".join(lines) + "\r\n\r\n"
+
+        exchange = _Exchange(authority, host, port, method, head, body or "", timings)
+        exchange.request = AsyncRequest(self)
+        self._send(exchange)
+
+        def received(response, content):
+            if method != "HEAD":
+                content = timings.timed('decompress', _decompressContent, response, content, http.max_decompressed_size)
+            return (response, content)
+
+        return self._then(exchange.request, received)
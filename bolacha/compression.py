@@ -0,0 +1,168 @@
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <bolacha - http library for python, with cookies and upload support>
+# Copyright (C) <2010>  Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Compression of request bodies, for servers that take them with
+Content-Encoding: gzip. See Bolacha(compression=...).
+
+Bodies held in memory are compressed before they are sent, and keep a
+Content-Length. Streamed ones, such as multipart uploads of files, are
+compressed while they are sent; since their compressed length is not
+known up front, they go out with Transfer-Encoding: chunked, which the
+server must accept as well.
+"""
+
+import zlib
+
+__all__ = ['RequestCompression', 'GzipStream', 'COMPRESSIBLE_TYPES']
+
+# Content types worth compressing, by prefix; images, archives and
+# the like are compressed already
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/xml',
+    'application/javascript',
+    'application/x-www-form-urlencoded',
+    'multipart/form-data',
+)
+
+# Smaller bodies gain too little to be worth the CPU time
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+CHUNK_SIZE = 64 * 1024
+
+def _gzip_compressor(level):
+    # 16 + MAX_WBITS wraps the deflate stream in a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _find_header(headers, name):
+    """The key of header 'name' in 'headers', whatever its case, or None"""
+    for key in headers:
+        if key.lower() == name:
+            return key
+    return None
+
+class GzipStream(object):
+    """
+    A file-like body that gzips another one, such as a
+    MultipartEncoder, 'chunk_size' bytes at a time while it is read,
+    and frames the result for Transfer-Encoding: chunked.
+    """
+    def __init__(self, source, level=DEFAULT_LEVEL, chunk_size=CHUNK_SIZE):
+        self.source = source
+        self.level = level
+        self.chunk_size = chunk_size
+        self.rewind()
+
+    def rewind(self):
+        """Starts over, so that the body can be sent again"""
+        if hasattr(self.source, 'rewind'):
+            self.source.rewind()
+        self._compressor = _gzip_compressor(self.level)
+        self._buffer = ''
+        self._finished = False
+        # how many bytes were read, and how many they compressed to
+        self.bytes_in = self.bytes_out = 0
+
+    def _fill(self, size):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            data = self.source.read(self.chunk_size)
+            if data:
+                self.bytes_in += len(data)
+                compressed = self._compressor.compress(data)
+            else:
+                compressed = self._compressor.flush()
+                self._finished = True
+            if compressed:
+                self.bytes_out += len(compressed)
+                self._buffer += '%x\r\n%s\r\n' % (len(compressed), compressed)
+            if self._finished:
+                self._buffer += '0\r\n\r\n'
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+class RequestCompression(object):
+    """
+    Which request bodies to gzip, and how hard.
+
+    Bodies of at least 'min_size' bytes whose Content-Type starts with
+    one of 'content_types' (or of any type, if that is None) are
+    compressed at 'level', from 1, the fastest, to 9, the smallest.
+    Requests that have a Content-Encoding already are left alone.
+    """
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, content_types=COMPRESSIBLE_TYPES,
+                 level=DEFAULT_LEVEL):
+        self.min_size = min_size
+        self.content_types = content_types
+        self.level = level
+
+    def applies_to(self, body, headers):
+        if not body or _find_header(headers, 'content-encoding') is not None:
+            return False
+
+        if self.content_types is not None:
+            key = _find_header(headers, 'content-type')
+            content_type = key is not None and headers[key].lower() or ''
+            if not content_type.startswith(tuple(self.content_types)):
+                return False
+
+        try:
+            size = len(body)
+        except TypeError:
+            # a stream of unknown length may well be large
+            return True
+        return size >= self.min_size
+
+    def compress(self, body, headers):
+        """Returns the body and headers to send in place of 'body' and
+        'headers', compressed if they should be."""
+        if not self.applies_to(body, headers):
+            return body, headers
+
+        headers = headers.copy()
+        for name in ('content-length', 'transfer-encoding'):
+            key = _find_header(headers, name)
+            if key is not None:
+                del headers[key]
+        headers['content-encoding'] = 'gzip'
+
+        if isinstance(body, basestring):
+            compressor = _gzip_compressor(self.level)
+            body = compressor.compress(body) + compressor.flush()
+            headers['content-length'] = '%d' % len(body)
+        else:
+            body = GzipStream(body, self.level)
+            headers['transfer-encoding'] = 'chunked'
+        return body, headers
@@ -0,0 +1,405 @@
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <bolacha - http library for python, with cookies and upload support>
+# Copyright (C) <2010>  Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+A cookie jar following RFC 6265: cookies are kept per domain and
+path, expire, and are only sent to the hosts they belong to.
+"""
+
+import calendar
+import heapq
+import re
+import threading
+import time
+import urlparse
+from email.Utils import parsedate_tz
+
+__all__ = ['Cookie', 'CookieJar', 'parse_set_cookie', 'split_set_cookie',
+           'registrable_domain']
+
+# Set-Cookie headers that came in the same response are merged with
+# ", ", which also appears in Expires dates. A new cookie starts where
+# a comma is followed by "name=".
+SET_COOKIE_SPLITTER = re.compile(r',\s*(?=[^;,\s]+=)')
+
+IP_ADDRESS = re.compile(r'^(\d+\.){3}\d+$|:')
+
+# Second level labels under which names are registered, as in co.uk or
+# com.br. Without a public suffix list this is an approximation.
+SECOND_LEVEL_LABELS = frozenset(['ac', 'co', 'com', 'edu', 'gov', 'net', 'org'])
+
+# How many Cookie headers are remembered per registrable domain
+MAX_CACHED_HEADERS = 256
+
+# What get_state() keeps of each cookie
+COOKIE_ATTRIBUTES = ('name', 'value', 'domain', 'path', 'expires', 'secure',
+                     'httponly', 'host_only')
+
+# Smallest size of the expiry heap that is worth cleaning up
+MIN_HEAP_COMPACTION = 1024
+
+def registrable_domain(host):
+    """The part of 'host' that a name is registered under, such as
+    'example.com' for 'www.example.com' or 'example.co.uk' for
+    'www.example.co.uk'. IP addresses are their own domain."""
+    host = host.lower().rstrip('.')
+    if IP_ADDRESS.search(host):
+        return host
+    labels = host.split('.')
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+def _is_public_suffix(domain):
+    """Whether cookies may not be set for all of 'domain', such as
+    'com' or 'co.uk'"""
+    if IP_ADDRESS.search(domain):
+        return False
+    labels = domain.split('.')
+    return len(labels) == 1 or (len(labels) == 2 and len(labels[1]) == 2 and
+                                labels[0] in SECOND_LEVEL_LABELS)
+
+def split_set_cookie(header):
+    """Splits merged Set-Cookie headers into one string per cookie"""
+    return [part for part in SET_COOKIE_SPLITTER.split(header) if part.strip()]
+
+def _parse_date(value):
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return calendar.timegm(parsed[:6]) - (parsed[9] or 0)
+    except (ValueError, OverflowError):
+        return None
+
+def _default_path(path):
+    """The directory of the request path, RFC 6265 section 5.1.4"""
+    if not path.startswith('/') or path.count('/') == 1:
+        return '/'
+    return path[:path.rindex('/')]
+
+class Cookie(object):
+    """A single cookie. 'expires' is a timestamp, or None for cookies
+    that last as long as the jar."""
+    def __init__(self, name, value, domain, path='/', expires=None,
+                 secure=False, httponly=False, host_only=True):
+        self.name = name
+        self.value = value
+        self.domain = domain
+        self.path = path
+        self.expires = expires
+        self.secure = secure
+        self.httponly = httponly
+        self.host_only = host_only
+        # set by the jar, orders cookies of the same path
+        self.serial = 0
+        # set by the jar, tells its expiry heap entry from stale ones
+        self._heap_serial = None
+
+    @property
+    def key(self):
+        return (self.domain, self.path, self.name)
+
+    def is_expired(self, now=None):
+        if self.expires is None:
+            return False
+        if now is None:
+            now = time.time()
+        return self.expires <= now
+
+    def matches(self, host, path, secure):
+        """Whether this cookie is to be sent in a request to 'host' and
+        'path', over a secure channel or not."""
+        if self.secure and not secure:
+            return False
+        if self.host_only:
+            if host != self.domain:
+                return False
+        elif host != self.domain and not host.endswith('.' + self.domain):
+            return False
+        if path == self.path:
+            return True
+        return path.startswith(self.path) and \
+               (self.path.endswith('/') or path[len(self.path)] == '/')
+
+    def __repr__(self):
+        return '<Cookie %s=%s for %s%s>' % (self.name, self.value,
+                                            self.domain, self.path)
+
+def parse_set_cookie(header, host, path='/', now=None):
+    """Parses the value of one Set-Cookie header, received from 'host'
+    for a request to 'path', and returns a Cookie, or None when the
+    header is malformed or names a domain 'host' is not part of."""
+    parts = header.split(';')
+    if '=' not in parts[0]:
+        return None
+    name, value = parts[0].split('=', 1)
+    name = name.strip()
+    if not name:
+        return None
+
+    if now is None:
+        now = time.time()
+    host = host.lower()
+    cookie = Cookie(name, value.strip(), host, _default_path(path))
+    max_age = None
+    for attribute in parts[1:]:
+        if '=' in attribute:
+            key, attribute_value = attribute.split('=', 1)
+        else:
+            key, attribute_value = attribute, ''
+        key = key.strip().lower()
+        attribute_value = attribute_value.strip()
+
+        if key == 'expires':
+            expires = _parse_date(attribute_value)
+            if expires is not None:
+                cookie.expires = expires
+        elif key == 'max-age':
+            try:
+                max_age = int(attribute_value)
+            except ValueError:
+                pass
+        elif key == 'domain' and attribute_value:
+            domain = attribute_value.lstrip('.').lower()
+            if host != domain and not host.endswith('.' + domain):
+                return None
+            if _is_public_suffix(domain):
+                if domain != host:
+                    return None
+                # a host named like a suffix gets a host-only cookie
+                continue
+            cookie.domain = domain
+            cookie.host_only = False
+        elif key == 'path' and attribute_value.startswith('/'):
+            cookie.path = attribute_value
+        elif key == 'secure':
+            cookie.secure = True
+        elif key == 'httponly':
+            cookie.httponly = True
+
+    if max_age is not None:
+        # Max-Age wins over Expires
+        cookie.expires = now + max_age
+    return cookie
+
+class CookieJar(object):
+    """
+    Keeps the cookies of a session and builds the Cookie header of
+    each request.
+
+    Cookies are indexed by registrable domain, so finding the ones for
+    a request only looks at cookies of the same site. The resulting
+    header is cached per host, path and scheme until a cookie of that
+    domain changes, and cookies with an expiry date are kept in a heap
+    so expired ones are dropped without going through the whole jar.
+    It is safe to share between threads.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        # registrable domain -> {(domain, path, name): Cookie}
+        self._domains = {}
+        # registrable domain -> {(host, path, secure): Cookie header}
+        self._headers = {}
+        # (expires, serial, registrable domain, key)
+        self._expiry = []
+        self._serial = 0
+        # replaced cookies leave entries behind in the heap, which is
+        # rebuilt when it grows to this size
+        self._compact_at = MIN_HEAP_COMPACTION
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            self._prune(time.time())
+            return sum([len(cookies) for cookies in self._domains.values()])
+        finally:
+            self._lock.release()
+
+    def __iter__(self):
+        self._lock.acquire()
+        try:
+            self._prune(time.time())
+            cookies = []
+            for bucket in self._domains.values():
+                cookies.extend(bucket.values())
+        finally:
+            self._lock.release()
+        cookies.sort(key=lambda cookie: cookie.serial)
+        return iter(cookies)
+
+    def set_cookie(self, cookie, now=None):
+        """Stores 'cookie', replacing the one of the same name, domain
+        and path. An expired cookie deletes that one instead."""
+        if now is None:
+            now = time.time()
+        domain = registrable_domain(cookie.domain)
+        self._lock.acquire()
+        try:
+            bucket = self._domains.get(domain, {})
+            old = bucket.get(cookie.key)
+            if cookie.is_expired(now):
+                if old is None:
+                    return
+                del bucket[cookie.key]
+                if not bucket:
+                    del self._domains[domain]
+                self._headers.pop(domain, None)
+                return
+
+            self._serial += 1
+            # a replaced cookie keeps its place among the others
+            cookie.serial = old is not None and old.serial or self._serial
+            self._domains[domain] = bucket
+            bucket[cookie.key] = cookie
+            if cookie.expires is not None:
+                heapq.heappush(self._expiry, (cookie.expires, self._serial,
+                                              domain, cookie.key))
+                cookie._heap_serial = self._serial
+                if len(self._expiry) >= self._compact_at:
+                    self._compact()
+            # servers often send the same cookies again, which does not
+            # change what is sent back
+            if old is None or (old.value, old.secure, old.host_only) != \
+                   (cookie.value, cookie.secure, cookie.host_only):
+                self._headers.pop(domain, None)
+        finally:
+            self._lock.release()
+
+    def set_from_header(self, url, header, now=None):
+        """Stores the cookies of the Set-Cookie 'header' (a string, which
+        may hold several merged headers, or a list of them) received in
+        response to 'url'. Returns the cookies that were accepted."""
+        if isinstance(header, basestring):
+            header = split_set_cookie(header)
+        else:
+            header = [cookie for part in header for cookie in split_set_cookie(part)]
+
+        parsed = urlparse.urlparse(url)
+        host = (parsed.hostname or '').lower()
+        if not host:
+            return []
+        accepted = []
+        for part in header:
+            cookie = parse_set_cookie(part, host, parsed.path or '/', now)
+            if cookie is not None:
+                self.set_cookie(cookie, now)
+                accepted.append(cookie)
+        return accepted
+
+    def header_for(self, url, now=None):
+        """The value of the Cookie header for a request to 'url', or None
+        when no cookie is to be sent."""
+        parsed = urlparse.urlparse(url)
+        host = (parsed.hostname or '').lower()
+        if not host:
+            return None
+        path = parsed.path or '/'
+        secure = parsed.scheme == 'https'
+        domain = registrable_domain(host)
+        if now is None:
+            now = time.time()
+
+        self._lock.acquire()
+        try:
+            self._prune(now)
+            bucket = self._domains.get(domain)
+            if not bucket:
+                return None
+            cached = self._headers.setdefault(domain, {})
+            key = (host, path, secure)
+            if key in cached:
+                return cached[key]
+
+            cookies = [cookie for cookie in bucket.values()
+                       if cookie.matches(host, path, secure)]
+            # longer paths first, then the oldest first, RFC 6265 5.4
+            cookies.sort(key=lambda cookie: (-len(cookie.path), cookie.serial))
+            value = '; '.join(['%s=%s' % (cookie.name, cookie.value)
+                               for cookie in cookies]) or None
+            if len(cached) >= MAX_CACHED_HEADERS:
+                cached.clear()
+            cached[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def cookies_for(self, url, now=None):
+        """A dict of the names and values of the cookies for 'url'"""
+        header = self.header_for(url, now)
+        if not header:
+            return {}
+        return dict([part.split('=', 1) for part in header.split('; ')])
+
+    def get_state(self):
+        """The cookies as a list of dicts, which restore() takes back"""
+        return [dict([(attribute, getattr(cookie, attribute))
+                      for attribute in COOKIE_ATTRIBUTES])
+                for cookie in self]
+
+    def restore(self, state, now=None):
+        """Adds the cookies of get_state() 'state' that have not expired"""
+        for attributes in state:
+            self.set_cookie(Cookie(**attributes), now)
+
+    def clear(self, domain=None):
+        """Forgets every cookie, or those of the site of 'domain'"""
+        self._lock.acquire()
+        try:
+            if domain is None:
+                self._domains.clear()
+                self._headers.clear()
+                self._expiry = []
+            else:
+                domain = registrable_domain(domain)
+                self._domains.pop(domain, None)
+                self._headers.pop(domain, None)
+        finally:
+            self._lock.release()
+
+    def _compact(self):
+        self._expiry = []
+        for domain, bucket in self._domains.items():
+            for key, cookie in bucket.items():
+                if cookie.expires is not None:
+                    self._expiry.append((cookie.expires, cookie._heap_serial,
+                                         domain, key))
+        heapq.heapify(self._expiry)
+        self._compact_at = max(MIN_HEAP_COMPACTION, 2 * len(self._expiry))
+
+    def _prune(self, now):
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            expires, serial, domain, key = heapq.heappop(expiry)
+            bucket = self._domains.get(domain)
+            cookie = bucket and bucket.get(key)
+            # the heap keeps entries of cookies replaced since
+            if cookie is None or cookie._heap_serial != serial:
+                continue
+            del bucket[key]
+            if not bucket:
+                del self._domains[domain]
+            self._headers.pop(domain, None)
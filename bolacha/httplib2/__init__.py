@@ -32,13 +32,12 @@ import sys
 try:
     from hashlib import md5
 except ImportError:
-    import md5
+    from md5 import new as md5
 
 import email
 import email.Utils
 import email.Message
 import StringIO
-import gzip
 import zlib
 import httplib
 import urlparse
@@ -48,19 +47,48 @@ import copy
 import calendar
 import time
 import random
+import threading
+import select
+import errno
+import mmap
+import struct
+from collections import OrderedDict, deque
 try:
     from hashlib import sha1 as sha
 except ImportError:
-    import sha
+    from sha import new as sha
 import hmac
 from gettext import gettext as _
 import socket
+import tempfile
 
 try:
     import socks
 except ImportError:
     socks = None
 
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Zero-copy uploads need sendfile(2), either from the pysendfile
+# package or, on newer Pythons, from the os module.
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = getattr(os, 'sendfile', None)
+
 if sys.version_info >= (2,3):
     from iri2uri import iri2uri
 else:
@@ -69,6 +97,10 @@ else:
 
 __all__ = ['Http', 'Response', 'ProxyInfo', 'HttpLib2Error',
   'RedirectMissingLocation', 'RedirectLimit', 'FailedToDecompressContent',
+  'DecompressedContentTooLarge', 'ContentDecoder',
+  'ConnectionPool', 'PoolExhaustedError', 'FileCache', 'ShardedFileCache',
+  'SqliteCache', 'MemoryCache',
+  'ResponseStream', 'RequestTimings', 'DNSCache', 'NormalizedURI', 'normalize_uri',
   'UnimplementedDigestAuthOptionError', 'UnimplementedHmacDigestAuthOptionError',
   'debuglevel']
 
@@ -106,11 +138,13 @@ class HttpLib2ErrorWithResponse(HttpLib2Error):
 class RedirectMissingLocation(HttpLib2ErrorWithResponse): pass
 class RedirectLimit(HttpLib2ErrorWithResponse): pass
 class FailedToDecompressContent(HttpLib2ErrorWithResponse): pass
+class DecompressedContentTooLarge(HttpLib2ErrorWithResponse): pass
 class UnimplementedDigestAuthOptionError(HttpLib2ErrorWithResponse): pass
 class UnimplementedHmacDigestAuthOptionError(HttpLib2ErrorWithResponse): pass
 
 class RelativeURIError(HttpLib2Error): pass
 class ServerNotFoundError(HttpLib2Error): pass
+class PoolExhaustedError(HttpLib2Error): pass
 
 # Open Items:
 # -----------
@@ -134,6 +168,44 @@ class ServerNotFoundError(HttpLib2Error): pass
 # requesting that URI again.
 DEFAULT_MAX_REDIRECTS = 5
 
+# How many keep-alive connections a single Http object keeps open
+# against the same scheme:authority.
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 10
+
+# How many requests Http.pipeline() writes ahead of the responses it
+# has read, on a connection, and the methods it pipelines
+DEFAULT_PIPELINE_DEPTH = 8
+PIPELINE_METHODS = ('GET', 'HEAD')
+
+# How many URIs normalize_uri() remembers, at most
+URI_CACHE_SIZE = 1024
+
+# How many bytes a ResponseStream yields at a time when iterated
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# How long DNSCache keeps resolved addresses, and failures to resolve,
+# in seconds, and how many hosts it remembers
+DEFAULT_DNS_TTL = 300
+DEFAULT_DNS_NEGATIVE_TTL = 5
+DEFAULT_DNS_CACHE_SIZE = 1024
+
+# How many bytes of responses a MemoryCache holds by default
+DEFAULT_MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
+# Levels of subdirectories a ShardedFileCache spreads its entries over,
+# each of them 256 wide
+DEFAULT_CACHE_LEVELS = 2
+
+# Temporary files of file caches this old, in seconds, were left behind
+# by interrupted writes, and FileCache.sweep() deletes them
+CACHE_TEMPORARY_FILE_AGE = 3600
+
+# A SqliteCache records reads of an entry at most this often, in
+# seconds, and when it is over its budget it evicts down to this
+# fraction of it
+SQLITE_CACHE_ACCESS_RESOLUTION = 60
+SQLITE_CACHE_LOW_WATER = 0.9
+
 # Which headers are hop-by-hop headers by default
 HOP_BY_HOP = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers', 'transfer-encoding', 'upgrade']
 
@@ -154,6 +226,10 @@ def parse_uri(uri):
 
 def urlnorm(uri):
     (scheme, authority, path, query, fragment) = parse_uri(uri)
+    return _urlnorm_parts(uri, scheme, authority, path, query)
+
+def _urlnorm_parts(uri, scheme, authority, path, query):
+    """urlnorm() of 'uri', from the parts parse_uri() took it apart into"""
     if not scheme or not authority:
         raise RelativeURIError("Only absolute URIs are allowed. uri = %s" % uri)
     authority = authority.lower()
@@ -163,10 +239,66 @@ def urlnorm(uri):
     # Could do syntax based normalization of the URI before
     # computing the digest. See Section 6.2.2 of Std 66.
     request_uri = query and "?".join([path, query]) or path
-    scheme = scheme.lower()
     defrag_uri = scheme + "://" + authority + request_uri
     return scheme, authority, request_uri, defrag_uri
 
+class NormalizedURI(object):
+    """An absolute URI, converted from an IRI if need be and taken apart
+    once, so that the steps of a request don't parse it again. Made by
+    normalize_uri(), and shared between threads: don't change it."""
+    __slots__ = ('uri', 'scheme', 'authority', 'path', 'query',
+                 'request_uri', 'defrag_uri')
+
+    def __init__(self, uri):
+        self.uri = iri2uri(uri)
+        (scheme, authority, path, query, fragment) = parse_uri(self.uri)
+        (self.scheme, self.authority, self.request_uri, self.defrag_uri) = \
+            _urlnorm_parts(self.uri, scheme, authority, path, query)
+        self.path = path or "/"
+        self.query = query
+
+    def __repr__(self):
+        return '<NormalizedURI %s>' % self.uri
+
+# URIs normalized lately, and before that. Together they make up an
+# approximate LRU: a URI of the older generation that is used again is
+# moved to the recent one, and when the recent one is full the older
+# one, with all that wasn't used meanwhile, is dropped. Hits take no lock.
+# They are keyed by (type, uri): u'x' == 'x', but a str URI must not get
+# the unicode parts of a NormalizedURI made from a unicode one.
+_recent_uris = {}
+_older_uris = {}
+_normalized_uris_lock = threading.Lock()
+
+def normalize_uri(uri):
+    """The NormalizedURI of 'uri', from a cache of about URI_CACHE_SIZE
+    of the last used ones. Raises RelativeURIError for relative URIs."""
+    key = (type(uri), uri)
+    normalized = _recent_uris.get(key)
+    if normalized is None:
+        normalized = _older_uris.get(key)
+        if normalized is None:
+            normalized = NormalizedURI(uri)
+        _remember_uri(key, normalized)
+    return normalized
+
+def _remember_uri(key, normalized):
+    global _recent_uris, _older_uris
+    _normalized_uris_lock.acquire()
+    try:
+        if len(_recent_uris) >= URI_CACHE_SIZE / 2:
+            _older_uris = _recent_uris
+            _recent_uris = {}
+        _recent_uris[key] = normalized
+    finally:
+        _normalized_uris_lock.release()
+
+def _request_path(request_uri):
+    """The path of 'request_uri', a string or a NormalizedURI"""
+    if isinstance(request_uri, NormalizedURI):
+        return request_uri.path
+    return parse_uri(request_uri)[2]
+
 
 # Cache filename construction (original borrowed from Venus http://intertwingly.net/code/venus/)
 re_url_scheme    = re.compile(r'^\w+://')
@@ -190,7 +322,7 @@ def safename(filename):
         pass
     if isinstance(filename,unicode):
         filename=filename.encode('utf-8')
-    filemd5 = md5.new(filename).hexdigest()
+    filemd5 = md5(filename).hexdigest()
     filename = re_url_scheme.sub("", filename)
     filename = re_slash.sub(",", filename)
 
@@ -200,6 +332,7 @@ def safename(filename):
     return ",".join((filename, filemd5))
 
 NORMALIZE_SPACE = re.compile(r'(?:\r\n)?[ \t]+')
+NEWLINES = re.compile(r'\r\n|\r|\n')
 def _normalize_headers(headers):
     return dict([ (key.lower(), NORMALIZE_SPACE.sub(value, ' ').strip())  for (key, value) in headers.iteritems()])
 
@@ -253,6 +386,61 @@ def _parse_www_authenticate(headers, headername='www-authenticate'):
     return retval
 
 
+def _freshness_lifetime(response_headers, cc_response, date):
+    """For how many seconds after 'date' the server said a response
+    stays fresh"""
+    if cc_response.has_key('max-age'):
+        try:
+            return int(cc_response['max-age'])
+        except ValueError:
+            return 0
+    elif response_headers.has_key('expires'):
+        expires = email.Utils.parsedate_tz(response_headers['expires'])
+        if None == expires:
+            return 0
+        return max(0, calendar.timegm(expires) - date)
+    return 0
+
+def _entry_expiry(response_headers, stored_at):
+    """When a cached response stops being fresh, as a timestamp. Those
+    that must be revalidated expire as soon as they are stored."""
+    cc_response = _parse_cache_control(response_headers)
+    if cc_response.has_key('no-cache') or not response_headers.has_key('date'):
+        return stored_at
+    try:
+        date = calendar.timegm(email.Utils.parsedate_tz(response_headers['date']))
+    except (TypeError, ValueError):
+        return stored_at
+    return max(stored_at, date + _freshness_lifetime(response_headers, cc_response, date))
+
+def _entry_staleness(response_headers, request_headers):
+    """For how many seconds a cached response has been stale, or None
+    if it may only be served once it has been revalidated: when the
+    server or the request says so, or its age isn't known."""
+    cc = _parse_cache_control(request_headers)
+    cc_response = _parse_cache_control(response_headers)
+    for directive in ('no-cache', 'must-revalidate', 'proxy-revalidate'):
+        if cc_response.has_key(directive):
+            return None
+    if cc.has_key('max-age') or cc.has_key('min-fresh') or not response_headers.has_key('date'):
+        return None
+    try:
+        date = calendar.timegm(email.Utils.parsedate_tz(response_headers['date']))
+    except (TypeError, ValueError):
+        return None
+    return time.time() - date - _freshness_lifetime(response_headers, cc_response, date)
+
+def _stale_window(response_headers, directive, override):
+    """For how many seconds a stale response may still be served, as
+    the RFC 5861 'directive' of the response says, or the client's
+    'override' if it has one"""
+    if override is not None:
+        return override
+    try:
+        return int(_parse_cache_control(response_headers).get(directive, 0))
+    except ValueError:
+        return 0
+
 def _entry_disposition(response_headers, request_headers):
     """Determine freshness from the Date, Expires and Cache-Control headers.
 
@@ -299,19 +487,7 @@ def _entry_disposition(response_headers, request_headers):
         date = calendar.timegm(email.Utils.parsedate_tz(response_headers['date']))
         now = time.time()
         current_age = max(0, now - date)
-        if cc_response.has_key('max-age'):
-            try:
-                freshness_lifetime = int(cc_response['max-age'])
-            except ValueError:
-                freshness_lifetime = 0
-        elif response_headers.has_key('expires'):
-            expires = email.Utils.parsedate_tz(response_headers['expires'])
-            if None == expires:
-                freshness_lifetime = 0
-            else:
-                freshness_lifetime = max(0, calendar.timegm(expires) - date)
-        else:
-            freshness_lifetime = 0
+        freshness_lifetime = _freshness_lifetime(response_headers, cc_response, date)
         if cc.has_key('max-age'):
             try:
                 freshness_lifetime = int(cc['max-age'])
@@ -327,22 +503,162 @@ def _entry_disposition(response_headers, request_headers):
             retval = "FRESH"
     return retval
 
-def _decompressContent(response, new_content):
-    content = new_content
-    try:
-        encoding = response.get('content-encoding', None)
-        if encoding in ['gzip', 'deflate']:
-            if encoding == 'gzip':
-                content = gzip.GzipFile(fileobj=StringIO.StringIO(new_content)).read()
-            if encoding == 'deflate':
-                content = zlib.decompress(content)
-            response['content-length'] = str(len(content))
-            del response['content-encoding']
-    except IOError:
-        content = ""
-        raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % response.get('content-encoding'), response, content)
+class ContentDecoder(object):
+    """Decompresses a gzip or deflate response body a chunk at a time.
+
+    Gives up with DecompressedContentTooLarge once more than 'max_size'
+    bytes come out, which protects against decompression bombs, and
+    records the compressed and decompressed byte counts on the response.
+    """
+    def __init__(self, response, max_size=None):
+        self.response = response
+        self.max_size = max_size
+        self.encoding = response['content-encoding']
+        self.compressed_length = 0
+        self.decompressed_length = 0
+        # seconds spent decompressing
+        self.elapsed = 0.0
+        if self.encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        # The body the caller sees is not encoded anymore
+        del response['content-encoding']
+        if response.has_key('content-length'):
+            del response['content-length']
+
+    def _fail(self):
+        raise FailedToDecompressContent(_("Content purported to be compressed with %s but failed to decompress.") % self.encoding, self.response, "")
+
+    def _check_size(self, content):
+        self.decompressed_length += len(content)
+        if self.max_size is not None and self.decompressed_length > self.max_size:
+            raise DecompressedContentTooLarge(_("Content decompressed to more than %d bytes.") % self.max_size, self.response, "")
+        return content
+
+    def decompress(self, data):
+        started = time.time()
+        try:
+            return self._decompress(data)
+        finally:
+            self.elapsed += time.time() - started
+
+    def _decompress(self, data):
+        self.compressed_length += len(data)
+        limit = self.max_size is not None and self.max_size - self.decompressed_length + 1 or 0
+        try:
+            try:
+                content = self._decompressor.decompress(data, limit)
+            except zlib.error:
+                if self.encoding != 'deflate' or self.compressed_length != len(data):
+                    raise
+                # Some servers send raw deflate streams, without the zlib header
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                content = self._decompressor.decompress(data, limit)
+        except zlib.error:
+            self._fail()
+        return self._check_size(content)
+
+    def flush(self):
+        started = time.time()
+        try:
+            return self._flush()
+        finally:
+            self.elapsed += time.time() - started
+
+    def _flush(self):
+        try:
+            content = self._check_size(self._decompressor.flush())
+        except zlib.error:
+            self._fail()
+        self.response['content-length'] = str(self.decompressed_length)
+        self.response.compressed_length = self.compressed_length
+        self.response.decompressed_length = self.decompressed_length
+        return content
+
+def _content_decoder(response, max_size=None):
+    if response.get('content-encoding', None) in ['gzip', 'deflate']:
+        return ContentDecoder(response, max_size)
+    return None
+
+def _decompressContent(response, new_content, max_size=None):
+    decoder = _content_decoder(response, max_size)
+    if decoder is None:
+        return new_content
+    return decoder.decompress(new_content) + decoder.flush()
+
+def _read_content(response, fp, max_size=None, timings=None):
+    """Reads a whole body off an httplib response, decompressing it as it
+    arrives so that the compressed body is never held all at once."""
+    started = time.time()
+    decoder = _content_decoder(response, max_size)
+    if decoder is None:
+        content = fp.read()
+    else:
+        chunks = []
+        while True:
+            data = fp.read(RESPONSE_CHUNK_SIZE)
+            if not data:
+                break
+            chunks.append(decoder.decompress(data))
+        chunks.append(decoder.flush())
+        content = "".join(chunks)
+    if timings is not None:
+        elapsed = time.time() - started
+        if decoder is not None:
+            timings.decompress += decoder.elapsed
+            elapsed -= decoder.elapsed
+        timings.transfer += elapsed
+    return content
+
+def _buffered(content):
+    """Reads a streamed body to the end, which also hands its connection
+    back to the pool, and returns it as a string."""
+    if isinstance(content, ResponseStream):
+        return content.read()
     return content
 
+# Cache entries start with this marker, a 4 byte big-endian length and
+# a block of "key: value\r\n" header lines, then the body follows as-is.
+# Entries written by older versions were RFC 822 messages, which always
+# start with "status:", so the two can't be mistaken for each other.
+CACHE_ENTRY_MAGIC = "\x00hc1"
+CACHE_ENTRY_HEADER = struct.Struct("!4sI")
+
+def _encode_cache_metadata(status, headers):
+    """The header part of a cache entry, which its body follows"""
+    lines = ["status: %d\r\n" % status]
+    for key, value in headers:
+        lines.append("%s: %s\r\n" % (key, NEWLINES.sub(" ", str(value))))
+    header_block = "".join(lines)
+    return CACHE_ENTRY_HEADER.pack(CACHE_ENTRY_MAGIC, len(header_block)) + header_block
+
+def _encode_cache_entry(status, headers, content):
+    if isinstance(content, buffer):
+        # a memory mapped body, from FileCache
+        content = str(content)
+    return _encode_cache_metadata(status, headers) + content
+
+def _decode_cache_entry(value):
+    """Returns the (info, content) stored in a cache entry, where info is
+    a dict of lowercase header names. Raises ValueError if the entry is
+    damaged."""
+    if value.startswith(CACHE_ENTRY_MAGIC):
+        (magic, length) = CACHE_ENTRY_HEADER.unpack_from(value)
+        end = CACHE_ENTRY_HEADER.size + length
+        if end > len(value):
+            raise ValueError("truncated cache entry")
+        lines = value[CACHE_ENTRY_HEADER.size:end].split("\r\n")
+        info = dict([line.split(": ", 1) for line in lines if line])
+        return info, value[end:]
+
+    # An entry in the old email.Message format
+    parts = value.split('\r\n\r\n', 1)
+    if len(parts) != 2:
+        raise ValueError("damaged cache entry")
+    info = email.message_from_string(value)
+    return dict([(key.lower(), header) for key, header in info.items()]), parts[1]
+
 def _updateCache(request_headers, response_headers, content, cache, cachekey):
     if cachekey:
         cc = _parse_cache_control(request_headers)
@@ -350,30 +666,71 @@ def _updateCache(request_headers, response_headers, content, cache, cachekey):
         if cc.has_key('no-store') or cc_response.has_key('no-store'):
             cache.delete(cachekey)
         else:
-            info = email.Message.Message()
-            for key, value in response_headers.iteritems():
-                if key not in ['status','content-encoding','transfer-encoding']:
-                    info[key] = value
+            headers = [(key, value) for key, value in response_headers.iteritems()
+                       if key not in ['status','content-encoding','transfer-encoding']]
 
             status = response_headers.status
             if status == 304:
                 status = 200
 
-            status_header = 'status: %d\r\n' % response_headers.status
-
-            header_str = info.as_string()
-
-            header_str = re.sub("\r(?!\n)|(?<!\r)\n", "\r\n", header_str)
-            text = "".join([status_header, header_str, content])
+            if hasattr(cache, 'set_parts'):
+                # a memory mapped body goes to the file as it is
+                cache.set_parts(cachekey, [_encode_cache_metadata(status, headers), content])
+            else:
+                cache.set(cachekey, _encode_cache_entry(status, headers, content))
+
+def _cache_lookup(cache, cachekey):
+    """Returns what the cache holds for 'cachekey', or None: only the
+    header part of the entry from caches that can read it alone, with
+    get_metadata(), and the whole entry from the others."""
+    if hasattr(cache, 'get_metadata'):
+        return cache.get_metadata(cachekey)
+    return cache.get(cachekey)
+
+def _cache_body(cache, cachekey, cached_value, content):
+    """The body of the entry _cache_lookup() returned as 'cached_value',
+    which decoded to 'content'. None if the entry has been replaced or
+    removed since it was looked up."""
+    if hasattr(cache, 'get_metadata'):
+        return cache.get_body(cachekey, cached_value)
+    return content
 
-            cache.set(cachekey, text)
+def _read_cache_metadata(f):
+    """Reads the header part of the cache entry in file 'f', leaving
+    'f' at the start of the body"""
+    start = f.read(CACHE_ENTRY_HEADER.size)
+    if start.startswith(CACHE_ENTRY_MAGIC) and len(start) == CACHE_ENTRY_HEADER.size:
+        (magic, length) = CACHE_ENTRY_HEADER.unpack(start)
+        return start + f.read(length)
+    # An entry in the old email.Message format ends its headers with a
+    # blank line
+    value = start + f.read()
+    end = value.find('\r\n\r\n')
+    end = end == -1 and len(value) or end + 4
+    f.seek(end)
+    return value[:end]
+
+def _mergeCache(request_headers, response_headers, content, cache, cachekey, cached_value):
+    """Stores the entry a 304 revalidated. Caches that can lock an
+    entry are locked meanwhile, and the entry is left alone if another
+    thread or process replaced it since 'cached_value' was read."""
+    lock = getattr(cache, 'lock', None)
+    held = lock is not None and lock(cachekey)
+    if not held:
+        _updateCache(request_headers, response_headers, content, cache, cachekey)
+        return
+    try:
+        if _cache_lookup(cache, cachekey) == cached_value:
+            _updateCache(request_headers, response_headers, content, cache, cachekey)
+    finally:
+        held.release()
 
 def _cnonce():
-    dig = md5.new("%s:%s" % (time.ctime(), ["0123456789"[random.randrange(0, 9)] for i in range(20)])).hexdigest()
+    dig = md5("%s:%s" % (time.ctime(), ["0123456789"[random.randrange(0, 9)] for i in range(20)])).hexdigest()
     return dig[:16]
 
 def _wsse_username_token(cnonce, iso_now, password):
-    return base64.encodestring(sha.new("%s%s%s" % (cnonce, iso_now, password)).digest()).strip()
+    return base64.encodestring(sha("%s%s%s" % (cnonce, iso_now, password)).digest()).strip()
 
 
 # For credentials we need two things, first
@@ -385,21 +742,49 @@ def _wsse_username_token(cnonce, iso_now, password):
 # how close to the 'top' it is.
 
 class Authentication(object):
+    # What get_state() saves besides the host, path and user name
+    state_attributes = ()
+
     def __init__(self, credentials, host, request_uri, headers, response, content, http):
-        (scheme, authority, path, query, fragment) = parse_uri(request_uri)
-        self.path = path
+        self.path = _request_path(request_uri)
         self.host = host
         self.credentials = credentials
         self.http = http
 
+    def get_state(self):
+        """A dict of what it takes to use this authorization again,
+        in another process, without a new challenge. The password is
+        not part of it."""
+        state = {'host': self.host, 'path': self.path,
+                 'name': self.credentials[0]}
+        for attribute in self.state_attributes:
+            state[attribute] = getattr(self, attribute)
+        return state
+
+    @classmethod
+    def from_state(cls, state, credentials, http):
+        """The authorization of get_state() 'state', using 'credentials'"""
+        authorization = cls.__new__(cls)
+        authorization.host = state['host']
+        authorization.path = state['path']
+        authorization.credentials = credentials
+        authorization.http = http
+        for attribute in cls.state_attributes:
+            setattr(authorization, attribute, copy.deepcopy(state[attribute]))
+        authorization._prepare_key()
+        return authorization
+
+    def _prepare_key(self):
+        """Derives what the credentials and state make up"""
+        pass
+
     def depth(self, request_uri):
-        (scheme, authority, path, query, fragment) = parse_uri(request_uri)
+        if isinstance(request_uri, NormalizedURI):
+            request_uri = request_uri.request_uri
         return request_uri[len(self.path):].count("/")
 
     def inscope(self, host, request_uri):
-        # XXX Should we normalize the request_uri?
-        (scheme, authority, path, query, fragment) = parse_uri(request_uri)
-        return (host == self.host) and path.startswith(self.path)
+        return (host == self.host) and _request_path(request_uri).startswith(self.path)
 
     def request(self, method, request_uri, headers, content):
         """Modify the request headers to add the appropriate
@@ -431,6 +816,8 @@ class BasicAuthentication(Authentication):
 class DigestAuthentication(Authentication):
     """Only do qop='auth' and MD5, since that
     is all Apache currently implements"""
+    state_attributes = ('challenge',)
+
     def __init__(self, credentials, host, request_uri, headers, response, content, http):
         Authentication.__init__(self, credentials, host, request_uri, headers, response, content, http)
         challenge = _parse_www_authenticate(response, 'www-authenticate')
@@ -442,12 +829,15 @@ class DigestAuthentication(Authentication):
         self.challenge['algorithm'] = self.challenge.get('algorithm', 'MD5')
         if self.challenge['algorithm'] != 'MD5':
             raise UnimplementedDigestAuthOptionError( _("Unsupported value for algorithm: %s." % self.challenge['algorithm']))
-        self.A1 = "".join([self.credentials[0], ":", self.challenge['realm'], ":", self.credentials[1]])
+        self._prepare_key()
         self.challenge['nc'] = 1
 
+    def _prepare_key(self):
+        self.A1 = "".join([self.credentials[0], ":", self.challenge['realm'], ":", self.credentials[1]])
+
     def request(self, method, request_uri, headers, content, cnonce = None):
         """Modify the request headers"""
-        H = lambda x: md5.new(x).hexdigest()
+        H = lambda x: md5(x).hexdigest()
         KD = lambda s, d: H("%s:%s" % (s, d))
         A2 = "".join([method, ":", request_uri])
         self.challenge['cnonce'] = cnonce or _cnonce()
@@ -488,6 +878,7 @@ class DigestAuthentication(Authentication):
 class HmacDigestAuthentication(Authentication):
     """Adapted from Robert Sayre's code and DigestAuthentication above."""
     __author__ = "Thomas Broyer (t.broyer@ltgt.net)"
+    state_attributes = ('challenge',)
 
     def __init__(self, credentials, host, request_uri, headers, response, content, http):
         Authentication.__init__(self, credentials, host, request_uri, headers, response, content, http)
@@ -506,6 +897,9 @@ class HmacDigestAuthentication(Authentication):
         self.challenge['pw-algorithm'] = self.challenge.get('pw-algorithm', 'SHA-1')
         if self.challenge['pw-algorithm'] not in ['SHA-1', 'MD5']:
             raise UnimplementedHmacDigestAuthOptionError( _("Unsupported value for pw-algorithm: %s." % self.challenge['pw-algorithm']))
+        self._prepare_key()
+
+    def _prepare_key(self):
         if self.challenge['algorithm'] == 'HMAC-MD5':
             self.hashmod = md5
         else:
@@ -515,10 +909,10 @@ class HmacDigestAuthentication(Authentication):
         else:
             self.pwhashmod = sha
         self.key = "".join([self.credentials[0], ":",
-                    self.pwhashmod.new("".join([self.credentials[1], self.challenge['salt']])).hexdigest().lower(),
+                    self.pwhashmod("".join([self.credentials[1], self.challenge['salt']])).hexdigest().lower(),
                     ":", self.challenge['realm']
                     ])
-        self.key = self.pwhashmod.new(self.key).hexdigest().lower()
+        self.key = self.pwhashmod(self.key).hexdigest().lower()
 
     def request(self, method, request_uri, headers, content):
         """Modify the request headers"""
@@ -572,6 +966,8 @@ class WsseAuthentication(Authentication):
                 iso_now)
 
 class GoogleLoginAuthentication(Authentication):
+    state_attributes = ('Auth',)
+
     def __init__(self, credentials, host, request_uri, headers, response, content, http):
         from urllib import urlencode
         Authentication.__init__(self, credentials, host, request_uri, headers, response, content, http)
@@ -613,38 +1009,456 @@ AUTH_SCHEME_ORDER = ["hmacdigest", "googlelogin", "digest", "wsse", "basic"]
 def _md5(s):
     return
 
+def _makedirs(directory):
+    """os.makedirs, that doesn't mind another process getting there first"""
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+
+# Cache files are written to temporary files first, which mkstemp()
+# makes readable by their owner only. They are given the mode open()
+# would have created them with instead, so that other users can share
+# the cache.
+_umask = os.umask(0)
+os.umask(_umask)
+CACHE_FILE_MODE = 0666 & ~_umask
+CACHE_TEMPORARY_PREFIX = '.tmp-'
+
 class FileCache(object):
     """Uses a local directory as a store for cached files.
-    Not really safe to use if multiple threads or processes are going to
-    be running on the same cache.
+
+    Entries are replaced atomically, so readers never see half of one,
+    but a 304 merged into an entry may undo what another process stored
+    meanwhile; ShardedFileCache locks against that.
+
+    With 'mmap_threshold', bodies of at least that many bytes are given
+    back as a read-only buffer over a memory map of the cache file,
+    which can be written to a socket or a file without being copied.
     """
-    def __init__(self, cache, safe=safename): # use safe=lambda x: md5.new(x).hexdigest() for the old behavior
+    def __init__(self, cache, safe=safename, mmap_threshold=None): # use safe=lambda x: md5(x).hexdigest() for the old behavior
         self.cache = cache
         self.safe = safe
+        self.mmap_threshold = mmap_threshold
         if not os.path.exists(cache):
             os.makedirs(self.cache)
 
+    def _path(self, key):
+        return os.path.join(self.cache, self.safe(key))
+
     def get(self, key):
         retval = None
-        cacheFullPath = os.path.join(self.cache, self.safe(key))
+        cacheFullPath = self._path(key)
         try:
-            f = file(cacheFullPath, "r")
+            f = file(cacheFullPath, "rb")
             retval = f.read()
             f.close()
         except IOError:
             pass
         return retval
 
+    def get_metadata(self, key):
+        """Reads the header part of the entry for 'key' and not its
+        body, or returns None if there is no such entry"""
+        try:
+            f = file(self._path(key), "rb")
+        except IOError:
+            return None
+        try:
+            return _read_cache_metadata(f)
+        finally:
+            f.close()
+
+    def get_body(self, key, metadata):
+        """Reads the body of the entry for 'key', if its header part is
+        still 'metadata', or returns None"""
+        try:
+            f = file(self._path(key), "rb")
+        except IOError:
+            return None
+        try:
+            if _read_cache_metadata(f) != metadata:
+                return None
+            if self.mmap_threshold is not None:
+                length = os.fstat(f.fileno()).st_size - len(metadata)
+                if length > 0 and length >= self.mmap_threshold:
+                    # entries are replaced by renames, so the mapped file
+                    # stays as it is for as long as the buffer lives
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    return buffer(mapped, len(metadata))
+            return f.read()
+        finally:
+            f.close()
+
+    def set(self, key, value):
+        self.set_parts(key, [value])
+
+    def set_parts(self, key, parts):
+        """Stores the strings or buffers in 'parts', one after the other,
+        as the entry for 'key', without joining them first"""
+        cacheFullPath = self._path(key)
+        directory = os.path.dirname(cacheFullPath)
+        _makedirs(directory)
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=CACHE_TEMPORARY_PREFIX)
+        try:
+            f = os.fdopen(descriptor, "wb")
+            try:
+                for part in parts:
+                    f.write(part)
+            finally:
+                f.close()
+            os.chmod(temporary, CACHE_FILE_MODE)
+            os.rename(temporary, cacheFullPath)
+        except:
+            os.unlink(temporary)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def sweep(self, max_age=CACHE_TEMPORARY_FILE_AGE, now=None):
+        """Deletes the temporary files that interrupted writes left
+        behind, once they are 'max_age' seconds old, so that writes
+        still going on are left alone. Returns how many were deleted."""
+        if now is None:
+            now = time.time()
+        count = 0
+        for directory, subdirectories, names in os.walk(self.cache):
+            for name in names:
+                if not name.startswith(CACHE_TEMPORARY_PREFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) <= now - max_age:
+                        os.remove(path)
+                        count += 1
+                except OSError, e:
+                    # another process swept it, or the write finished
+                    if e.errno != errno.ENOENT:
+                        raise
+        return count
+
+class _CacheLock(object):
+    """An exclusive fcntl lock on 'path', held until release()"""
+    def __init__(self, path):
+        self.descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(self.descriptor, fcntl.LOCK_EX)
+        except:
+            os.close(self.descriptor)
+            raise
+
+    def release(self):
+        if self.descriptor is not None:
+            fcntl.flock(self.descriptor, fcntl.LOCK_UN)
+            os.close(self.descriptor)
+            self.descriptor = None
+
+class ShardedFileCache(FileCache):
+    """Uses a local directory as a store for cached files, and unlike
+    FileCache is safe to share between threads and processes.
+
+    Entries are spread over 'levels' levels of subdirectories, named
+    after the md5 of their key, so that no directory holds too many
+    files. Like with FileCache, they are replaced atomically and large
+    bodies can be memory mapped with 'mmap_threshold'.
+
+    Where the platform has fcntl, and unless 'locking' is False, lock()
+    takes an exclusive lock on the subdirectory of a key; Http holds it
+    while it merges a 304 response into the cached entry.
+    """
+    def __init__(self, cache, levels=DEFAULT_CACHE_LEVELS, locking=True, mmap_threshold=None):
+        self.cache = cache
+        self.levels = levels
+        self.mmap_threshold = mmap_threshold
+        self.locking = locking and fcntl is not None
+        _makedirs(cache)
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        name = md5(key).hexdigest()
+        shards = [name[level * 2:level * 2 + 2] for level in range(self.levels)]
+        return os.path.join(self.cache, *(shards + [name]))
+
+    def lock(self, key):
+        """Locks the entry for 'key' against other threads and
+        processes, and returns the lock, or None if this cache does not
+        lock. Call release() on it when done."""
+        if not self.locking:
+            return None
+        directory = os.path.dirname(self._path(key))
+        _makedirs(directory)
+        return _CacheLock(os.path.join(directory, '.lock'))
+
+SQLITE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    headers BLOB NOT NULL,
+    body BLOB NOT NULL,
+    stored_at REAL NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0, 0);
+
+CREATE TRIGGER IF NOT EXISTS entries_inserted AFTER INSERT ON entries BEGIN
+    UPDATE totals SET entries = entries + 1, size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_updated AFTER UPDATE OF size ON entries BEGIN
+    UPDATE totals SET size = size - old.size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_deleted AFTER DELETE ON entries BEGIN
+    UPDATE totals SET entries = entries - 1, size = size - old.size;
+END;
+"""
+
+class SqliteCache(object):
+    """Keeps cached responses in a single SQLite database, instead of a
+    file per response.
+
+    Every entry is stored with when it expires and when it was last
+    read, so evict() can make room cheaply: expired entries go first,
+    then the least recently used ones. If 'max_bytes' is given, set()
+    evicts down to a little under it whenever the cache grows past it.
+
+    The database is in WAL mode, so readers don't wait for writers.
+    Each thread, and each process, uses a connection of its own, so
+    one SqliteCache can be shared by threads and many processes can
+    use the same database file.
+    """
+    def __init__(self, path, max_bytes=None, timeout=30):
+        if sqlite3 is None:
+            raise ImportError("SqliteCache needs the sqlite3 module")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            # connections can't be carried over a fork
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.text_factory = str
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SQLITE_CACHE_SCHEMA)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def close(self):
+        """Closes the connection of the calling thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection.close()
+
+    def __len__(self):
+        return self._connection().execute("SELECT entries FROM totals").fetchone()[0]
+
+    @property
+    def size(self):
+        """How many bytes the entries take"""
+        return self._connection().execute("SELECT size FROM totals").fetchone()[0]
+
+    def _touch(self, connection, key, accessed):
+        now = time.time()
+        if now - accessed >= SQLITE_CACHE_ACCESS_RESOLUTION:
+            # a read must not wait for 'timeout' behind a writer just
+            # to record when it happened
+            connection.execute("PRAGMA busy_timeout = 0")
+            try:
+                connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            except sqlite3.OperationalError:
+                # the database is busy, being a little less recent is fine
+                pass
+            finally:
+                connection.execute("PRAGMA busy_timeout = %d" % (self.timeout * 1000))
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute("SELECT headers, body, accessed FROM entries WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        headers, body, accessed = row
+        self._touch(connection, key, accessed)
+        return str(headers) + str(body)
+
+    def get_metadata(self, key):
+        """The header part of the entry for 'key', without its body, or
+        None if there is no such entry"""
+        connection = self._connection()
+        row = connection.execute("SELECT headers, accessed FROM entries WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        headers, accessed = row
+        self._touch(connection, key, accessed)
+        return str(headers)
+
+    def get_body(self, key, metadata):
+        """The body of the entry for 'key', if its header part is still
+        'metadata', or None"""
+        row = self._connection().execute("SELECT body FROM entries WHERE key = ? AND headers = ?",
+                                         (key, buffer(metadata))).fetchone()
+        return row and str(row[0])
+
     def set(self, key, value):
-        cacheFullPath = os.path.join(self.cache, self.safe(key))
-        f = file(cacheFullPath, "w")
-        f.write(value)
-        f.close()
+        now = time.time()
+        try:
+            (info, content) = _decode_cache_entry(value)
+            expires = _entry_expiry(info, now)
+        except (ValueError, struct.error):
+            (content, expires) = ("", now)
+        headers = value[:len(value) - len(content)]
+        row = (buffer(headers), buffer(content), now, expires, now, len(value), key)
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.execute(
+                "UPDATE entries SET headers = ?, body = ?, stored_at = ?, expires = ?,"
+                " accessed = ?, size = ? WHERE key = ?", row)
+            if cursor.rowcount == 0:
+                connection.execute(
+                    "INSERT INTO entries (headers, body, stored_at, expires, accessed, size, key)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * SQLITE_CACHE_LOW_WATER), now)
 
     def delete(self, key):
-        cacheFullPath = os.path.join(self.cache, self.safe(key))
-        if os.path.exists(cacheFullPath):
-            os.remove(cacheFullPath)
+        self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM entries")
+
+    def evict(self, max_bytes=None, now=None):
+        """Deletes entries until the cache holds at most 'max_bytes':
+        expired ones first, those that expired longest ago before the
+        others, then the least recently used ones. Without 'max_bytes'
+        every expired entry is deleted. Returns how many were."""
+        if now is None:
+            now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if max_bytes is None:
+                count = connection.execute("DELETE FROM entries WHERE expires <= ?",
+                                           (now,)).rowcount
+            else:
+                excess = connection.execute("SELECT size FROM totals").fetchone()[0] - max_bytes
+                victims = set()
+                queries = [("SELECT key, size FROM entries WHERE expires <= ? ORDER BY expires", (now,)),
+                           ("SELECT key, size FROM entries ORDER BY accessed", ())]
+                for query, parameters in queries:
+                    if excess <= 0:
+                        break
+                    for key, size in connection.execute(query, parameters):
+                        if key not in victims:
+                            victims.add(key)
+                            excess -= size
+                            if excess <= 0:
+                                break
+                connection.executemany("DELETE FROM entries WHERE key = ?",
+                                       [(key,) for key in victims])
+                count = len(victims)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return count
+
+class MemoryCache(object):
+    """Keeps cached responses in memory, within this process.
+
+    The cache holds at most 'max_bytes' bytes of entries and, if given,
+    at most 'max_entries' of them. When it is full the least recently
+    used entry is evicted, or the least frequently used one (ties broken
+    by recency) with policy='lfu'. Safe to share between threads.
+    """
+    def __init__(self, max_bytes=DEFAULT_MEMORY_CACHE_SIZE, max_entries=None, policy='lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("policy must be 'lru' or 'lfu', got %r" % policy)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self.size = 0
+        self._entries = OrderedDict()
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key))
+        del self._hits[key]
+
+    def _evict(self):
+        if self.policy == 'lfu':
+            key = min(self._entries, key=self._hits.__getitem__)
+        else:
+            key = iter(self._entries).next()
+        self._remove(key)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            retval = self._entries.pop(key, None)
+            if retval is not None:
+                self._entries[key] = retval
+                self._hits[key] += 1
+            return retval
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            if len(value) > self.max_bytes:
+                return
+            while self._entries and (self.size + len(value) > self.max_bytes or
+                    (self.max_entries is not None and len(self._entries) >= self.max_entries)):
+                self._evict()
+            self._entries[key] = value
+            self._hits[key] = 1
+            self.size += len(value)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+        finally:
+            self._lock.release()
 
 class Credentials(object):
     def __init__(self):
@@ -685,71 +1499,662 @@ p = ProxyInfo(proxy_type=socks.PROXY_TYPE_HTTP, proxy_host='localhost', proxy_po
     return socks and (self.proxy_host != None) and (self.proxy_port != None)
 
 
+class DNSCache(object):
+    """A thread-safe cache of socket.getaddrinfo() results, used by the
+    connections of an Http object so that a host name is not resolved
+    again on every connect.
+
+    Addresses are kept for 'ttl' seconds, and failures to resolve for
+    'negative_ttl' seconds, so a host that does not exist does not cost
+    a lookup per request either. A 'ttl' of 0 turns caching off. At most
+    'max_entries' results are kept.
+
+    add_override() pins a host name to given addresses, much like an
+    /etc/hosts entry that only this client sees. stats() tells how many
+    lookups were answered from the cache.
+    """
+    def __init__(self, ttl=DEFAULT_DNS_TTL, negative_ttl=DEFAULT_DNS_NEGATIVE_TTL,
+                 max_entries=DEFAULT_DNS_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._entries = {}
+        self._overrides = {}
+        self._lock = threading.Lock()
+
+    def add_override(self, host, *addresses):
+        """Resolves 'host' to 'addresses', which are IP addresses"""
+        self._lock.acquire()
+        try:
+            self._overrides[host.lower()] = list(addresses)
+        finally:
+            self._lock.release()
+
+    def remove_override(self, host):
+        self._lock.acquire()
+        try:
+            self._overrides.pop(host.lower(), None)
+        finally:
+            self._lock.release()
+
+    def forget(self, host, port=None):
+        """Drops what is cached about 'host', on any port unless 'port'
+        is given."""
+        host = host.lower()
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                if key[0] == host and (port is None or key[1] == port):
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'negative_hits': self.negative_hits,
+                'entries': len(self._entries),
+                'overrides': len(self._overrides)}
+
+    def _store(self, key, expires, result):
+        if len(self._entries) >= self.max_entries:
+            now = time.time()
+            for old_key, (old_expires, old_result) in self._entries.items():
+                if old_expires <= now:
+                    del self._entries[old_key]
+            if len(self._entries) >= self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                del self._entries[oldest]
+        self._entries[key] = (expires, result)
+
+    def cached(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """What getaddrinfo() answers without looking 'host' up: the
+        addresses it was pinned to, or cached ones, or None if it would
+        have to be looked up. Raises socket.gaierror if resolving it
+        failed lately."""
+        key = (host.lower(), port, family, socktype, proto, flags)
+        self._lock.acquire()
+        try:
+            overrides = self._overrides.get(key[0])
+            entry = self._entries.get(key)
+            if overrides is None and entry is not None:
+                expires, result = entry
+                if expires > time.time():
+                    if isinstance(result, socket.gaierror):
+                        self.negative_hits += 1
+                        raise result
+                    self.hits += 1
+                    return result
+                del self._entries[key]
+            if overrides is None:
+                self.misses += 1
+            else:
+                # pinned hosts are answered without a lookup too
+                self.hits += 1
+        finally:
+            self._lock.release()
+
+        if overrides is not None:
+            addresses = []
+            for address in overrides:
+                addresses.extend(socket.getaddrinfo(address, port, family, socktype, proto,
+                                                    flags | socket.AI_NUMERICHOST))
+            return addresses
+        return None
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """Same as socket.getaddrinfo()"""
+        result = self.cached(host, port, family, socktype, proto, flags)
+        if result is None:
+            result = self.lookup(host, port, family, socktype, proto, flags)
+        return result
+
+    def lookup(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """Resolves 'host', whatever is cached about it, and caches the
+        result. Called by getaddrinfo() when cached() had nothing."""
+        key = (host.lower(), port, family, socktype, proto, flags)
+
+        # resolve without holding the lock, lookups can be slow
+        try:
+            result = socket.getaddrinfo(host, port, family, socktype, proto, flags)
+            ttl = self.ttl
+        except socket.gaierror, e:
+            result = e
+            ttl = self.negative_ttl
+
+        if ttl > 0:
+            self._lock.acquire()
+            try:
+                self._store(key, time.time() + ttl, result)
+            finally:
+                self._lock.release()
+
+        if isinstance(result, socket.gaierror):
+            raise result
+        return result
+
+def _open_socket(conn):
+    """Resolves and connects to conn.host and conn.port, through a
+    proxy if conn.proxy_info is usable, and returns the socket. Records
+    how long that took in conn.dns_time and conn.connect_time."""
+    # Mostly verbatim from httplib.py.
+    msg = "getaddrinfo returns an empty list"
+    started = time.time()
+    proxied = conn.proxy_info and conn.proxy_info.isgood()
+    if proxied and conn.proxy_info.proxy_rdns:
+        # the proxy resolves the host name, which it is given as it is
+        addresses = [(socket.AF_INET, socket.SOCK_STREAM, 0, '', (conn.host, conn.port))]
+    elif conn.dns_cache is not None:
+        addresses = conn.dns_cache.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    else:
+        addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    resolved = time.time()
+    conn.dns_time = resolved - started
+    sock = None
+    for res in addresses:
+        af, socktype, proto, canonname, sa = res
+        try:
+            if proxied:
+                sock = socks.socksocket(af, socktype, proto)
+                sock.setproxy(*conn.proxy_info.astuple())
+            else:
+                sock = socket.socket(af, socktype, proto)
+            # Different from httplib: support timeouts.
+            if conn.timeout is not None:
+                sock.settimeout(conn.timeout)
+                # End of difference from httplib.
+            if conn.debuglevel > 0:
+                print "connect: (%s, %s)" % (conn.host, conn.port)
+            sock.connect(sa)
+        except socket.error, msg:
+            if conn.debuglevel > 0:
+                print 'connect fail:', (conn.host, conn.port)
+            if sock:
+                sock.close()
+            sock = None
+            continue
+        break
+    conn.connect_time = time.time() - resolved
+    if not sock:
+        if conn.dns_cache is not None and not (proxied and conn.proxy_info.proxy_rdns):
+            # the host may have moved, look it up again next time
+            conn.dns_cache.forget(conn.host, conn.port)
+        raise socket.error, msg
+    try:
+        # headers and bodies may go out in separate writes, don't let
+        # Nagle's algorithm hold the last one back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (socket.error, AttributeError):
+        pass
+    return sock
+
 class HTTPConnectionWithTimeout(httplib.HTTPConnection):
     """HTTPConnection subclass that supports timeouts"""
 
-    def __init__(self, host, port=None, strict=None, timeout=None, proxy_info=None):
+    # How long the last connect() spent resolving the host name,
+    # connecting and in the TLS handshake, in seconds
+    dns_time = connect_time = tls_time = 0.0
+
+    def __init__(self, host, port=None, strict=None, timeout=None, proxy_info=None, dns_cache=None):
         httplib.HTTPConnection.__init__(self, host, port, strict)
         self.timeout = timeout
         self.proxy_info = proxy_info
+        self.dns_cache = dns_cache
 
     def connect(self):
         """Connect to the host and port specified in __init__."""
-        # Mostly verbatim from httplib.py.
-        msg = "getaddrinfo returns an empty list"
-        for res in socket.getaddrinfo(self.host, self.port, 0,
-                socket.SOCK_STREAM):
-            af, socktype, proto, canonname, sa = res
+        self.sock = _open_socket(self)
+
+    def send(self, data):
+        """Send 'data' to the server.
+
+        Streamed bodies that expose their 'parts' (see
+        bolacha.multipart.MultipartEncoder) have their file parts handed
+        to the kernel with sendfile(2), while the small buffers around
+        them are sent as usual. Anything else, or any part that is not a
+        real OS file, is copied the way httplib does it.
+        """
+        if sendfile is None or not hasattr(data, 'parts') or \
+               (self.proxy_info and self.proxy_info.isgood()):
+            return httplib.HTTPConnection.send(self, data)
+
+        if self.sock is None:
+            if self.auto_open:
+                self.connect()
+            else:
+                raise httplib.NotConnected()
+
+        for file, buf, length in data.parts:
+            if file is None:
+                self.sock.sendall(buf)
+                continue
+
+            # for file parts, buf is where the file started
             try:
-                if self.proxy_info and self.proxy_info.isgood():
-                    self.sock = socks.socksocket(af, socktype, proto)
-                    self.sock.setproxy(*self.proxy_info.astuple())
-                else:
-                    self.sock = socket.socket(af, socktype, proto)
-                # Different from httplib: support timeouts.
-                if self.timeout is not None:
-                    self.sock.settimeout(self.timeout)
-                    # End of difference from httplib.
-                if self.debuglevel > 0:
-                    print "connect: (%s, %s)" % (self.host, self.port)
-                self.sock.connect(sa)
-            except socket.error, msg:
-                if self.debuglevel > 0:
-                    print 'connect fail:', (self.host, self.port)
-                if self.sock:
-                    self.sock.close()
-                self.sock = None
+                fileno = file.fileno()
+            except (AttributeError, IOError, ValueError):
+                fileno = None
+
+            if fileno is None:
+                self._copy_file(file, buf, length)
+            else:
+                self._sendfile(fileno, buf, length)
+
+    def _copy_file(self, file, offset, length):
+        file.seek(offset)
+        while length > 0:
+            chunk = file.read(min(length, 8192))
+            if not chunk:
+                raise IOError('%r was truncated while being uploaded' % file.name)
+            self.sock.sendall(chunk)
+            length -= len(chunk)
+
+    def _sendfile(self, fileno, offset, length):
+        out = self.sock.fileno()
+        while length > 0:
+            try:
+                sent = sendfile(out, fileno, offset, length)
+            except (OSError, IOError), e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                # sockets with a timeout are non-blocking under the hood
+                if not select.select([], [out], [], self.timeout)[1]:
+                    raise socket.timeout('timed out')
                 continue
-            break
-        if not self.sock:
-            raise socket.error, msg
+            if not sent:
+                raise IOError('file was truncated while being uploaded')
+            offset += sent
+            length -= sent
 
 class HTTPSConnectionWithTimeout(httplib.HTTPSConnection):
     "This class allows communication via SSL."
 
+    dns_time = connect_time = tls_time = 0.0
+
     def __init__(self, host, port=None, key_file=None, cert_file=None,
-                 strict=None, timeout=None, proxy_info=None):
+                 strict=None, timeout=None, proxy_info=None, dns_cache=None):
         self.timeout = timeout
         self.proxy_info = proxy_info
+        self.dns_cache = dns_cache
         httplib.HTTPSConnection.__init__(self, host, port=port, key_file=key_file,
                 cert_file=cert_file, strict=strict)
 
     def connect(self):
         "Connect to a host on a given (SSL) port."
+        sock = _open_socket(self)
+        started = time.time()
+        if ssl is not None:
+            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+        else:
+            self.sock = httplib.FakeSocket(sock, socket.ssl(sock, self.key_file, self.cert_file))
+        self.tls_time = time.time() - started
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of keep-alive connections, keyed by
+    scheme:authority.
+
+    At most 'max_per_host' connections are kept for the same key and,
+    if 'max_connections' is given, at most that many for all keys
+    together. When the pool is full acquire() either waits for a
+    connection to be released (block=True, giving up after 'timeout'
+    seconds if it is not None) or raises PoolExhaustedError.
+    """
+    def __init__(self, max_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 max_connections=None, block=True, timeout=None):
+        self.max_per_host = max_per_host
+        self.max_connections = max_connections
+        self.block = block
+        self.timeout = timeout
+        self._idle = {}
+        self._counts = {}
+        self._total = 0
+        self._lock = threading.Condition(threading.Lock())
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __len__(self):
+        return self._total
+
+    def _host_is_full(self, key):
+        return self.max_per_host is not None and \
+               self._counts.get(key, 0) >= self.max_per_host
+
+    def _pool_is_full(self):
+        return self.max_connections is not None and \
+               self._total >= self.max_connections
+
+    def _forget(self, key):
+        self._counts[key] -= 1
+        self._total -= 1
+        if not self._counts[key]:
+            del self._counts[key]
+
+    def _evict_idle(self, exclude):
+        """Close an idle connection held for some other key, making
+        room for a new one. Returns False if there was none."""
+        for key, idle in self._idle.items():
+            if key != exclude and idle:
+                idle.pop(0).close()
+                self._forget(key)
+                if not idle:
+                    del self._idle[key]
+                return True
+        return False
+
+    def acquire(self, key, factory):
+        """Check out a connection for 'key', reusing an idle one when
+        possible and otherwise creating it by calling 'factory'."""
+        deadline = self.timeout is not None and time.time() + self.timeout
+        self._lock.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    if not idle:
+                        del self._idle[key]
+                    return conn
+                if not self._host_is_full(key):
+                    if not self._pool_is_full() or self._evict_idle(key):
+                        conn = factory()
+                        self._counts[key] = self._counts.get(key, 0) + 1
+                        self._total += 1
+                        return conn
+                if not self.block:
+                    raise PoolExhaustedError(_("No connection available for %s") % key)
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolExhaustedError(_("Timed out waiting for a connection to %s") % key)
+                    self._lock.wait(remaining)
+                else:
+                    self._lock.wait()
+        finally:
+            self._lock.release()
+
+    def release(self, key, conn):
+        """Give a connection back to the pool so it can be reused."""
+        # waiters for every key share one condition, so wake them all:
+        # a single notify() could go to a thread waiting for another key
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def discard(self, key, conn):
+        """Close a checked out connection that must not be reused,
+        for example after an error left it in an unknown state."""
+        self._lock.acquire()
+        try:
+            conn.close()
+            self._forget(key)
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
 
-        if self.proxy_info and self.proxy_info.isgood():
-            self.sock.setproxy(*self.proxy_info.astuple())
-            sock.setproxy(*self.proxy_info.astuple())
+    def clear(self):
+        """Close every idle connection."""
+        self._lock.acquire()
+        try:
+            for key, idle in self._idle.items():
+                for conn in idle:
+                    conn.close()
+                    self._forget(key)
+            self._idle = {}
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+
+class _BufferReader(object):
+    """Reads a buffer like a file, copying only what is read"""
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        if size < 0:
+            self.position = len(self.data)
+        else:
+            self.position = min(len(self.data), start + size)
+        return self.data[start:self.position]
+
+def _body_reader(content):
+    if isinstance(content, buffer):
+        return _BufferReader(content)
+    return StringIO.StringIO(content)
+
+class ResponseStream(object):
+    """A file-like response body, returned by Http.request(stream=True).
+
+    The body is read from the connection as the caller reads it, in
+    chunks of 'chunk_size' bytes when iterated, and decompressed on the
+    way by 'decoder' if the response was compressed. The connection goes
+    back to the pool once the body has been read to the end; closing the
+    stream before that closes the connection instead, since it can not
+    be reused with a half-read response on it.
+    """
+    def __init__(self, fp, on_close=None, chunk_size=RESPONSE_CHUNK_SIZE, decoder=None, timings=None):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = decoder
+        self.timings = timings
+        self.closed = False
+        self._on_close = on_close
+        self._buffer = ''
+        self._eof = False
+        # httplib says a length of 0 for HEAD, 204 and 304 responses
+        if getattr(fp, 'length', None) == 0 or self._fp_closed():
+            self.decoder = None
+            self._finish(True)
+
+    def _fp_closed(self):
+        return getattr(self.fp, 'isclosed', lambda: False)()
+
+    def _finish(self, exhausted):
+        self._eof = True
+        if self._on_close is not None:
+            self._on_close(exhausted)
+            self._on_close = None
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            started = time.time()
+            if size < 0:
+                data = self.fp.read()
+            else:
+                data = self.fp.read(size - len(self._buffer))
+            if self.timings is not None:
+                self.timings.transfer += time.time() - started
+            exhausted = size < 0 or not data or self._fp_closed()
+            if self.decoder is not None:
+                elapsed = self.decoder.elapsed
+                data = self.decoder.decompress(data)
+                if exhausted:
+                    data += self.decoder.flush()
+                if self.timings is not None:
+                    self.timings.decompress += self.decoder.elapsed - elapsed
+            self._buffer += data
+            if exhausted:
+                self._finish(True)
+
+    def read(self, size=-1):
+        if self.closed:
+            return ''
+        if size is None:
+            size = -1
+        try:
+            self._fill(size)
+        except:
+            self.close()
+            raise
+        if size < 0:
+            data, self._buffer = self._buffer, ''
         else:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if self.timeout is not None:
-            sock.settimeout(self.timeout)
-        sock.connect((self.host, self.port))
-        ssl = socket.ssl(sock, self.key_file, self.cert_file)
-        self.sock = httplib.FakeSocket(sock, ssl)
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if self._eof and not self._buffer:
+            self.closed = True
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._buffer = ''
+            if not self._eof:
+                self._finish(False)
+
+
+class RequestTimings(object):
+    """How long each phase of a request took, in seconds, much like
+    curl's -w timings. Http.request attaches one to every Response as
+    'timings' and hands it to the hooks added with add_timing_hook().
+
+    dns, connect and tls are 0 when a pooled connection was reused.
+    ttfb runs from sending the request until the response headers
+    arrived, transfer is the time spent reading the body and decompress
+    the time spent inflating it. cache is the time spent reading and
+    writing the cache. Redirects add the timings of the requests they
+    lead to, and are counted in 'redirects'; requests sent again with
+    credentials are counted in 'auth_retries'. A request that waited
+    for an identical one to be answered, and shares its response, is
+    'coalesced', and only spent 'total' waiting.
+
+    The body of a streamed response is read after request() returns,
+    so its transfer and decompress times keep growing until it is.
+    """
+    PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'decompress', 'cache')
+
+    def __init__(self, method=None, uri=None):
+        self.method = method
+        self.uri = uri
+        self.status = None
+        for phase in self.PHASES:
+            setattr(self, phase, 0.0)
+        self.total = 0.0
+        self.redirects = 0
+        self.auth_retries = 0
+        self.coalesced = False
+
+    def connected(self, conn):
+        """Records the phases of a connection that was just opened"""
+        self.dns += getattr(conn, 'dns_time', 0.0)
+        self.connect += getattr(conn, 'connect_time', 0.0)
+        self.tls += getattr(conn, 'tls_time', 0.0)
+
+    def timed(self, phase, function, *args):
+        """Calls function(*args), adding the time it takes to 'phase'"""
+        started = time.time()
+        try:
+            return function(*args)
+        finally:
+            setattr(self, phase, getattr(self, phase) + time.time() - started)
+
+    def add(self, other):
+        for phase in self.PHASES:
+            setattr(self, phase, getattr(self, phase) + getattr(other, phase))
+        self.redirects += other.redirects
+        self.auth_retries += other.auth_retries
+
+    def as_dict(self):
+        timings = dict([(phase, getattr(self, phase)) for phase in self.PHASES])
+        timings.update(method=self.method, uri=self.uri, status=self.status,
+                       total=self.total, redirects=self.redirects,
+                       auth_retries=self.auth_retries, coalesced=self.coalesced)
+        return timings
 
+    def __repr__(self):
+        return '<RequestTimings %s %s %s total=%.6f>' % (self.method, self.uri, self.status, self.total)
 
 
+class _Flight(object):
+    """A request in flight, that identical requests wait for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+def _shareable(response):
+    """Whether a copy of 'response' may answer identical requests that
+    were waiting for it"""
+    cc = _parse_cache_control(response)
+    return not cc.has_key('no-store') and not cc.has_key('private')
+
+def _flight_key(method, uri, headers):
+    """What identical requests, which can share a response, have in
+    common"""
+    return (method, normalize_uri(uri).defrag_uri,
+            headers and tuple(sorted(_normalize_headers(headers).items())) or ())
+
+
+class _CacheCheck(object):
+    """A request as Http._check_cache() prepared it, with what it found
+    in the cache and what is to be done about it. 'action' is one of:
+
+    - "send": send the request, there is no entry that can answer it
+    - "redirect": follow the permanent redirect cached for the URI
+    - "fresh": answer with the entry, whose body is 'content'
+    - "stale": answer with the entry, whose body is 'content', and
+      revalidate it in the background
+    - "revalidate": send the request, with the entry's validators if it
+      has any, and hand the response to Http._revalidated(). If
+      'stale_if_error', Http._stale_on_error() may serve the entry
+      instead of an error
+
+    Http and bolacha.asynchronous.AsyncBolacha both act on it, each
+    sending requests its own way.
+    """
+    def __init__(self, normalized, headers):
+        self.normalized = normalized
+        self.headers = headers
+        self.info = {}
+        self.content = ""
+        self.cached_value = None
+        self.cachekey = None
+        self.action = "send"
+        self.stale_if_error = False
+
+
+class _PipelineReader(object):
+    """The reading end of a pipelined connection, given to each
+    httplib.HTTPResponse in place of the socket. Responses share one
+    buffered file, which they can't close: whatever is buffered past
+    the end of a response is the start of the next one."""
+    def __init__(self, sock):
+        self._fp = sock.makefile('rb')
+
+    def makefile(self, *args):
+        return self
+
+    def read(self, *args):
+        return self._fp.read(*args)
+
+    def readline(self, *args):
+        return self._fp.readline(*args)
+
+    def close(self):
+        pass
+
 class Http(object):
     """An HTTP client that handles:
 - all methods
@@ -763,15 +2168,38 @@ class Http(object):
 
 and more.
     """
-    def __init__(self, cache=None, timeout=None, proxy_info=None):
+    def __init__(self, cache=None, timeout=None, proxy_info=None,
+                 max_connections_per_host=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 max_connections=None, pool_block=True, pool_timeout=None,
+                 dns_cache=None, stale_while_revalidate=None, stale_if_error=None):
         """The value of proxy_info is a ProxyInfo instance.
 
 If 'cache' is a string then it is used as a directory name
 for a disk cache. Otherwise it must be an object that supports
-the same interface as FileCache."""
+the same interface as FileCache, such as a MemoryCache.
+
+Connections are kept in a ConnectionPool shared by every thread
+using this object. 'max_connections_per_host' and 'max_connections'
+bound it; when it is full a request waits for a free connection
+(up to 'pool_timeout' seconds) or, if 'pool_block' is False, raises
+PoolExhaustedError.
+
+Host names are resolved through 'dns_cache', a DNSCache of
+its own unless one is given, so that they can be shared.
+
+A cached response that has gone stale is served right away, and
+revalidated on a thread of its own, for as many seconds after it
+went stale as its 'stale-while-revalidate' Cache-Control directive
+says. It is served instead of an error, or of a 5xx response, for as
+long as its 'stale-if-error' directive says. 'stale_while_revalidate'
+and 'stale_if_error', in seconds, take the place of those directives
+for every response."""
         self.proxy_info = proxy_info
-        # Map domain name to an httplib connection
-        self.connections = {}
+        # Map scheme:authority to a pool of httplib connections
+        self.connections = ConnectionPool(max_connections_per_host,
+                                          max_connections,
+                                          block=pool_block,
+                                          timeout=pool_timeout)
         # The location of the cache, for now a directory
         # where cached responses are held.
         if cache and isinstance(cache, str):
@@ -799,8 +2227,34 @@ the same interface as FileCache."""
 
         self.force_exception_to_status_code = False
 
+        # If set, gzip and deflate bodies that decompress to more than
+        # this many bytes raise DecompressedContentTooLarge.
+        self.max_decompressed_size = None
+
         self.timeout = timeout
 
+        if dns_cache is None:
+            dns_cache = DNSCache()
+        self.dns_cache = dns_cache
+
+        # Called with the RequestTimings of every request
+        self.timing_hooks = []
+
+        # In seconds, in place of the directives of RFC 5861 if not None
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+
+        # The cache keys being revalidated in the background
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+
+        # If True, a GET or HEAD the cache could answer, made while an
+        # identical one is in flight, waits for it and gets a copy of
+        # its response, unless that response may not be shared
+        self.coalesce_requests = True
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
     def _auth_from_challenge(self, host, request_uri, headers, response, content):
         """A generator that creates Authorization objects
            that can be applied to requests.
@@ -827,104 +2281,244 @@ the same interface as FileCache."""
         self.credentials.clear()
         self.authorizations = []
 
-    def _conn_request(self, conn, request_uri, method, body, headers):
+    def get_authorizations_state(self):
+        """The state of the authorizations learned so far, as a list
+        of dicts that restore_authorizations() takes back, in this or
+        another process. Passwords are left out."""
+        schemes = dict([(klass, scheme) for scheme, klass in AUTH_SCHEME_CLASSES.items()])
+        states = []
+        for authorization in self.authorizations:
+            scheme = schemes.get(type(authorization))
+            if scheme is not None:
+                state = authorization.get_state()
+                state['scheme'] = scheme
+                states.append(state)
+        return states
+
+    def restore_authorizations(self, states):
+        """Adds the authorizations of get_authorizations_state() for
+        which there are credentials with the same name, so that requests
+        are authorized without being challenged first."""
+        for state in states:
+            klass = AUTH_SCHEME_CLASSES.get(state.get('scheme'))
+            if klass is None:
+                continue
+            known = [authorization for authorization in self.authorizations
+                     if type(authorization) is klass and
+                     (authorization.host, authorization.path) == (state['host'], state['path'])]
+            if known:
+                continue
+            for credentials in self.credentials.iter(state['host']):
+                if credentials[0] == state['name']:
+                    self.authorizations.append(klass.from_state(state, credentials, self))
+                    break
+
+    def add_timing_hook(self, hook):
+        """Add a callable that will be given the RequestTimings
+        of every request once it is done."""
+        self.timing_hooks.append(hook)
+
+    def remove_timing_hook(self, hook):
+        self.timing_hooks.remove(hook)
+
+    def _connection_factory(self, scheme, authority, connection_type=None):
+        """A callable making new connections to 'authority'"""
+        if not connection_type:
+            connection_type = (scheme == 'https') and HTTPSConnectionWithTimeout or HTTPConnectionWithTimeout
+
+        def connection_factory():
+            certs = list(self.certificates.iter(authority))
+            if scheme == 'https' and certs:
+                conn = connection_type(authority, key_file=certs[0][0],
+                    cert_file=certs[0][1], timeout=self.timeout, proxy_info=self.proxy_info)
+            else:
+                conn = connection_type(authority, timeout=self.timeout, proxy_info=self.proxy_info)
+            # set after the fact, custom connection types may not
+            # take it as an argument
+            conn.dns_cache = self.dns_cache
+            conn.set_debuglevel(debuglevel)
+            return conn
+        return connection_factory
+
+    def _conn_request(self, conn_key, connection_factory, request_uri, method, body, headers, stream=False, timings=None):
+        if timings is None:
+            timings = RequestTimings(method, request_uri)
+        conn = self.connections.acquire(conn_key, connection_factory)
+        try:
+            (response, content) = self._send_and_read(conn, request_uri, method, body, headers, stream, timings)
+        except:
+            self.connections.discard(conn_key, conn)
+            raise
+        if not stream:
+            self.connections.release(conn_key, conn)
+            return (response, content)
+
+        def on_close(exhausted):
+            if exhausted:
+                self.connections.release(conn_key, conn)
+            else:
+                self.connections.discard(conn_key, conn)
+
+        decoder = None
+        if method != "HEAD":
+            decoder = _content_decoder(response, self.max_decompressed_size)
+        return (response, ResponseStream(content, on_close, decoder=decoder, timings=timings))
+
+    def _send_and_read(self, conn, request_uri, method, body, headers, stream=False, timings=None):
+        if timings is None:
+            timings = RequestTimings(method, request_uri)
         for i in range(2):
             try:
+                if hasattr(body, 'rewind'):
+                    # streamed bodies are consumed while being sent
+                    body.rewind()
+                if conn.sock is None:
+                    conn.connect()
+                    timings.connected(conn)
+                started = time.time()
                 conn.request(method, request_uri, body, headers)
                 response = conn.getresponse()
+                timings.ttfb += time.time() - started
             except socket.gaierror:
                 conn.close()
                 raise ServerNotFoundError("Unable to find the server at %s" % conn.host)
             except httplib.HTTPException, e:
                 if i == 0:
                     conn.close()
-                    conn.connect()
                     continue
                 else:
                     raise
             else:
-                content = response.read()
-                response = Response(response)
-                if method != "HEAD":
-                    content = _decompressContent(response, content)
+                if stream:
+                    content = response
+                    response = Response(response)
+                elif method == "HEAD":
+                    content = timings.timed('transfer', response.read)
+                    response = Response(response)
+                else:
+                    fp = response
+                    response = Response(fp)
+                    content = _read_content(response, fp, self.max_decompressed_size, timings)
 
             break;
         return (response, content)
 
 
-    def _request(self, conn, host, absolute_uri, request_uri, method, body, headers, redirections, cachekey):
-        """Do the actual request using the connection object
-        and also follow one level of redirects if necessary"""
+    def _request(self, conn_key, connection_factory, uri, method, body, headers, redirections, cachekey, stream=False, timings=None):
+        """Do the actual request, to the NormalizedURI 'uri', using the
+        connection object and also follow one level of redirects if necessary"""
+        host = uri.authority
+        absolute_uri = uri.uri
+        request_uri = uri.request_uri
+        if timings is None:
+            timings = RequestTimings(method, absolute_uri)
 
-        auths = [(auth.depth(request_uri), auth) for auth in self.authorizations if auth.inscope(host, request_uri)]
-        auth = auths and sorted(auths)[0][1] or None
+        auth = self._authorization_for(uri)
         if auth:
             auth.request(method, request_uri, headers, body)
 
-        (response, content) = self._conn_request(conn, request_uri, method, body, headers)
+        (response, content) = self._conn_request(conn_key, connection_factory, request_uri, method, body, headers, stream, timings)
 
         if auth:
             if auth.response(response, body):
+                _buffered(content)
                 auth.request(method, request_uri, headers, body)
-                (response, content) = self._conn_request(conn, request_uri, method, body, headers )
+                timings.auth_retries += 1
+                (response, content) = self._conn_request(conn_key, connection_factory, request_uri, method, body, headers, stream, timings)
                 response._stale_digest = 1
 
         if response.status == 401:
-            for authorization in self._auth_from_challenge(host, request_uri, headers, response, content):
+            content = _buffered(content)
+            for authorization in self._auth_from_challenge(host, uri, headers, response, content):
                 authorization.request(method, request_uri, headers, body)
-                (response, content) = self._conn_request(conn, request_uri, method, body, headers, )
+                timings.auth_retries += 1
+                (response, content) = self._conn_request(conn_key, connection_factory, request_uri, method, body, headers, stream, timings)
                 if response.status != 401:
                     self.authorizations.append(authorization)
                     authorization.response(response, body)
                     break
-
-        if (self.follow_all_redirects or (method in ["GET", "HEAD"]) or response.status == 303):
-            if self.follow_redirects and response.status in [300, 301, 302, 303, 307]:
-                # Pick out the location header and basically start from the beginning
-                # remembering first to strip the ETag header and decrement our 'depth'
-                if redirections:
-                    if not response.has_key('location') and response.status != 300:
-                        raise RedirectMissingLocation( _("Redirected but the response is missing a Location: header."), response, content)
-                    # Fix-up relative redirects (which violate an RFC 2616 MUST)
-                    if response.has_key('location'):
-                        location = response['location']
-                        (scheme, authority, path, query, fragment) = parse_uri(location)
-                        if authority == None:
-                            response['location'] = urlparse.urljoin(absolute_uri, location)
-                    if response.status == 301 and method in ["GET", "HEAD"]:
-                        response['-x-permanent-redirect-url'] = response['location']
-                        if not response.has_key('content-location'):
-                            response['content-location'] = absolute_uri
-                        _updateCache(headers, response, content, self.cache, cachekey)
-                    if headers.has_key('if-none-match'):
-                        del headers['if-none-match']
-                    if headers.has_key('if-modified-since'):
-                        del headers['if-modified-since']
-                    if response.has_key('location'):
-                        location = response['location']
-                        old_response = copy.deepcopy(response)
-                        if not old_response.has_key('content-location'):
-                            old_response['content-location'] = absolute_uri
-                        redirect_method = ((response.status == 303) and (method not in ["GET", "HEAD"])) and "GET" or method
-                        (response, content) = self.request(location, redirect_method, body=body, headers = headers, redirections = redirections - 1)
-                        response.previous = old_response
-                else:
-                    raise RedirectLimit( _("Redirected more times than rediection_limit allows."), response, content)
-            elif response.status in [200, 203] and method == "GET":
-                # Don't cache 206's since we aren't going to handle byte range requests
-                if not response.has_key('content-location'):
-                    response['content-location'] = absolute_uri
-                _updateCache(headers, response, content, self.cache, cachekey)
+                content = _buffered(content)
+
+        if self._redirects(method, response):
+            content = _buffered(content)
+            redirect = self._redirect(absolute_uri, method, headers, response, content, redirections, cachekey, timings)
+            if redirect is not None:
+                (location, redirect_method, old_response) = redirect
+                (response, content) = self._cached_request(location, redirect_method, body, headers, redirections - 1, None, stream)
+                response.previous = old_response
+                timings.add(response.timings)
+                timings.redirects += 1
+                if isinstance(content, ResponseStream):
+                    content.timings = timings
+        elif not stream:
+            # a streamed body is never held in memory, so it can't be cached
+            self._store_response(absolute_uri, method, headers, response, content, cachekey, timings)
 
         return (response, content)
 
+    def _authorization_for(self, uri):
+        """The authorization learned so far that applies to the
+        NormalizedURI 'uri' most closely, or None"""
+        auths = [(auth.depth(uri), auth) for auth in self.authorizations if auth.inscope(uri.authority, uri)]
+        return auths and sorted(auths)[0][1] or None
+
+    def _redirects(self, method, response):
+        """Whether 'response', to a 'method' request, is a redirect to follow"""
+        return (self.follow_all_redirects or (method in ["GET", "HEAD"]) or response.status == 303) and \
+               self.follow_redirects and response.status in [300, 301, 302, 303, 307]
+
+    def _redirect(self, absolute_uri, method, headers, response, content, redirections, cachekey, timings):
+        """Prepares to follow the redirect 'response' to a request for
+        'absolute_uri', and returns the (location, method, previous
+        response) of the request to make next, or None if there is no
+        location to go to. Validators are taken out of 'headers' and
+        permanent redirects are cached."""
+        if not redirections:
+            raise RedirectLimit( _("Redirected more times than rediection_limit allows."), response, content)
+        # Pick out the location header and basically start from the beginning
+        # remembering first to strip the ETag header and decrement our 'depth'
+        if not response.has_key('location') and response.status != 300:
+            raise RedirectMissingLocation( _("Redirected but the response is missing a Location: header."), response, content)
+        # Fix-up relative redirects (which violate an RFC 2616 MUST)
+        if response.has_key('location'):
+            location = response['location']
+            (scheme, authority, path, query, fragment) = parse_uri(location)
+            if authority == None:
+                response['location'] = urlparse.urljoin(absolute_uri, location)
+        if response.status == 301 and method in ["GET", "HEAD"]:
+            response['-x-permanent-redirect-url'] = response['location']
+            if not response.has_key('content-location'):
+                response['content-location'] = absolute_uri
+            timings.timed('cache', _updateCache, headers, response, content, self.cache, cachekey)
+        if headers.has_key('if-none-match'):
+            del headers['if-none-match']
+        if headers.has_key('if-modified-since'):
+            del headers['if-modified-since']
+        if not response.has_key('location'):
+            return None
+        # the responses before it are shared, not copied
+        old_response = copy.copy(response)
+        old_response.requested_uri = absolute_uri
+        if not old_response.has_key('content-location'):
+            old_response['content-location'] = absolute_uri
+        redirect_method = ((response.status == 303) and (method not in ["GET", "HEAD"])) and "GET" or method
+        return (response['location'], redirect_method, old_response)
+
+    def _store_response(self, absolute_uri, method, headers, response, content, cachekey, timings):
+        """Caches 'response' to a request for 'absolute_uri', if it can be"""
+        if response.status in [200, 203] and method == "GET":
+            # Don't cache 206's since we aren't going to handle byte range requests
+            if not response.has_key('content-location'):
+                response['content-location'] = absolute_uri
+            timings.timed('cache', _updateCache, headers, response, content, self.cache, cachekey)
+
 
 # Need to catch and rebrand some exceptions
 # Then need to optionally turn all exceptions into status codes
 # including all socket.* and httplib.* exceptions.
 
 
-    def request(self, uri, method="GET", body=None, headers=None, redirections=DEFAULT_MAX_REDIRECTS, connection_type=None):
+    def request(self, uri, method="GET", body=None, headers=None, redirections=DEFAULT_MAX_REDIRECTS, connection_type=None, stream=False):
         """ Performs a single HTTP request.
 The 'uri' is the URI of the HTTP resource and can begin
 with either 'http' or 'https'. The value of 'uri' must be an absolute URI.
@@ -933,7 +2527,9 @@ The 'method' is the HTTP method to perform, such as GET, POST, DELETE, etc.
 There is no restriction on the methods allowed.
 
 The 'body' is the entity body to be sent with the request. It is a string
-object.
+object, or a file-like object such as bolacha.multipart.MultipartEncoder
+that is read while being sent and has a rewind() method so it can be
+sent again on retries.
 
 Any extra headers that are to be sent with the request should be provided in the
 'headers' dictionary.
@@ -944,120 +2540,462 @@ exception is 'redirections. The default is 5.
 The return value is a tuple of (response, content), the first
 being and instance of the 'Response' class, the second being
 a string that contains the response entity body.
+
+If 'stream' is True the content is a ResponseStream instead, which
+reads (and decompresses) the body as it is consumed. Redirects and
+authentication challenges are still handled, but streamed responses
+are not stored in the cache.
+
+The response has a RequestTimings as 'timings', which is also given
+to every hook in 'timing_hooks'.
+
+With a cache, while a GET or HEAD is in flight, identical ones made by
+other threads (same method, URI and headers) wait for it, and get
+copies of its response instead of sending the request again. Requests
+the cache could not answer anyway, such as those with 'no-store', are
+not coalesced, and if the response turns out to be 'no-store' or
+'private' the others are sent after all. Set 'coalesce_requests' to
+False to send each of them.
         """
-        try:
-            if headers is None:
-                headers = {}
-            else:
-                headers = _normalize_headers(headers)
+        if self._coalesces(method, body, stream, headers):
+            (response, content) = self._coalesced_request(uri, method, headers, redirections, connection_type)
+        else:
+            (response, content) = self._cached_request(uri, method, body, headers, redirections, connection_type, stream)
+        for hook in self.timing_hooks:
+            hook(response.timings)
+        return (response, content)
 
-            if not headers.has_key('user-agent'):
-                headers['user-agent'] = "Python-httplib2/%s" % __version__
+    def _coalesces(self, method, body, stream, headers):
+        """Whether requests like this one are coalesced: those the cache
+        could answer, had the response been there already"""
+        if not self.coalesce_requests or self.cache is None or \
+           method not in ("GET", "HEAD") or body or stream:
+            return False
+        headers = headers and _normalize_headers(headers) or {}
+        cc = _parse_cache_control(headers)
+        return 'range' not in headers and not cc.has_key('no-store') and not cc.has_key('no-cache')
+
+    def _coalesced_request(self, uri, method, headers, redirections, connection_type):
+        """Performs the request, or waits for an identical one already in
+        flight and answers with a copy of its response"""
+        key = _flight_key(method, uri, headers)
+        self._flights_lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        finally:
+            self._flights_lock.release()
+
+        if leader:
+            try:
+                try:
+                    flight.result = self._cached_request(uri, method, None, headers, redirections, connection_type, False)
+                except:
+                    flight.exc_info = sys.exc_info()
+                    raise
+                return flight.result
+            finally:
+                self._flights_lock.acquire()
+                try:
+                    del self._flights[key]
+                finally:
+                    self._flights_lock.release()
+                flight.done.set()
+
+        started = time.time()
+        flight.done.wait()
+        if flight.exc_info is not None:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        (response, content) = flight.result
+        if not _shareable(response):
+            return self._cached_request(uri, method, None, headers, redirections, connection_type, False)
+        response = copy.copy(response)
+        response.timings = timings = RequestTimings(method, uri)
+        timings.status = response.status
+        timings.coalesced = True
+        timings.total = time.time() - started
+        return (response, content)
 
-            uri = iri2uri(uri)
+    def pipeline(self, uris, method="GET", headers=None, depth=DEFAULT_PIPELINE_DEPTH, connection_type=None):
+        """Performs a batch of GET or HEAD requests using HTTP/1.1
+pipelining: up to 'depth' requests are written on a kept-alive
+connection before their responses are read, so that a batch to a
+distant server doesn't pay a round trip per request. The server must
+support pipelining.
 
-            (scheme, authority, request_uri, defrag_uri) = urlnorm(uri)
+Requests are grouped by scheme:authority, one connection each. The
+requests a server did not answer before closing the connection are
+sent again on a new one. Responses asking to be redirected or
+authenticated are done again through request(). Pipelined requests
+neither use nor fill the cache.
 
+Returns a list of (response, content) tuples, in the order of 'uris'.
+        """
+        if method not in PIPELINE_METHODS:
+            raise ValueError("Only %s requests can be pipelined, not %s" % (
+                " and ".join(PIPELINE_METHODS), method))
+        if headers is None:
+            headers = {}
+        else:
+            headers = _normalize_headers(headers)
+        if not headers.has_key('user-agent'):
+            headers['user-agent'] = "Python-httplib2/%s" % __version__
+        if 'range' not in headers:
+            headers['accept-encoding'] = 'compress, gzip'
+
+        batches = OrderedDict()
+        for index, uri in enumerate(uris):
+            normalized = normalize_uri(uri)
+            (uri, scheme, authority, request_uri) = (normalized.uri, normalized.scheme,
+                                                     normalized.authority, normalized.request_uri)
+            batch = batches.setdefault((scheme, authority), [])
+            request_headers = headers.copy()
+            request_headers['host'] = authority
+            auth = self._authorization_for(normalized)
+            if auth:
+                auth.request(method, request_uri, request_headers, '')
+            batch.append((index, uri, request_uri, request_headers, RequestTimings(method, uri)))
+
+        results = [None] * len(uris)
+        for (scheme, authority), batch in batches.items():
             conn_key = scheme+":"+authority
-            if conn_key in self.connections:
-                conn = self.connections[conn_key]
+            connection_factory = self._connection_factory(scheme, authority, connection_type)
+            for (index, uri, request_uri, request_headers, timings), (response, content) in \
+                    zip(batch, self._pipeline(conn_key, connection_factory, method, batch, depth)):
+                if (response.status in [300, 301, 302, 303, 307] and self.follow_redirects and 'location' in response) or \
+                   (response.status == 401 and list(self.credentials.iter(authority))):
+                    results[index] = self.request(uri, method, headers=headers, connection_type=connection_type)
+                    continue
+                response.timings = timings
+                response.requested_uri = uri
+                timings.status = response.status
+                for hook in self.timing_hooks:
+                    hook(timings)
+                results[index] = (response, content)
+        return results
+
+    def _pipeline(self, conn_key, connection_factory, method, batch, depth):
+        """Sends the requests of 'batch' pipelined and returns their
+        (response, content) in order"""
+        results = []
+        pending = deque(batch)
+        failures = 0
+        while pending:
+            conn = self.connections.acquire(conn_key, connection_factory)
+            try:
+                answered, error = self._pipeline_on(conn, method, pending, depth, results)
+            except:
+                self.connections.discard(conn_key, conn)
+                raise
+            if conn.sock is None:
+                self.connections.discard(conn_key, conn)
             else:
-                if not connection_type:
-                    connection_type = (scheme == 'https') and HTTPSConnectionWithTimeout or HTTPConnectionWithTimeout
-                certs = list(self.certificates.iter(authority))
-                if scheme == 'https' and certs:
-                    conn = self.connections[conn_key] = connection_type(authority, key_file=certs[0][0],
-                        cert_file=certs[0][1], timeout=self.timeout, proxy_info=self.proxy_info)
+                self.connections.release(conn_key, conn)
+            if answered:
+                failures = 0
+            elif error is not None:
+                # a fresh connection that answers nothing won't get better
+                failures += 1
+                if failures > 1:
+                    raise error
+        return results
+
+    def _pipeline_on(self, conn, method, pending, depth, results):
+        """Writes requests of 'pending' on 'conn' and reads their responses
+        into 'results' until all are answered or the server closes the
+        connection. Returns how many were answered, and the error that
+        ended the connection if any."""
+        try:
+            if conn.sock is None:
+                conn.connect()
+                pending[0][4].connected(conn)
+        except socket.gaierror:
+            conn.close()
+            raise ServerNotFoundError("Unable to find the server at %s" % conn.host)
+
+        answered = 0
+        written = 0
+        sent_at = {}
+        reader = _PipelineReader(conn.sock)
+        try:
+            while pending:
+                while written < min(depth, len(pending)):
+                    (index, uri, request_uri, headers, timings) = pending[written]
+                    lines = ["%s %s HTTP/1.1" % (method, request_uri)]
+                    lines.extend(["%s: %s" % item for item in headers.items()])
+                    sent_at[index] = time.time()
+                    conn.sock.sendall("\r\n".join(lines) + "\r\n\r\n")
+                    written += 1
+
+                (index, uri, request_uri, headers, timings) = pending[0]
+                fp = httplib.HTTPResponse(reader, strict=conn.strict, method=method)
+                fp.begin()
+                timings.ttfb += time.time() - sent_at[index]
+                response = Response(fp)
+                if method == "HEAD":
+                    content = timings.timed('transfer', fp.read)
                 else:
-                    conn = self.connections[conn_key] = connection_type(authority, timeout=self.timeout, proxy_info=self.proxy_info)
-                conn.set_debuglevel(debuglevel)
-
-            if method in ["GET", "HEAD"] and 'range' not in headers:
-                headers['accept-encoding'] = 'compress, gzip'
-
-            info = email.Message.Message()
-            cached_value = None
-            if self.cache:
-                cachekey = defrag_uri
-                cached_value = self.cache.get(cachekey)
-                if cached_value:
-                    info = email.message_from_string(cached_value)
-                    try:
-                        content = cached_value.split('\r\n\r\n', 1)[1]
-                    except IndexError:
-                        self.cache.delete(cachekey)
-                        cachekey = None
-                        cached_value = None
-            else:
-                cachekey = None
-
-            if method in ["PUT"] and self.cache and info.has_key('etag') and not self.ignore_etag and 'if-match' not in headers:
-                # http://www.w3.org/1999/04/Editing/
-                headers['if-match'] = info['etag']
+                    content = _read_content(response, fp, self.max_decompressed_size, timings)
+                timings.total = timings.dns + timings.connect + timings.tls + \
+                                time.time() - sent_at[index]
+                results.append((response, content))
+                pending.popleft()
+                written -= 1
+                answered += 1
+                if fp.will_close:
+                    # whatever else was written is sent again
+                    conn.close()
+                    break
+        except socket.timeout:
+            conn.close()
+            raise
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            return answered, e
+        return answered, None
+
+    def _revalidate_in_background(self, uri, headers, redirections, connection_type, cachekey):
+        """Revalidates the stale cache entry for 'uri' on a thread of its
+        own, unless that is already being done"""
+        if not self._start_revalidation(cachekey):
+            return
+
+        def revalidate():
+            try:
+                try:
+                    self._cached_request(uri, "GET", None, headers, redirections,
+                                         connection_type, False, revalidating=True)
+                except Exception:
+                    # nobody is waiting for it, the entry is tried again
+                    # the next time it is served stale
+                    pass
+            finally:
+                self._end_revalidation(cachekey)
+
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+    def _start_revalidation(self, cachekey):
+        """Claims the revalidation of the entry for 'cachekey'. False if
+        it is already being revalidated."""
+        self._revalidating_lock.acquire()
+        try:
+            if cachekey in self._revalidating:
+                return False
+            self._revalidating.add(cachekey)
+            return True
+        finally:
+            self._revalidating_lock.release()
 
-            if method not in ["GET", "HEAD"] and self.cache and cachekey:
-                # RFC 2616 Section 13.10
-                self.cache.delete(cachekey)
+    def _end_revalidation(self, cachekey):
+        self._revalidating_lock.acquire()
+        try:
+            self._revalidating.discard(cachekey)
+        finally:
+            self._revalidating_lock.release()
+
+    def _serve_stale(self, info, content, stream, timings, started):
+        response = Response(info)
+        response.fromcache = True
+        response.stale = True
+        response.requested_uri = timings.uri
+        if stream:
+            content = ResponseStream(_body_reader(content))
+        timings.status = response.status
+        timings.total = time.time() - started
+        response.timings = timings
+        return (response, content)
 
-            if cached_value and method in ["GET", "HEAD"] and self.cache and 'range' not in headers:
-                if info.has_key('-x-permanent-redirect-url'):
-                    # Should cached permanent redirects be counted in our redirection count? For now, yes.
-                    (response, new_content) = self.request(info['-x-permanent-redirect-url'], "GET", headers = headers, redirections = redirections - 1)
-                    response.previous = Response(info)
+    def _check_cache(self, uri, method, headers, timings, revalidating=False):
+        """Prepares a request for 'uri', looks it up in the cache and
+        decides what the entry found, if any, is good for. Returns a
+        _CacheCheck."""
+        if headers is None:
+            headers = {}
+        else:
+            headers = _normalize_headers(headers)
+
+        if not headers.has_key('user-agent'):
+            headers['user-agent'] = "Python-httplib2/%s" % __version__
+
+        normalized = normalize_uri(uri)
+        timings.uri = normalized.uri
+        check = _CacheCheck(normalized, headers)
+
+        if method in ["GET", "HEAD"] and 'range' not in headers:
+            headers['accept-encoding'] = 'compress, gzip'
+
+        if self.cache is not None:
+            check.cachekey = normalized.defrag_uri
+            # the body is only read if the entry is served
+            check.cached_value = timings.timed('cache', _cache_lookup, self.cache, check.cachekey)
+            if check.cached_value:
+                try:
+                    (check.info, check.content) = timings.timed('cache', _decode_cache_entry, check.cached_value)
+                except (ValueError, struct.error):
+                    timings.timed('cache', self.cache.delete, check.cachekey)
+                    check.cachekey = None
+                    check.cached_value = None
+        info = check.info
+
+        if method in ["PUT"] and self.cache is not None and info.has_key('etag') and not self.ignore_etag and 'if-match' not in headers:
+            # http://www.w3.org/1999/04/Editing/
+            headers['if-match'] = info['etag']
+
+        if method not in ["GET", "HEAD"] and self.cache is not None and check.cachekey:
+            # RFC 2616 Section 13.10
+            timings.timed('cache', self.cache.delete, check.cachekey)
+
+        if not (check.cached_value and method in ["GET", "HEAD"] and self.cache is not None and 'range' not in headers):
+            return check
+
+        if info.has_key('-x-permanent-redirect-url'):
+            # Should cached permanent redirects be counted in our redirection count? For now, yes.
+            check.action = "redirect"
+            return check
+
+        # Determine our course of action:
+        #   Is the cached entry fresh or stale?
+        #   Has the client requested a non-cached response?
+        #
+        # There seems to be three possible answers:
+        # 1. [FRESH] Return the cache entry w/o doing a GET
+        # 2. [STALE] Do the GET (but add in cache validators if available)
+        # 3. [TRANSPARENT] Do a GET w/o any cache validators (Cache-Control: no-cache) on the request
+        entry_disposition = _entry_disposition(info, headers)
+
+        if entry_disposition == "FRESH":
+            content = timings.timed('cache', _cache_body, self.cache, check.cachekey, check.cached_value, check.content)
+            if content is not None:
+                check.content = content
+                check.action = "fresh"
+                return check
+            # replaced or removed since, ask the server
+            entry_disposition = "TRANSPARENT"
+
+        if entry_disposition == "STALE" and method == "GET":
+            staleness = _entry_staleness(info, headers)
+            if staleness is not None and not revalidating and \
+                    staleness <= _stale_window(info, 'stale-while-revalidate', self.stale_while_revalidate):
+                content = timings.timed('cache', _cache_body, self.cache, check.cachekey, check.cached_value, check.content)
+                if content is not None:
+                    check.content = content
+                    check.action = "stale"
+                    return check
+            check.stale_if_error = staleness is not None and \
+                staleness <= _stale_window(info, 'stale-if-error', self.stale_if_error)
+
+        if entry_disposition == "STALE":
+            if info.has_key('etag') and not self.ignore_etag and not 'if-none-match' in headers:
+                headers['if-none-match'] = info['etag']
+            if info.has_key('last-modified') and not 'last-modified' in headers:
+                headers['if-modified-since'] = info['last-modified']
+
+        check.action = "revalidate"
+        return check
+
+    def _stale_on_error(self, check, response, timings):
+        """The body of the entry of 'check' if it is to be served instead
+        of 'response', a 5xx, or instead of an error when 'response' is
+        None. Otherwise None."""
+        if check.stale_if_error and (response is None or response.status >= 500):
+            return timings.timed('cache', _cache_body, self.cache, check.cachekey, check.cached_value, check.content)
+        return None
+
+    def _revalidated(self, check, method, response, new_content, timings):
+        """The (response, content) to answer with, once the request of a
+        "revalidate" or "redirect" check got 'response'. None if the
+        request has to be sent again, without the validators, which are
+        taken out of check.headers."""
+        if response.status == 304 and method == "GET":
+            content = timings.timed('cache', _cache_body, self.cache, check.cachekey, check.cached_value, check.content)
+            if content is None:
+                # The entry was replaced or removed while we revalidated
+                # it, so there is no body to go with the 304.
+                for key in ('if-none-match', 'if-modified-since'):
+                    check.headers.pop(key, None)
+                return None
+
+            # Rewrite the cache entry with the new end-to-end headers
+            # Take all headers that are in response
+            # and overwrite their values in info.
+            # unless they are hop-by-hop, or are listed in the connection header.
+            info = check.info
+            for key in _get_end2end_headers(response):
+                info[key] = response[key]
+            merged_response = Response(info)
+            if hasattr(response, "_stale_digest"):
+                merged_response._stale_digest = response._stale_digest
+            timings.timed('cache', _mergeCache, check.headers, merged_response, content, self.cache, check.cachekey, check.cached_value)
+            merged_response.status = 200
+            merged_response.fromcache = True
+            return (merged_response, content)
+
+        if response.status != 200:
+            timings.timed('cache', self.cache.delete, check.cachekey)
+        return (response, new_content)
+
+    def _cached_request(self, uri, method, body, headers, redirections, connection_type, stream, revalidating=False):
+        started = time.time()
+        timings = RequestTimings(method, uri)
+        try:
+            check = self._check_cache(uri, method, headers, timings, revalidating)
+            (normalized, headers) = (check.normalized, check.headers)
+            uri = normalized.uri
+            conn_key = normalized.scheme+":"+normalized.authority
+            connection_factory = self._connection_factory(normalized.scheme, normalized.authority, connection_type)
+
+            if check.action == "fresh":
+                response = Response(check.info)
+                response.fromcache = True
+                content = check.content
+                if stream:
+                    content = ResponseStream(_body_reader(content))
+                timings.status = response.status
+                timings.total = time.time() - started
+                response.timings = timings
+                response.requested_uri = uri
+                return (response, content)
+
+            if check.action == "stale":
+                self._revalidate_in_background(uri, dict(headers), redirections, connection_type, check.cachekey)
+                return self._serve_stale(check.info, check.content, stream, timings, started)
+
+            if check.action == "send":
+                (response, content) = self._request(conn_key, connection_factory, normalized, method, body, headers, redirections, check.cachekey, stream, timings)
+            else:
+                if check.action == "redirect":
+                    (response, new_content) = self._cached_request(check.info['-x-permanent-redirect-url'], "GET", None, headers, redirections - 1, None, stream)
+                    response.previous = Response(check.info)
                     response.previous.fromcache = True
+                    response.previous.requested_uri = uri
+                    timings.add(response.timings)
+                    timings.redirects += 1
                 else:
-                    # Determine our course of action:
-                    #   Is the cached entry fresh or stale?
-                    #   Has the client requested a non-cached response?
-                    #
-                    # There seems to be three possible answers:
-                    # 1. [FRESH] Return the cache entry w/o doing a GET
-                    # 2. [STALE] Do the GET (but add in cache validators if available)
-                    # 3. [TRANSPARENT] Do a GET w/o any cache validators (Cache-Control: no-cache) on the request
-                    entry_disposition = _entry_disposition(info, headers)
-
-                    if entry_disposition == "FRESH":
-                        if not cached_value:
-                            info['status'] = '504'
-                            content = ""
-                        response = Response(info)
-                        if cached_value:
-                            response.fromcache = True
-                        return (response, content)
-
-                    if entry_disposition == "STALE":
-                        if info.has_key('etag') and not self.ignore_etag and not 'if-none-match' in headers:
-                            headers['if-none-match'] = info['etag']
-                        if info.has_key('last-modified') and not 'last-modified' in headers:
-                            headers['if-modified-since'] = info['last-modified']
-                    elif entry_disposition == "TRANSPARENT":
-                        pass
-
-                    (response, new_content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
-
-                if response.status == 304 and method == "GET":
-                    # Rewrite the cache entry with the new end-to-end headers
-                    # Take all headers that are in response
-                    # and overwrite their values in info.
-                    # unless they are hop-by-hop, or are listed in the connection header.
-
-                    for key in _get_end2end_headers(response):
-                        info[key] = response[key]
-                    merged_response = Response(info)
-                    if hasattr(response, "_stale_digest"):
-                        merged_response._stale_digest = response._stale_digest
-                    _updateCache(headers, merged_response, content, self.cache, cachekey)
-                    response = merged_response
-                    response.status = 200
-                    response.fromcache = True
-
-                elif response.status == 200:
-                    content = new_content
-                else:
-                    self.cache.delete(cachekey)
-                    content = new_content
-            else:
-                (response, content) = self._request(conn, authority, uri, request_uri, method, body, headers, redirections, cachekey)
+                    (response, error) = (None, None)
+                    try:
+                        (response, new_content) = self._request(conn_key, connection_factory, normalized, method, body, headers, redirections, check.cachekey, stream, timings)
+                    except (socket.error, httplib.HTTPException, ServerNotFoundError):
+                        if not check.stale_if_error:
+                            raise
+                        error = sys.exc_info()
+
+                    stale_content = self._stale_on_error(check, response, timings)
+                    if stale_content is not None:
+                        if response is not None and hasattr(new_content, 'close'):
+                            # an unread stream holds on to its connection
+                            new_content.close()
+                        return self._serve_stale(check.info, stale_content, stream, timings, started)
+                    if error:
+                        raise error[0], error[1], error[2]
+
+                result = self._revalidated(check, method, response, new_content, timings)
+                if result is None:
+                    result = self._request(conn_key, connection_factory, normalized, method, body, headers, redirections, check.cachekey, stream, timings)
+                (response, content) = result
         except Exception, e:
             if self.force_exception_to_status_code:
                 if isinstance(e, HttpLib2ErrorWithResponse):
@@ -1084,29 +3022,54 @@ a string that contains the response entity body.
             else:
                 raise
 
+        if stream and isinstance(content, (basestring, buffer)):
+            content = ResponseStream(_body_reader(content))
 
+        timings.status = response.status
+        timings.total = time.time() - started
+        response.timings = timings
+        if response.requested_uri is None:
+            # a response that redirected here was requested where it was
+            response.requested_uri = timings.uri
         return (response, content)
 
 
 
 class Response(dict):
-    """An object more like email.Message than httplib.HTTPResponse."""
+    """An object more like email.Message than httplib.HTTPResponse.
 
-    """Is this response from our local cache"""
-    fromcache = False
-
-    """HTTP protocol version used by server. 10 for HTTP/1.0, 11 for HTTP/1.1. """
-    version = 11
-
-    "Status code returned by server. "
-    status = 200
-
-    """Reason phrase returned by server."""
-    reason = "Ok"
-
-    previous = None
+    Its attributes live in slots, so that a response takes little more
+    than the dict of its headers. A copy, such as the one a redirect
+    keeps as 'previous', shares the responses that came before rather
+    than copying them.
+    """
+    __slots__ = ('fromcache', 'version', 'status', 'compressed_length',
+                 'decompressed_length', 'reason', 'stale', 'previous',
+                 'requested_uri', 'timings', '_stale_digest')
 
     def __init__(self, info):
+        # Is this response from our local cache
+        self.fromcache = False
+        # HTTP protocol version used by server. 10 for HTTP/1.0, 11 for HTTP/1.1.
+        self.version = 11
+        # Status code returned by server.
+        self.status = 200
+        # Size of the body before and after decompression, if it was compressed.
+        self.compressed_length = None
+        self.decompressed_length = None
+        # Reason phrase returned by server.
+        self.reason = "Ok"
+        # Is this a stale response from our local cache, served without
+        # revalidating it first
+        self.stale = False
+        # The response that redirected to this one
+        self.previous = None
+        # The absolute URI this response was requested with, which is
+        # what cookies it sets belong to, whatever Content-Location says
+        self.requested_uri = None
+        # How long each phase of the request took, a RequestTimings.
+        self.timings = None
+
         # info is either an email.Message or
         # an httplib.HTTPResponse object.
         if isinstance(info, httplib.HTTPResponse):
@@ -1131,3 +3094,27 @@ class Response(dict):
             return self
         else:
             raise AttributeError, name
+
+    @property
+    def history(self):
+        """The responses that redirected to this one, the first first"""
+        hops = []
+        hop = self.previous
+        while hop is not None:
+            hops.insert(0, hop)
+            hop = hop.previous
+        return tuple(hops)
+
+    def __copy__(self):
+        response = dict.__new__(self.__class__)
+        dict.update(response, self)
+        response.__setstate__(self.__getstate__())
+        return response
+
+    def __getstate__(self):
+        return dict([(name, getattr(self, name)) for name in Response.__slots__
+                     if hasattr(self, name)])
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
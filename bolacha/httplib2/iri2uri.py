@@ -12,6 +12,8 @@ __license__ = "MIT"
 __history__ = """
 """
 
+import bisect
+import re
 import urlparse
 
 
@@ -49,31 +51,68 @@ escape_range = [
    (0xF0000, 0xFFFFD ),
    (0x100000, 0x10FFFD)
 ]
- 
+
+# The lower bounds of escape_range, to bisect
+_escape_starts = [low for low, high in escape_range]
+
+# Matches URIs that may have something to escape
+_escaped_character = re.compile(u'[^\x00-\x9f]')
+
+def _escape(i):
+    """The escaped form of the character of code point 'i', or 'i' when
+    it is not in escape_range"""
+    index = bisect.bisect_right(_escape_starts, i) - 1
+    if index >= 0 and i <= escape_range[index][1]:
+        return u"".join([u"%%%2X" % ord(o) for o in unichr(i).encode('utf-8')])
+    return i
+
+class _EscapeTable(dict):
+    """A unicode.translate() table doing encode() on each character,
+    filled in as characters are met."""
+    def __missing__(self, i):
+        value = self[i] = _escape(i)
+        return value
+
+_escape_table = _EscapeTable()
+
 def encode(c):
-    retval = c
-    i = ord(c)
-    for low, high in escape_range:
-        if i < low:
-            break
-        if i >= low and i <= high:
-            retval = "".join(["%%%2X" % ord(o) for o in c.encode('utf-8')])
-            break
+    retval = _escape_table[ord(c)]
+    if isinstance(retval, int):
+        return c
     return retval
 
 
+def _encode_authority(authority):
+    """authority.encode('idna'), without going through the codec for
+    ASCII names, which it only checks the labels of"""
+    try:
+        encoded = authority.encode('ascii')
+    except UnicodeError:
+        return authority.encode('idna')
+    labels = encoded.split('.')
+    if labels[-1] == '':
+        # a trailing dot
+        del labels[-1]
+    for label in labels:
+        if not 0 < len(label) < 64:
+            # for the codec to complain
+            return authority.encode('idna')
+    return encoded
+
 def iri2uri(uri):
     """Convert an IRI to a URI. Note that IRIs must be 
     passed in a unicode strings. That is, do not utf-8 encode
     the IRI before passing it into the function.""" 
     if isinstance(uri ,unicode):
         (scheme, authority, path, query, fragment) = urlparse.urlsplit(uri)
-        authority = authority.encode('idna')
+        authority = _encode_authority(authority)
         # For each character in 'ucschar' or 'iprivate'
         #  1. encode as utf-8
         #  2. then %-encode each octet of that utf-8 
         uri = urlparse.urlunsplit((scheme, authority, path, query, fragment))
-        uri = "".join([encode(c) for c in uri])
+        # most URIs have nothing to escape
+        if _escaped_character.search(uri) is not None:
+            uri = uri.translate(_escape_table)
     return uri
         
 if __name__ == "__main__":
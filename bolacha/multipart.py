@@ -24,6 +24,8 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import stat
 import types
 from uuid import uuid4
 from urllib import quote_plus, urlencode
@@ -33,6 +35,9 @@ from mimetypes import guess_type
 
 BOUNDARY = uuid4().hex
 
+# How many bytes MultipartEncoder reads from a file at once
+CHUNK_SIZE = 64 * 1024
+
 def is_file(obj):
     return hasattr(obj, 'read') and callable(obj.read)
 
@@ -100,12 +105,158 @@ def guess_mime(path):
     mime, x = guess_type(path)
     return mime or 'application/octet-stream'
 
-def encode_file(boundary, key, file):
+def file_headers(boundary, key, file):
     return [
         '--' + boundary,
         'Content-Disposition: form-data; name="%s"; filename="%s"' \
             % (to_str(key), to_str(basename(file.name))),
         'Content-Type: %s' % guess_mime(file.name),
         '',
-        to_str(file.read())
     ]
+
+def encode_file(boundary, key, file):
+    return file_headers(boundary, key, file) + [to_str(file.read())]
+
+def file_size(file):
+    """
+    Returns how many bytes are left to be read from the given file,
+    or None when that can not be told without reading it.
+    """
+    try:
+        position = file.tell()
+        info = os.fstat(file.fileno())
+        if stat.S_ISREG(info.st_mode):
+            return info.st_size - position
+
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    try:
+        position = file.tell()
+        file.seek(0, 2)
+        size = file.tell() - position
+        file.seek(position)
+        return size
+
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+def reads_unicode(file):
+    """
+    Tells whether the given file, whose size is known, was opened in
+    text mode, as by codecs.open or io.open, and so reads unicode.
+    """
+    position = file.tell()
+    try:
+        return isinstance(file.read(1), unicode)
+    finally:
+        file.seek(position)
+
+class MultipartEncoder(object):
+    """
+    A lazy, file-like multipart/form-data body.
+
+    Produces exactly the same bytes as encode_multipart, but file
+    contents are only read, CHUNK_SIZE bytes at a time, while the body
+    is being sent, so memory use does not depend on upload sizes.
+    Files whose size can not be told up front are read right away, and
+    so are files that read unicode, since their size in bytes is only
+    known once encoded.
+    """
+
+    def __init__(self, boundary, data, chunk_size=CHUNK_SIZE):
+        self.boundary = boundary
+        self.chunk_size = chunk_size
+        self.parts = []
+
+        for key, value in expand_items(data):
+            if is_file(value):
+                self._add_file(key, value)
+            else:
+                self._add_string('\r\n'.join([
+                    '--' + boundary,
+                    'Content-Disposition: form-data; name="%s"' % to_str(key),
+                    '',
+                    to_str(value),
+                    '',
+                ]))
+
+        self._add_string('--' + boundary + '--\r\n')
+        self.length = sum([part[2] for part in self.parts])
+        self.rewind()
+
+    def _add_string(self, data):
+        if self.parts and self.parts[-1][0] is None:
+            data = self.parts.pop()[1] + data
+
+        self.parts.append((None, data, len(data)))
+
+    def _add_file(self, key, file):
+        lines = file_headers(self.boundary, key, file)
+        size = file_size(file)
+        if size is None or (size and reads_unicode(file)):
+            self._add_string('\r\n'.join(lines + [to_str(file.read()), '']))
+            return
+
+        self._add_string('\r\n'.join(lines + ['']))
+        if size:
+            self.parts.append((file, file.tell(), size))
+        self._add_string('\r\n')
+
+    @property
+    def is_streaming(self):
+        return any([file is not None for file, data, size in self.parts])
+
+    def __len__(self):
+        return self.length
+
+    def rewind(self):
+        """Starts over, so that the body can be sent again"""
+        self._index = 0
+        self._offset = 0
+
+    def seek(self, position, whence=0):
+        if (position, whence) != (0, 0):
+            raise IOError('MultipartEncoder can only be rewound')
+
+        self.rewind()
+
+    def _read_part(self, size):
+        file, data, length = self.parts[self._index]
+        size = min(size, length - self._offset)
+        if file is None:
+            chunk = data[self._offset:self._offset + size]
+        else:
+            if not self._offset:
+                # for file parts, data is where the file started
+                file.seek(data)
+            chunk = file.read(size)
+            if not chunk:
+                raise IOError('%r was truncated while being uploaded' % file.name)
+
+        self._offset += len(chunk)
+        if self._offset == length:
+            self._index += 1
+            self._offset = 0
+
+        return chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+
+        chunks = []
+        while size > 0 and self._index < len(self.parts):
+            chunk = self._read_part(size)
+            size -= len(chunk)
+            chunks.append(chunk)
+
+        return ''.join(chunks)
+
+    def __iter__(self):
+        self.rewind()
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
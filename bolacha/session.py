@@ -0,0 +1,212 @@
+# #!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <bolacha - http library for python, with cookies and upload support>
+# Copyright (C) <2010>  Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Stores for the state of a Bolacha session: its cookies and the
+authorizations it has learned. See Bolacha.save_session().
+
+A store is any object with save(state) and load() methods, where
+state is a dict that can be serialized as JSON. load() returns None
+when nothing was saved yet. Stores that can be shared between
+processes, like SessionFile, may also have save_changes(state, base),
+where base is the state last loaded from or saved to it by this
+process, to merge what changed since then.
+"""
+
+import errno
+import json
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['SessionFile', 'SESSION_VERSION', 'merge_states']
+
+# Sessions saved with another version are not loaded
+SESSION_VERSION = 1
+
+def _bytes(value):
+    """json gives back unicode, bolacha sends str"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_bytes(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(_bytes(key), _bytes(item)) for key, item in value.items()])
+    return value
+
+def _cookie_key(cookie):
+    return (cookie.get('domain'), cookie.get('path'), cookie.get('name'))
+
+def _authorization_key(authorization):
+    return (authorization.get('scheme'), authorization.get('host'),
+            authorization.get('path'), authorization.get('name'))
+
+def _plain(value):
+    """'value' as it reads back from JSON, so that it compares equal to
+    what was saved"""
+    return _bytes(json.loads(json.dumps(value)))
+
+def _merge(saved, state, base, key):
+    """The items of 'saved' and 'state', matched by 'key'. Without a
+    'base', those of 'state' win. With one, each side keeps what it
+    changed since 'base', including what it dropped."""
+    if base is None:
+        keys = set([key(item) for item in state])
+        return [item for item in saved if key(item) not in keys] + list(state)
+
+    saved_items = dict([(key(item), item) for item in saved])
+    state_items = dict([(key(item), item) for item in state])
+    base_items = dict([(key(item), item) for item in base])
+    merged = []
+    for item in saved:
+        k = key(item)
+        if k not in state_items and base_items.get(k) != item:
+            # added or changed by another process, not dropped here
+            merged.append(item)
+    for item in state:
+        k = key(item)
+        if base_items.get(k) != item:
+            merged.append(item)
+        elif k in saved_items:
+            # unchanged here, so whatever the file has now wins
+            merged.append(saved_items[k])
+        # else another process dropped it
+    return merged
+
+def merge_states(saved, state, base=None):
+    """
+    The session 'state' combined with one saved before it by another
+    process: cookies are matched by domain, path and name, and
+    authorizations by scheme, host, path and user name.
+
+    'base' is the state this process last loaded or saved. With it,
+    the changes each side made since then are kept, so a cookie that
+    was deleted, say by logging out, stays deleted. Without it, the
+    items of 'state' win and those it doesn't have are kept.
+    """
+    state = _plain(state)
+    if base is not None:
+        base = _plain(base)
+    merged = dict(state)
+    for name, key in (('cookies', _cookie_key),
+                      ('authorizations', _authorization_key)):
+        merged[name] = _merge(saved.get(name, []), state.get(name, []),
+                              base and base.get(name, []), key)
+    return merged
+
+class SessionFile(object):
+    """
+    Keeps a session in a JSON file that many processes can share.
+
+    The file is replaced atomically, so readers never see half of it,
+    and saving and loading take a lock on 'path'.lock, when the
+    platform has fcntl. Saving merges the session with the one in the
+    file, under that lock, so processes saving at the same time don't
+    lose each other's cookies, nor bring back those one of them
+    deleted; see merge_states(). The file is only
+    readable by its owner, since session cookies are as good as a
+    password.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def _lock(self, operation):
+        if fcntl is None:
+            return None
+        descriptor = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(descriptor, operation)
+        except:
+            os.close(descriptor)
+            raise
+        return descriptor
+
+    def _unlock(self, descriptor):
+        if descriptor is not None:
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+            os.close(descriptor)
+
+    def _read(self):
+        """The saved state, or None"""
+        try:
+            input = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            data = input.read()
+        finally:
+            input.close()
+
+        try:
+            return _bytes(json.loads(data))
+        except ValueError:
+            # not worth failing over, the session is made again
+            return None
+
+    def save(self, state):
+        self.save_changes(state, None)
+
+    def save_changes(self, state, base):
+        """Saves 'state', merged with the one in the file as
+        merge_states() does, with 'base' if not None"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        lock = self._lock(fcntl and fcntl.LOCK_EX)
+        try:
+            saved = self._read()
+            if saved and saved.get('version') == state.get('version'):
+                state = merge_states(saved, state, base)
+            data = json.dumps(state, separators=(',', ':'), sort_keys=True)
+            # mkstemp creates the file with mode 0600
+            descriptor, temporary = tempfile.mkstemp(dir=directory,
+                                                     prefix='.session-')
+            try:
+                output = os.fdopen(descriptor, 'wb')
+                try:
+                    output.write(data)
+                    output.flush()
+                    os.fsync(output.fileno())
+                finally:
+                    output.close()
+                os.rename(temporary, self.path)
+            except:
+                os.unlink(temporary)
+                raise
+        finally:
+            self._unlock(lock)
+
+    def load(self):
+        lock = self._lock(fcntl and fcntl.LOCK_SH)
+        try:
+            return self._read()
+        finally:
+            self._unlock(lock)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import base64
+import httplib
+import socket
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from nose.tools import assert_equals
+from utils import assert_raises
+
+from bolacha.asynchronous import AsyncBolacha, ResponseParser
+from bolacha.httplib2 import HttpLib2Error, MemoryCache, ServerNotFoundError
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # keep-alive connections are dropped after this many idle seconds
+    timeout = 5
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200, headers=()):
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        Handler.requests.append(self.path)
+        if self.path == '/redirect':
+            self.reply('', 302, [('Location', '/')])
+        elif self.path == '/cookie':
+            self.reply('', headers=[('Set-Cookie', 'name=value')])
+        elif self.path == '/echo-cookie':
+            self.reply(self.headers.get('cookie', ''))
+        elif self.path == '/cached':
+            self.reply('cached', headers=[('Cache-Control', 'max-age=300'),
+                                          ('Date', self.date_time_string())])
+        elif self.path == '/slow':
+            time.sleep(0.5)
+            self.reply('slow')
+        elif self.path == '/close':
+            # closes a kept-alive connection without telling the client
+            self.reply('closed')
+            self.close_connection = 1
+        elif self.path in ('/swr', '/flaky'):
+            # fresh for no time, then stale for a minute; /flaky fails
+            # after its first response
+            if self.path == '/flaky' and self.path in Handler.requests[:-1]:
+                self.reply('down', 500)
+                return
+            window = {'/swr': 'stale-while-revalidate', '/flaky': 'stale-if-error'}[self.path]
+            self.reply('%s %d' % (self.path, Handler.requests.count(self.path)),
+                       headers=[('Cache-Control', 'max-age=0, %s=60' % window),
+                                ('Date', self.date_time_string())])
+        elif self.path == '/host':
+            self.reply(', '.join(self.headers.getheaders('host')))
+        elif self.path == '/no-store':
+            self.reply('hit %d' % Handler.requests.count(self.path),
+                       headers=[('Cache-Control', 'no-store')])
+        elif self.path == '/protected':
+            if self.headers.get('authorization') != 'Basic %s' % base64.b64encode('joe:secret'):
+                self.reply('', 401, [('WWW-Authenticate', 'Basic realm="test"')])
+            else:
+                self.reply('welcome')
+        else:
+            self.reply('hello %s' % self.path)
+
+    def do_POST(self):
+        length = int(self.headers['content-length'])
+        self.reply(self.rfile.read(length))
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, client_address):
+        # clients going away mid-request is part of the tests
+        pass
+
+server = None
+base = None
+browsers = []
+
+def make_browser(**kw):
+    browser = AsyncBolacha(**kw)
+    browsers.append(browser)
+    return browser
+
+def setup():
+    global server, base
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+
+def teardown():
+    for browser in browsers:
+        browser.close()
+    server.shutdown()
+    server.server_close()
+
+def test_parser_reads_content_length_body_in_pieces():
+    parser = ResponseParser('GET')
+    for piece in ['HTTP/1.1 200 OK\r\nContent-', 'Length: 5\r\n\r\nhel', 'lo']:
+        parser.feed(piece)
+    assert parser.done
+    assert_equals(parser.response().status, 200)
+    assert_equals(parser.content(), 'hello')
+    assert not parser.will_close
+
+def test_parser_reads_chunked_body():
+    parser = ResponseParser('GET')
+    parser.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                '3\r\nhel\r\n2;ext=1\r\nlo\r\n0\r\nX-Trailer: 1\r\n\r\n')
+    assert parser.done
+    assert_equals(parser.content(), 'hello')
+
+def test_parser_reads_until_close_without_length():
+    parser = ResponseParser('GET')
+    parser.feed('HTTP/1.0 200 OK\r\n\r\nhello')
+    assert not parser.done
+    assert parser.eof()
+    assert_equals(parser.content(), 'hello')
+    assert parser.will_close
+
+def test_parser_skips_interim_responses_and_merges_headers():
+    parser = ResponseParser('GET')
+    parser.feed('HTTP/1.1 100 Continue\r\n\r\n'
+                'HTTP/1.1 200 OK\r\nSet-Cookie: a=1\r\nSet-Cookie: b=2\r\n'
+                'Content-Length: 0\r\n\r\n')
+    assert parser.done
+    assert_equals(parser.response()['set-cookie'], 'a=1, b=2')
+
+def test_parser_has_no_body_for_head():
+    parser = ResponseParser('HEAD')
+    parser.feed('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n')
+    assert parser.done
+    assert_equals(parser.content(), '')
+
+def test_parser_rejects_garbage():
+    parser = ResponseParser('GET')
+    assert_raises(httplib.BadStatusLine, parser.feed, 'garbage\r\n')
+
+def test_async_requests_run_concurrently():
+    browser = make_browser()
+    started = time.time()
+    requests = [browser.get(base + '/slow') for i in range(4)]
+    assert_equals([request.result()[1] for request in requests], ['slow'] * 4)
+    assert time.time() - started < 1.5
+
+def test_async_queues_requests_over_connection_limit():
+    browser = make_browser(max_connections_per_host=1)
+    requests = [browser.get(base + '/queued/%d' % i) for i in range(3)]
+    browser.run()
+    assert_equals([request.result()[1] for request in requests],
+                  ['hello /queued/0', 'hello /queued/1', 'hello /queued/2'])
+    assert_equals(len(browser._map), 1)
+
+def test_async_follows_redirects():
+    browser = make_browser()
+    response, content = browser.get(base + '/redirect').result()
+    assert_equals(content, 'hello /')
+    assert_equals(response.previous.status, 302)
+
+def test_async_keeps_cookies():
+    browser = make_browser()
+    browser.get(base + '/cookie').result()
+    response, content = browser.get(base + '/echo-cookie').result()
+    assert_equals(content, 'name=value')
+
+def test_async_posts_dicts():
+    browser = make_browser()
+    response, content = browser.post(base + '/', body={'name': 'value'}).result()
+    assert_equals(content, 'name=value')
+
+def test_async_answers_fresh_requests_from_cache():
+    browser = make_browser(cache=MemoryCache())
+    first, content = browser.get(base + '/cached').result()
+    Handler.requests = []
+    second, content = browser.get(base + '/cached').result()
+    assert not first.fromcache
+    assert second.fromcache
+    assert_equals(content, 'cached')
+    assert_equals(Handler.requests, [])
+
+def test_async_retries_on_connection_closed_by_server():
+    browser = make_browser()
+    browser.get(base + '/close').result()
+    # let the server close the kept-alive connection
+    time.sleep(0.1)
+    response, content = browser.get(base + '/again').result()
+    assert_equals(content, 'hello /again')
+
+def test_async_times_out():
+    browser = make_browser(timeout=0.1)
+    request = browser.get(base + '/slow')
+    assert isinstance(request.exception(), socket.timeout)
+    assert_equals(browser._map, {})
+
+def test_async_map_keeps_order_and_captures_exceptions():
+    browser = make_browser()
+    results = browser.map([base + '/slow', base + '/fast',
+                           ('ftp://nowhere', 'GET'), 'not an url'],
+                          concurrency=2)
+    assert_equals(results[0][1], 'slow')
+    assert_equals(results[1][1], 'hello /fast')
+    assert isinstance(results[2], HttpLib2Error)
+    assert isinstance(results[3], Exception)
+
+def test_async_responses_have_timings():
+    browser = make_browser()
+    seen = []
+    browser.http.add_timing_hook(seen.append)
+    response, content = browser.get(base + '/redirect').result()
+    assert_equals(seen, [response.timings])
+    assert_equals(response.timings.redirects, 1)
+    assert response.timings.total >= response.timings.ttfb > 0
+
+def test_async_streams_content():
+    browser = make_browser()
+    response, content = browser.get(base + '/streamed', stream=True).result()
+    assert_equals(content.read(), 'hello /streamed')
+
+def test_async_resolves_unknown_hosts_off_the_loop():
+    browser = make_browser()
+    port = server.server_address[1]
+    response, content = browser.get('http://localhost:%d/resolved' % port).result()
+    assert_equals(content, 'hello /resolved')
+    assert_equals(browser.http.dns_cache.stats()['misses'], 1)
+    assert_equals(browser._resolving, set())
+
+def test_async_fails_on_hosts_that_do_not_resolve():
+    browser = make_browser()
+    port = server.server_address[1]
+    browser.http.dns_cache._store(('nowhere.test', port, 0, socket.SOCK_STREAM, 0, 0),
+                                  time.time() + 60, socket.gaierror(-2, 'Name or service not known'))
+    request = browser.get('http://nowhere.test:%d/' % port)
+    assert isinstance(request.exception(), ServerNotFoundError)
+
+def test_async_tries_every_address_of_a_host():
+    browser = make_browser()
+    port = server.server_address[1]
+    refusing = socket.socket()
+    refusing.bind(('127.0.0.1', 0))
+    dead_port = refusing.getsockname()[1]
+    refusing.close()
+    addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', dead_port)),
+                 (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+    browser.http.dns_cache._store(('twice.test', port, 0, socket.SOCK_STREAM, 0, 0),
+                                  time.time() + 60, addresses)
+    response, content = browser.get('http://twice.test:%d/second' % port).result()
+    assert_equals(content, 'hello /second')
+
+def test_async_serves_stale_while_revalidating():
+    browser = make_browser(cache=MemoryCache())
+    Handler.requests = []
+    browser.get(base + '/swr').result()
+    response, content = browser.get(base + '/swr').result()
+    assert response.stale
+    assert_equals(content, '/swr 1')
+    browser.run()
+    assert_equals(Handler.requests, ['/swr', '/swr'])
+    response, content = browser.get(base + '/swr').result()
+    assert_equals(content, '/swr 2')
+
+def test_async_serves_stale_if_error():
+    browser = make_browser(cache=MemoryCache())
+    Handler.requests = []
+    browser.get(base + '/flaky').result()
+    response, content = browser.get(base + '/flaky').result()
+    assert response.stale
+    assert_equals(content, '/flaky 1')
+    assert_equals(Handler.requests, ['/flaky', '/flaky'])
+
+def test_async_answers_authentication_challenges():
+    browser = make_browser()
+    browser.http.add_credentials('joe', 'secret')
+    response, content = browser.get(base + '/protected').result()
+    assert_equals(content, 'welcome')
+    assert_equals(response.timings.auth_retries, 1)
+    # later requests are authorized up front
+    response, content = browser.get(base + '/protected').result()
+    assert_equals(response.timings.auth_retries, 0)
+
+def test_async_coalesces_only_what_may_be_shared():
+    browser = make_browser(cache=MemoryCache())
+    Handler.requests = []
+    requests = [browser.get(base + '/cached-once') for number in range(3)]
+    assert_equals([request.result()[1] for request in requests], ['hello /cached-once'] * 3)
+    assert_equals(Handler.requests, ['/cached-once'])
+
+    requests = [browser.get(base + '/no-store') for number in range(2)]
+    assert_equals(sorted([request.result()[1] for request in requests]), ['hit 1', 'hit 2'])
+
+def test_async_sends_the_host_header_once():
+    browser = make_browser()
+    response, content = browser.get(base + '/host').result()
+    assert_equals(content, base[len('http://'):])
+    response, content = browser.get(base + '/host', headers={'Host': 'example.com'}).result()
+    assert_equals(content, 'example.com')
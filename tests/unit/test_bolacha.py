@@ -17,13 +17,15 @@
 # License along with this program; if not, write to the
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
+import time
 import types
+import zlib
 from mox import Mox
 from nose.tools import assert_equals
 from utils import assert_raises
 
-from bolacha import Bolacha, BOUNDARY
-from bolacha.httplib2 import Http
+from bolacha import Bolacha, BOUNDARY, RequestCompression
+from bolacha.httplib2 import Http, MemoryCache, Response
 
 base_header = {'Content-type': 'application/x-www-form-urlencoded'}
 def prepare_header(h):
@@ -117,6 +119,22 @@ def test_request_calls_http_request():
                                                              response_body))
     mocker.VerifyAll()
 
+def test_request_with_stream_asks_http_for_a_stream():
+    mocker = Mox()
+
+    klass_mock = mocker.CreateMockAnything()
+    http_mock = mocker.CreateMockAnything()
+    klass_mock().AndReturn(http_mock)
+
+    http_mock.request('http://somewhere.com', 'GET', '', {}, stream=True). \
+        AndReturn(({}, 'a stream'))
+
+    mocker.ReplayAll()
+
+    b = Bolacha(klass_mock)
+    assert_equals(b.get('http://somewhere.com', stream=True), ({}, 'a stream'))
+    mocker.VerifyAll()
+
 def test_request_fails_with_headers_non_dict():
     b = Bolacha()
     assert_raises(TypeError, b.request, 'http://somewhere', 'GET', headers=5,
@@ -223,14 +241,14 @@ def test_request_keep_sending_last_cookies():
 
     http_mock = mocker.CreateMockAnything()
 
-    response_headers1 = {'set-cookie': 5}
+    response_headers1 = {'set-cookie': 'count=5'}
     response_headers2 = {'good': 10}
-    response_headers3 = {'set-cookie': 20}
+    response_headers3 = {'set-cookie': 'count=20'}
 
     request_headers1 = {}
-    request_headers2 = {'Cookie': 5}
-    request_headers3 = {'Cookie': 5}
-    request_headers4 = {'Cookie': 20}
+    request_headers2 = {'Cookie': 'count=5'}
+    request_headers3 = {'Cookie': 'count=5'}
+    request_headers4 = {'Cookie': 'count=20'}
 
     # 1st request
     http_mock.request('http://somewhere.com', 'GET',
@@ -265,16 +283,16 @@ def test_request_handle_cookies():
 
     http_mock = mocker.CreateMockAnything()
     request_headers1 = {}
-    response_headers1 = {'set-cookie': 'Will log in'}
+    response_headers1 = {'set-cookie': 'state=login'}
 
-    request_headers2 = {'Cookie': 'Will log in'}
-    response_headers2 = {'set-cookie': 'Already logged as root'}
+    request_headers2 = {'Cookie': 'state=login'}
+    response_headers2 = {'set-cookie': 'user=root; Path=/, state=logged'}
 
-    request_headers3 = {'Cookie': 'Already logged as root'}
-    response_headers3 = {'set-cookie': 'Just logged out'}
+    request_headers3 = {'Cookie': 'state=logged; user=root'}
+    response_headers3 = {'set-cookie': 'user=; Max-Age=0, state=logout'}
 
-    request_headers4 = {'Cookie': 'Just logged out'}
-    response_headers4 = {'set-cookie': 'Will log in'}
+    request_headers4 = {'Cookie': 'state=logout'}
+    response_headers4 = {'set-cookie': 'state=login'}
 
     http_mock.request('http://somewhere.com', 'GET',
                       '', request_headers1). \
@@ -300,6 +318,71 @@ def test_request_handle_cookies():
 
     mocker.VerifyAll()
 
+def test_request_keeps_cookies_to_their_hosts():
+    mocker = Mox()
+
+    http_mock = mocker.CreateMockAnything()
+    http_mock.request('http://www.somewhere.com/login', 'POST', '', {}). \
+        AndReturn(({'set-cookie': 'site=1; Domain=somewhere.com, '
+                    'host=2; Expires=Wed, 09 Jun 2100 10:18:14 GMT'}, ''))
+    http_mock.request('http://static.somewhere.com/', 'GET', '',
+                      {'Cookie': 'site=1'}).AndReturn(({}, ''))
+    http_mock.request('http://www.somewhere.com/', 'GET', '',
+                      {'Cookie': 'site=1; host=2'}).AndReturn(({}, ''))
+    http_mock.request('http://elsewhere.com/', 'GET', '', {}). \
+        AndReturn(({}, ''))
+
+    mocker.ReplayAll()
+    bol = Bolacha()
+    bol.http = http_mock
+    bol.request('http://www.somewhere.com/login', 'POST')
+    bol.request('http://static.somewhere.com/', 'GET')
+    bol.request('http://www.somewhere.com/', 'GET')
+    bol.request('http://elsewhere.com/', 'GET')
+
+    mocker.VerifyAll()
+
+def test_request_ignores_content_location_for_cookies():
+    mocker = Mox()
+
+    http_mock = mocker.CreateMockAnything()
+    evil = Response({'set-cookie': 'sid=evil',
+                     'content-location': 'http://bank.example.com/'})
+    evil.requested_uri = 'http://evil.example.org/page'
+    http_mock.request('http://evil.example.org/page', 'GET', '', {}). \
+        AndReturn((evil, ''))
+
+    mocker.ReplayAll()
+    bol = Bolacha()
+    bol.http = http_mock
+    bol.request('http://evil.example.org/page', 'GET')
+    mocker.VerifyAll()
+
+    assert not bol.cookies.header_for('http://bank.example.com/account')
+    assert_equals(bol.cookies.header_for('http://evil.example.org/'), 'sid=evil')
+
+def test_request_keeps_cookies_of_redirects_to_their_hosts():
+    mocker = Mox()
+
+    http_mock = mocker.CreateMockAnything()
+    redirect = Response({'status': '302', 'set-cookie': 'from=login',
+                         'location': 'http://www.other.com/'})
+    redirect.requested_uri = 'http://login.somewhere.com/'
+    final = Response({'set-cookie': 'to=home'})
+    final.requested_uri = 'http://www.other.com/'
+    final.previous = redirect
+    http_mock.request('http://login.somewhere.com/', 'GET', '', {}). \
+        AndReturn((final, ''))
+
+    mocker.ReplayAll()
+    bol = Bolacha()
+    bol.http = http_mock
+    bol.request('http://login.somewhere.com/', 'GET')
+    mocker.VerifyAll()
+
+    assert_equals(bol.cookies.header_for('http://login.somewhere.com/'), 'from=login')
+    assert_equals(bol.cookies.header_for('http://www.other.com/'), 'to=home')
+
 def test_request_when_persistent():
     mocker = Mox()
 
@@ -380,6 +463,21 @@ def test_when_body_dict_and_content_type_is_specified():
     b.request('http://somewhere.com', 'GET', body={}, headers=request_headers)
     mocker.VerifyAll()
 
+def test_request_compresses_bodies_when_asked_to():
+    sent = []
+    class FakeHttp(object):
+        def request(self, url, method, body, headers):
+            sent.append((body, headers))
+            return {}, ''
+
+    b = Bolacha(FakeHttp, compression=RequestCompression(min_size=10))
+    b.request('http://somewhere.com', 'POST', body={'name': 'value' * 10})
+
+    body, headers = sent[0]
+    assert_equals(zlib.decompress(body, 16 + zlib.MAX_WBITS), 'name=' + 'value' * 10)
+    assert_equals(headers['content-encoding'], 'gzip')
+    assert_equals(headers['content-length'], str(len(body)))
+
 def test_post_shortcut():
     mocker = Mox()
 
@@ -523,3 +621,49 @@ def test_request_with_multiple_files_with_same_name_will_upload_multipart():
     b = Bolacha(klass_mock)
     b.request('http://somewhere.com', 'POST', body=body, headers=request_headers)
     mocker.VerifyAll()
+
+class SlowHttp(object):
+    def request(self, url, method, body, headers):
+        if url == 'http://fails.com':
+            raise ValueError('no way')
+        time.sleep(0.01 * (url.count('slow')))
+        return {'set-cookie': 'from=%s' % url}, '%s %s' % (method, url)
+
+class CoalescingHttp(Http):
+    coalesced = []
+    def _coalesced_request(self, uri, method, headers, redirections, connection_type):
+        CoalescingHttp.coalesced.append((method, uri))
+        return Response({'status': '200'}), ''
+
+def test_bolacha_get_and_head_are_coalesced():
+    CoalescingHttp.coalesced = []
+    b = Bolacha(CoalescingHttp, cache=MemoryCache())
+    b.get('http://somewhere.com/page')
+    b.head('http://somewhere.com/page')
+    assert_equals(CoalescingHttp.coalesced, [('GET', 'http://somewhere.com/page'),
+                                             ('HEAD', 'http://somewhere.com/page')])
+
+def test_map_keeps_order_and_captures_exceptions():
+    b = Bolacha(SlowHttp)
+    results = b.map(['http://slow.slow.com',
+                     ('http://fast.com', 'POST'),
+                     'http://fails.com',
+                     {'url': 'http://slow.com', 'method': 'PUT'}],
+                    concurrency=3)
+
+    assert_equals(results[0], ({'set-cookie': 'from=http://slow.slow.com'},
+                               'GET http://slow.slow.com'))
+    assert_equals(results[1][1], 'POST http://fast.com')
+    assert isinstance(results[2], ValueError)
+    assert_equals(results[3][1], 'PUT http://slow.com')
+    assert b.cookies.header_for('http://slow.com').startswith('from=')
+    assert b.headers['set-cookie'].startswith('from=')
+
+def test_map_of_nothing():
+    b = Bolacha(SlowHttp)
+    assert_equals(b.map([]), [])
+
+def test_map_needs_at_least_one_thread():
+    b = Bolacha(SlowHttp)
+    assert_raises(ValueError, b.map, ['http://fast.com'], concurrency=0)
+    assert_raises(ValueError, b.map, ['http://fast.com'], concurrency=-1)
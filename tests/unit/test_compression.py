@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import zlib
+from StringIO import StringIO
+from nose.tools import assert_equals
+
+from bolacha.compression import RequestCompression, GzipStream
+from bolacha.multipart import MultipartEncoder
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def unchunk(data):
+    body = []
+    while True:
+        size, data = data.split('\r\n', 1)
+        size = int(size, 16)
+        if not size:
+            assert_equals(data, '\r\n')
+            return ''.join(body)
+        body.append(data[:size])
+        assert_equals(data[size:size + 2], '\r\n')
+        data = data[size + 2:]
+
+def test_compresses_bodies_in_memory():
+    body = '{"value": 1}' * 1000
+    headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+    compressed, sent = RequestCompression().compress(body, headers)
+
+    assert_equals(gunzip(compressed), body)
+    assert_equals(sent, {'Content-Type': 'application/json', 'content-encoding': 'gzip',
+                         'content-length': str(len(compressed))})
+    # what was given is left as it was
+    assert_equals(headers['Content-Length'], str(len(body)))
+
+def test_leaves_small_incompressible_or_encoded_bodies_alone():
+    compression = RequestCompression(min_size=100)
+    for body, headers in [('x' * 99, {'content-type': 'text/plain'}),
+                          ('x' * 1000, {'content-type': 'image/png'}),
+                          ('x' * 1000, {}),
+                          ('x' * 1000, {'content-type': 'text/plain', 'Content-Encoding': 'br'})]:
+        assert_equals(compression.compress(body, headers), (body, headers))
+
+    body, headers = RequestCompression(content_types=None).compress('x' * 2000, {})
+    assert_equals(gunzip(body), 'x' * 2000)
+
+def test_compresses_streamed_bodies_while_they_are_read():
+    upload = StringIO('file contents ' * 10000)
+    upload.name = 'upload.txt'
+    encoder = MultipartEncoder('boundary', {'file': upload, 'name': 'value'})
+    expected = encoder.read()
+    encoder.rewind()
+
+    body, headers = RequestCompression(level=1).compress(
+        encoder, {'Content-type': 'multipart/form-data; boundary=boundary',
+                  'content-length': str(len(encoder))})
+    assert isinstance(body, GzipStream)
+    assert_equals(headers['transfer-encoding'], 'chunked')
+    assert 'content-length' not in headers
+
+    chunks = []
+    while True:
+        chunk = body.read(1000)
+        if not chunk:
+            break
+        assert len(chunk) <= 1000
+        chunks.append(chunk)
+    assert_equals(gunzip(unchunk(''.join(chunks))), expected)
+    assert_equals(body.bytes_in, len(expected))
+
+    # sending it again, after a redirect or a dropped connection
+    body.rewind()
+    assert_equals(gunzip(unchunk(body.read())), expected)
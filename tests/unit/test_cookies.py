@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+from nose.tools import assert_equals
+
+from bolacha.cookies import CookieJar, parse_set_cookie
+from bolacha.cookies import registrable_domain, split_set_cookie
+
+def test_registrable_domain():
+    assert_equals(registrable_domain('www.Example.com'), 'example.com')
+    assert_equals(registrable_domain('a.b.example.co.uk'), 'example.co.uk')
+    assert_equals(registrable_domain('localhost'), 'localhost')
+    assert_equals(registrable_domain('127.0.0.1'), '127.0.0.1')
+
+def test_split_merged_set_cookie_headers():
+    header = 'a=1; Expires=Wed, 09 Jun 2100 10:18:14 GMT; Path=/, b=2,c=3; Secure'
+    assert_equals(split_set_cookie(header),
+                  ['a=1; Expires=Wed, 09 Jun 2100 10:18:14 GMT; Path=/', 'b=2',
+                   'c=3; Secure'])
+
+def test_parse_set_cookie_attributes():
+    cookie = parse_set_cookie('sid=abc; Domain=.Example.com; Path=/app; '
+                              'Max-Age=60; Expires=Wed, 09 Jun 2100 10:18:14 GMT; '
+                              'Secure; HttpOnly', 'www.example.com', now=1000)
+    assert_equals((cookie.name, cookie.value), ('sid', 'abc'))
+    assert_equals((cookie.domain, cookie.path), ('example.com', '/app'))
+    assert_equals(cookie.expires, 1060)
+    assert cookie.secure and cookie.httponly and not cookie.host_only
+
+def test_parse_set_cookie_defaults_and_refusals():
+    cookie = parse_set_cookie('sid=abc', 'www.example.com', '/app/page')
+    assert_equals((cookie.domain, cookie.path), ('www.example.com', '/app'))
+    assert cookie.host_only
+    assert_equals(parse_set_cookie('no value', 'example.com'), None)
+    assert_equals(parse_set_cookie('a=1; Domain=other.com', 'example.com'), None)
+    assert_equals(parse_set_cookie('a=1; Domain=co.uk', 'example.co.uk'), None)
+    assert parse_set_cookie('a=1; Domain=localhost', 'localhost').host_only
+
+def test_jar_matches_domain_path_and_scheme():
+    jar = CookieJar()
+    jar.set_from_header('https://www.example.com/app/login',
+                        'site=1; Domain=example.com; Path=/, '
+                        'app=2; Path=/app, secret=3; Secure; Path=/')
+    assert_equals(jar.header_for('https://www.example.com/app/x'),
+                  'app=2; site=1; secret=3')
+    assert_equals(jar.header_for('http://www.example.com/application'),
+                  'site=1')
+    assert_equals(jar.header_for('http://static.example.com/'), 'site=1')
+    assert_equals(jar.header_for('http://example.org/'), None)
+    assert_equals(len(jar), 3)
+
+def test_jar_replaces_deletes_and_expires_cookies():
+    jar = CookieJar()
+    jar.set_from_header('http://example.com/', 'a=1, b=2; Max-Age=10, c=3', now=0)
+    assert_equals(jar.header_for('http://example.com/', now=5), 'a=1; b=2; c=3')
+
+    jar.set_from_header('http://example.com/', 'a=changed, c=; Max-Age=0', now=5)
+    assert_equals(jar.header_for('http://example.com/', now=5), 'a=changed; b=2')
+    assert_equals(jar.header_for('http://example.com/', now=10), 'a=changed')
+    assert_equals(jar._expiry, [])
+
+def test_jar_caches_headers_until_cookies_change():
+    jar = CookieJar()
+    jar.set_from_header('http://example.com/', 'a=1')
+    assert_equals(jar.header_for('http://example.com/'), 'a=1')
+    assert_equals(jar._headers['example.com'], {('example.com', '/', False): 'a=1'})
+    jar.set_from_header('http://www.example.com/', 'b=2')
+    assert 'example.com' not in jar._headers
+    jar.clear('example.com')
+    assert_equals(jar.header_for('http://example.com/'), None)
+
+def test_jar_keeps_cached_header_when_cookies_come_again():
+    jar = CookieJar()
+    for number in range(3000):
+        jar.set_from_header('http://example.com/', 'a=1; Max-Age=60, b=2',
+                            now=number)
+        assert number == 0 or 'example.com' in jar._headers
+        assert_equals(jar.header_for('http://example.com/', now=number), 'a=1; b=2')
+    assert len(jar._expiry) < 2048
@@ -0,0 +1,1341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+from mox import Mox
+import os
+import copy
+import pickle
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import email.Utils
+import zlib
+import gzip
+import httplib
+from StringIO import StringIO
+from nose.tools import assert_equals
+from utils import assert_raises
+
+from bolacha import httplib2
+from bolacha.httplib2 import ConnectionPool, PoolExhaustedError
+from bolacha.httplib2 import HTTPConnectionWithTimeout
+from bolacha.multipart import MultipartEncoder
+
+class FakeConnection(object):
+    closed = False
+    def close(self):
+        self.closed = True
+
+def test_pool_reuses_released_connection():
+    pool = ConnectionPool()
+    conn = pool.acquire('http:somewhere.com', FakeConnection)
+    pool.release('http:somewhere.com', conn)
+
+    assert pool.acquire('http:somewhere.com', FakeConnection) is conn
+    assert_equals(len(pool), 1)
+
+def test_pool_creates_one_connection_per_concurrent_checkout():
+    pool = ConnectionPool()
+    conn1 = pool.acquire('http:somewhere.com', FakeConnection)
+    conn2 = pool.acquire('http:somewhere.com', FakeConnection)
+
+    assert conn1 is not conn2
+    assert_equals(len(pool), 2)
+
+def test_pool_fails_when_host_is_full_and_not_blocking():
+    pool = ConnectionPool(max_per_host=1, block=False)
+    pool.acquire('http:somewhere.com', FakeConnection)
+    assert_raises(PoolExhaustedError, pool.acquire,
+                  'http:somewhere.com', FakeConnection,
+                  exc_pattern=r'No connection available for http:somewhere.com')
+
+def test_pool_times_out_waiting_for_a_connection():
+    pool = ConnectionPool(max_per_host=1, timeout=0.01)
+    pool.acquire('http:somewhere.com', FakeConnection)
+    assert_raises(PoolExhaustedError, pool.acquire,
+                  'http:somewhere.com', FakeConnection,
+                  exc_pattern=r'Timed out waiting for a connection')
+
+def test_pool_blocks_until_connection_is_released():
+    pool = ConnectionPool(max_per_host=1)
+    conn = pool.acquire('http:somewhere.com', FakeConnection)
+    got = []
+
+    def checkout():
+        got.append(pool.acquire('http:somewhere.com', FakeConnection))
+
+    thread = threading.Thread(target=checkout)
+    thread.start()
+    pool.release('http:somewhere.com', conn)
+    thread.join(1)
+
+    assert_equals(got, [conn])
+
+def _wait_for_waiters(pool, count):
+    deadline = time.time() + 1
+    while len(pool._lock._Condition__waiters) < count:
+        assert time.time() < deadline, 'waiters never blocked'
+        time.sleep(0.001)
+
+def test_pool_release_wakes_the_waiter_for_that_host():
+    pool = ConnectionPool(max_per_host=1, timeout=2)
+    conn = pool.acquire('http:somewhere.com', FakeConnection)
+    other = pool.acquire('http:elsewhere.com', FakeConnection)
+    got = {}
+
+    def checkout(key):
+        got[key] = pool.acquire(key, FakeConnection)
+
+    # the waiter for the other host blocks first, so a lone notify()
+    # would wake it instead of the one the released connection is for
+    threads = []
+    for number, key in enumerate(['http:elsewhere.com',
+                                  'http:somewhere.com']):
+        threads.append(threading.Thread(target=checkout, args=(key,)))
+        threads[-1].start()
+        _wait_for_waiters(pool, number + 1)
+
+    pool.release('http:somewhere.com', conn)
+    threads[1].join(1)
+    assert_equals(got, {'http:somewhere.com': conn})
+
+    pool.release('http:elsewhere.com', other)
+    threads[0].join(1)
+    assert got['http:elsewhere.com'] is other
+
+def test_pool_evicts_idle_connection_of_other_host_when_full():
+    pool = ConnectionPool(max_connections=1, block=False)
+    conn = pool.acquire('http:somewhere.com', FakeConnection)
+    pool.release('http:somewhere.com', conn)
+
+    other = pool.acquire('http:elsewhere.com', FakeConnection)
+
+    assert other is not conn
+    assert conn.closed
+    assert 'http:somewhere.com' not in pool
+    assert_equals(len(pool), 1)
+
+def test_pool_discard_frees_a_slot():
+    pool = ConnectionPool(max_per_host=1, block=False)
+    conn = pool.acquire('http:somewhere.com', FakeConnection)
+    pool.discard('http:somewhere.com', conn)
+
+    assert conn.closed
+    assert pool.acquire('http:somewhere.com', FakeConnection) is not conn
+
+def _send_through_socketpair(data):
+    conn = HTTPConnectionWithTimeout('somewhere.com')
+    conn.sock, peer = socket.socketpair()
+    conn.send(data)
+    conn.close()
+
+    received = []
+    while True:
+        chunk = peer.recv(65536)
+        if not chunk:
+            break
+        received.append(chunk)
+    return ''.join(received)
+
+def test_send_hands_file_parts_to_sendfile():
+    calls = []
+    def fake_sendfile(out, fileno, offset, count):
+        calls.append((offset, count))
+        os.lseek(fileno, offset, 0)
+        return os.write(out, os.read(fileno, min(count, 1000)))
+
+    upload = tempfile.NamedTemporaryFile()
+    upload.write('0123456789' * 500)
+    upload.seek(10)
+    encoder = MultipartEncoder('b', {'file': upload, 'name': 'foo'})
+
+    old_sendfile = httplib2.sendfile
+    httplib2.sendfile = fake_sendfile
+    try:
+        got = _send_through_socketpair(encoder)
+    finally:
+        httplib2.sendfile = old_sendfile
+
+    encoder.rewind()
+    assert_equals(got, encoder.read())
+    assert_equals(calls[0], (10, 4990))
+    assert_equals(len(calls), 5)
+
+def test_send_copies_file_parts_without_fileno():
+    def fake_sendfile(out, fileno, offset, count):
+        assert False, 'sendfile should not be used'
+
+    upload = StringIO('0123456789' * 500)
+    upload.name = '/path/to/file'
+    encoder = MultipartEncoder('b', {'file': upload})
+
+    old_sendfile = httplib2.sendfile
+    httplib2.sendfile = fake_sendfile
+    try:
+        got = _send_through_socketpair(encoder)
+    finally:
+        httplib2.sendfile = old_sendfile
+
+    encoder.rewind()
+    assert_equals(got, encoder.read())
+
+def test_memory_cache_get_set_delete():
+    cache = httplib2.MemoryCache()
+    cache.set('http://somewhere.com/', 'entry')
+
+    assert_equals(cache.get('http://somewhere.com/'), 'entry')
+    assert_equals(cache.get('http://elsewhere.com/'), None)
+
+    cache.delete('http://somewhere.com/')
+    assert_equals(cache.get('http://somewhere.com/'), None)
+    assert_equals(cache.size, 0)
+
+def test_memory_cache_evicts_least_recently_used_by_size():
+    cache = httplib2.MemoryCache(max_bytes=10)
+    cache.set('a', '1234')
+    cache.set('b', '1234')
+    cache.get('a')
+    cache.set('c', '1234')
+
+    assert_equals(cache.get('b'), None)
+    assert_equals(cache.get('a'), '1234')
+    assert_equals(cache.size, 8)
+
+def test_memory_cache_evicts_by_entry_count():
+    cache = httplib2.MemoryCache(max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.set('c', '3')
+
+    assert_equals(len(cache), 2)
+    assert_equals(cache.get('a'), None)
+
+def test_memory_cache_evicts_least_frequently_used():
+    cache = httplib2.MemoryCache(max_entries=2, policy='lfu')
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    cache.set('c', '3')
+
+    assert_equals(cache.get('b'), None)
+    assert_equals(cache.get('a'), '1')
+
+def test_memory_cache_skips_entries_bigger_than_itself():
+    cache = httplib2.MemoryCache(max_bytes=3)
+    cache.set('a', '1234')
+
+    assert_equals(cache.get('a'), None)
+    assert_equals(cache.size, 0)
+
+def test_response_stream_releases_connection_when_exhausted():
+    closed = []
+    stream = httplib2.ResponseStream(StringIO('0123456789'), closed.append,
+                                     chunk_size=4)
+
+    assert_equals(list(stream), ['0123', '4567', '89'])
+    assert_equals(closed, [True])
+    assert stream.closed
+
+def test_response_stream_discards_connection_when_closed_early():
+    closed = []
+    stream = httplib2.ResponseStream(StringIO('0123456789'), closed.append)
+
+    assert_equals(stream.read(4), '0123')
+    stream.close()
+    stream.close()
+
+    assert_equals(closed, [False])
+    assert_equals(stream.read(), '')
+
+def test_response_stream_read_all():
+    closed = []
+    stream = httplib2.ResponseStream(StringIO('0123456789'), closed.append)
+
+    assert_equals(stream.read(), '0123456789')
+    assert_equals(closed, [True])
+
+def _gzip(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='w')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def test_content_decoder_gunzips_chunk_by_chunk():
+    body = _gzip('Bolacha! ' * 1000)
+    response = httplib2.Response({'content-encoding': 'gzip',
+                                  'content-length': str(len(body))})
+    decoder = httplib2.ContentDecoder(response)
+
+    chunks = [decoder.decompress(body[i:i + 10]) for i in range(0, len(body), 10)]
+    chunks.append(decoder.flush())
+
+    assert_equals(''.join(chunks), 'Bolacha! ' * 1000)
+    assert_equals(response['content-length'], '9000')
+    assert_equals(response.compressed_length, len(body))
+    assert_equals(response.decompressed_length, 9000)
+    assert 'content-encoding' not in response
+
+def test_content_decoder_inflates_raw_deflate():
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress('Bolacha! ' * 10) + compressor.flush()
+    response = httplib2.Response({'content-encoding': 'deflate'})
+
+    assert_equals(httplib2._decompressContent(response, body), 'Bolacha! ' * 10)
+
+def test_content_decoder_enforces_max_size():
+    body = _gzip('0' * 100000)
+    response = httplib2.Response({'content-encoding': 'gzip'})
+    decoder = httplib2.ContentDecoder(response, max_size=1000)
+
+    assert_raises(httplib2.DecompressedContentTooLarge,
+                  decoder.decompress, body,
+                  exc_pattern=r'decompressed to more than 1000 bytes')
+
+def test_content_decoder_fails_on_garbage():
+    response = httplib2.Response({'content-encoding': 'gzip'})
+    assert_raises(httplib2.FailedToDecompressContent,
+                  httplib2._decompressContent, response, 'not gzipped',
+                  exc_pattern=r'purported to be compressed with gzip')
+
+def test_response_stream_decompresses_as_it_reads():
+    body = _gzip('Bolacha! ' * 1000)
+    response = httplib2.Response({'content-encoding': 'gzip'})
+    stream = httplib2.ResponseStream(StringIO(body), chunk_size=100,
+                                     decoder=httplib2.ContentDecoder(response))
+
+    chunks = list(stream)
+
+    assert_equals(set([len(c) for c in chunks]), set([100]))
+    assert_equals(''.join(chunks), 'Bolacha! ' * 1000)
+    assert_equals(response.compressed_length, len(body))
+
+def test_cache_entry_round_trip():
+    entry = httplib2._encode_cache_entry(200, [('etag', '"abc"'),
+                                              ('x-multi', 'line\r\n one')],
+                                         'body\r\n\r\nwith blank lines')
+    info, content = httplib2._decode_cache_entry(entry)
+
+    assert_equals(info, {'status': '200', 'etag': '"abc"', 'x-multi': 'line  one'})
+    assert_equals(content, 'body\r\n\r\nwith blank lines')
+
+def test_cache_entry_reads_old_email_format():
+    entry = 'status: 200\r\nETag: "abc"\r\ncontent-type: text/plain\r\n\r\nbody'
+    info, content = httplib2._decode_cache_entry(entry)
+
+    assert_equals(info, {'status': '200', 'etag': '"abc"',
+                         'content-type': 'text/plain'})
+    assert_equals(content, 'body')
+
+def test_cache_entry_rejects_damaged_entries():
+    entry = httplib2._encode_cache_entry(200, [('etag', '"abc"')], 'body')
+    assert_raises(ValueError, httplib2._decode_cache_entry, entry[:10])
+    assert_raises(ValueError, httplib2._decode_cache_entry, 'status: 200')
+
+def test_update_cache_writes_binary_entries():
+    cache = httplib2.MemoryCache()
+    response = httplib2.Response({'status': '304', 'etag': '"abc"',
+                                  'content-encoding': 'gzip'})
+    httplib2._updateCache({}, response, 'body', cache, 'http://somewhere.com/')
+
+    info, content = httplib2._decode_cache_entry(cache.get('http://somewhere.com/'))
+    assert_equals(info, {'status': '200', 'etag': '"abc"'})
+    assert_equals(content, 'body')
+
+def test_responses_keep_their_attributes_in_slots():
+    response = httplib2.Response({'status': '404', 'content-type': 'text/plain'})
+    assert not hasattr(response, '__dict__')
+    assert_equals((response.status, response['content-type']), (404, 'text/plain'))
+    assert_equals((response.fromcache, response.reason, response.previous), (False, 'Ok', None))
+    assert not hasattr(response, '_stale_digest')
+    assert_equals(response.dict, response)
+
+def test_response_copies_share_the_responses_before_them():
+    first = httplib2.Response({'status': '301', 'location': '/second'})
+    second = httplib2.Response({'status': '302', 'location': '/third'})
+    second.previous = first
+    second.reason = 'Found'
+    third = httplib2.Response({'status': '200'})
+    third.previous = copy.copy(second)
+
+    assert_equals(third.history, (first, second))
+    assert third.previous is not second
+    assert third.previous.previous is first
+    assert_equals((third.previous.status, third.previous.reason), (302, 'Found'))
+    third.previous['content-location'] = 'http://somewhere.com/second'
+    assert 'content-location' not in second
+
+def test_responses_can_be_pickled_and_deep_copied():
+    response = httplib2.Response({'status': '200', 'etag': '"abc"'})
+    response.previous = httplib2.Response({'status': '302'})
+    response.fromcache = True
+    for copied in [copy.deepcopy(response)] + [pickle.loads(pickle.dumps(response, protocol))
+                                               for protocol in range(3)]:
+        assert_equals(type(copied), httplib2.Response)
+        assert_equals(copied, response)
+        assert_equals((copied.status, copied.fromcache), (200, True))
+        assert_equals(copied.previous.status, 302)
+
+class CannedSocket(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+    def sendall(self, data):
+        self.sent.append(data)
+    def makefile(self, *args):
+        return StringIO(self.responses.pop(0))
+    def close(self):
+        pass
+
+class CannedConnection(httplib.HTTPConnection):
+    """Answers with the raw responses in 'responses', one per request"""
+    responses = []
+    connects = 0
+    def __init__(self, host, timeout=None, proxy_info=None):
+        httplib.HTTPConnection.__init__(self, host)
+    def connect(self):
+        CannedConnection.connects += 1
+        self.sock = CannedSocket(CannedConnection.responses)
+        self.dns_time = 0.25
+        self.connect_time = 0.5
+
+def test_request_timings_are_attached_and_given_to_hooks():
+    CannedConnection.responses = [
+        'HTTP/1.1 302 Found\r\nLocation: /final\r\nContent-Length: 0\r\n\r\n',
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    ]
+    CannedConnection.connects = 0
+    seen = []
+    http = httplib2.Http()
+    http.add_timing_hook(seen.append)
+
+    response, content = http.request('http://somewhere.com/start',
+                                     connection_type=CannedConnection)
+
+    assert_equals(content, 'hello')
+    assert_equals(seen, [response.timings])
+    timings = response.timings
+    assert_equals(timings.uri, 'http://somewhere.com/start')
+    assert_equals(timings.status, 200)
+    assert_equals(timings.redirects, 1)
+    # the redirect reused the connection
+    assert_equals(CannedConnection.connects, 1)
+    assert_equals((timings.dns, timings.connect), (0.25, 0.5))
+    assert timings.total >= timings.ttfb > 0
+
+def test_responses_know_the_uri_they_were_requested_with():
+    CannedConnection.responses = [
+        'HTTP/1.1 302 Found\r\nLocation: /final\r\n'
+        'Content-Location: http://elsewhere.com/\r\nContent-Length: 0\r\n\r\n',
+        'HTTP/1.1 200 OK\r\nContent-Location: http://elsewhere.com/\r\n'
+        'Content-Length: 5\r\n\r\nhello',
+    ]
+    http = httplib2.Http()
+
+    response, content = http.request('http://somewhere.com/start',
+                                     connection_type=CannedConnection)
+
+    assert_equals(response.requested_uri, 'http://somewhere.com/final')
+    assert_equals(response.previous.requested_uri, 'http://somewhere.com/start')
+
+def test_request_timings_add_up():
+    timings = httplib2.RequestTimings('GET', 'http://somewhere.com/')
+    assert_equals(timings.timed('cache', lambda x: x * 2, 21), 42)
+    assert timings.cache > 0
+
+    other = httplib2.RequestTimings('GET', 'http://elsewhere.com/')
+    other.dns = 1.0
+    other.auth_retries = 1
+    timings.add(other)
+
+    assert_equals(timings.as_dict()['dns'], 1.0)
+    assert_equals(timings.as_dict()['auth_retries'], 1)
+    assert_equals(timings.as_dict()['uri'], 'http://somewhere.com/')
+
+def test_read_content_times_transfer_and_decompression():
+    response = httplib2.Response({'status': '200', 'content-encoding': 'gzip'})
+    timings = httplib2.RequestTimings()
+    content = httplib2._read_content(response, StringIO(_gzip('x' * 100000)),
+                                     timings=timings)
+    assert_equals(content, 'x' * 100000)
+    assert timings.decompress > 0
+    assert timings.transfer >= 0
+
+def test_file_cache_with_default_names():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.FileCache(directory)
+        cache.set('http://somewhere.com/some/path?query', 'entry')
+        assert_equals(cache.get('http://somewhere.com/some/path?query'), 'entry')
+        cache.delete('http://somewhere.com/some/path?query')
+        assert_equals(cache.get('http://somewhere.com/some/path?query'), None)
+    finally:
+        shutil.rmtree(directory)
+
+def test_sharded_file_cache_spreads_entries_over_subdirectories():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        cache.set('http://somewhere.com/some/path?query', 'entry')
+        assert_equals(cache.get('http://somewhere.com/some/path?query'), 'entry')
+
+        name = httplib2.md5('http://somewhere.com/some/path?query').hexdigest()
+        assert os.path.isfile(os.path.join(directory, name[0:2], name[2:4], name))
+        # no temporary file is left behind
+        assert_equals(os.listdir(os.path.join(directory, name[0:2], name[2:4])), [name])
+
+        cache.delete('http://somewhere.com/some/path?query')
+        cache.delete('http://somewhere.com/some/path?query')
+        assert_equals(cache.get('http://somewhere.com/some/path?query'), None)
+    finally:
+        shutil.rmtree(directory)
+
+def test_file_caches_create_entries_with_the_default_mode():
+    directory = tempfile.mkdtemp()
+    umask = os.umask(022)
+    try:
+        for cache in (httplib2.FileCache(directory), httplib2.ShardedFileCache(directory)):
+            cache.set('key', 'entry')
+            assert_equals(stat.S_IMODE(os.stat(cache._path('key')).st_mode),
+                          httplib2.CACHE_FILE_MODE)
+    finally:
+        os.umask(umask)
+        shutil.rmtree(directory)
+    assert_equals(httplib2.CACHE_FILE_MODE, 0666 & ~umask)
+
+def test_file_caches_sweep_temporary_files_left_behind():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        cache.set('key', 'entry')
+        shard = os.path.dirname(cache._path('key'))
+        for name in ('.tmp-old', '.tmp-new'):
+            open(os.path.join(shard, name), 'w').write('half an entry')
+        an_hour_ago = time.time() - 3600
+        os.utime(os.path.join(shard, '.tmp-old'), (an_hour_ago, an_hour_ago))
+
+        assert_equals(cache.sweep(), 1)
+        assert_equals(sorted(os.listdir(shard)), ['.tmp-new', os.path.basename(cache._path('key'))])
+        assert_equals(cache.sweep(max_age=0), 1)
+        assert_equals(cache.get('key'), 'entry')
+    finally:
+        shutil.rmtree(directory)
+
+def test_sharded_file_cache_readers_never_see_partial_entries():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        entries = ['a' * 200000, 'b' * 300000]
+        cache.set('key', entries[0])
+        seen = set()
+        def write():
+            for number in range(50):
+                cache.set('key', entries[number % 2])
+        def read():
+            for number in range(200):
+                seen.add(cache.get('key'))
+        threads = [threading.Thread(target=write), threading.Thread(target=write),
+                   threading.Thread(target=read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert seen.issubset(set(entries))
+    finally:
+        shutil.rmtree(directory)
+
+def test_sharded_file_cache_lock_excludes_other_holders():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        lock = cache.lock('key')
+        events = []
+        def take():
+            cache.lock('key').release()
+            events.append('taken')
+        thread = threading.Thread(target=take)
+        thread.start()
+        thread.join(0.2)
+        events.append('released')
+        lock.release()
+        thread.join()
+        assert_equals(events, ['released', 'taken'])
+
+        assert_equals(httplib2.ShardedFileCache(directory, locking=False).lock('key'), None)
+    finally:
+        shutil.rmtree(directory)
+
+def test_merge_cache_leaves_entries_replaced_meanwhile_alone():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        response = httplib2.Response({'status': '304', 'etag': '"abc"'})
+        cache.set('http://somewhere.com/', 'newer')
+        httplib2._mergeCache({}, response, 'body', cache, 'http://somewhere.com/', 'older')
+        assert_equals(cache.get('http://somewhere.com/'), 'newer')
+
+        httplib2._mergeCache({}, response, 'body', cache, 'http://somewhere.com/', 'newer')
+        info, content = httplib2._decode_cache_entry(cache.get('http://somewhere.com/'))
+        assert_equals(info, {'status': '200', 'etag': '"abc"'})
+    finally:
+        shutil.rmtree(directory)
+
+def test_not_modified_responses_update_the_sharded_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        cache.set('http://somewhere.com/page', httplib2._encode_cache_entry(
+            200, [('etag', '"abc"'), ('cache-control', 'no-cache')], 'cached body'))
+        CannedConnection.responses = [
+            'HTTP/1.1 304 Not Modified\r\nETag: "abc"\r\nX-Fresh: yes\r\n\r\n',
+        ]
+        http = httplib2.Http(cache=cache)
+        response, content = http.request('http://somewhere.com/page',
+                                         connection_type=CannedConnection)
+
+        assert_equals((response.status, response.fromcache), (200, True))
+        assert_equals(content, 'cached body')
+        info, content = httplib2._decode_cache_entry(cache.get('http://somewhere.com/page'))
+        assert_equals(info['x-fresh'], 'yes')
+        assert_equals(content, 'cached body')
+    finally:
+        shutil.rmtree(directory)
+
+def test_file_caches_read_headers_without_bodies():
+    directory = tempfile.mkdtemp()
+    try:
+        entry = httplib2._encode_cache_entry(200, [('etag', '"abc"')], 'body\r\n\r\nmore')
+        old_entry = 'status: 200\r\netag: "abc"\r\n\r\nold body'
+        for cache in (httplib2.FileCache(os.path.join(directory, 'flat')),
+                      httplib2.ShardedFileCache(os.path.join(directory, 'sharded'))):
+            cache.set('new', entry)
+            cache.set('old', old_entry)
+            assert_equals(cache.get_metadata('missing'), None)
+
+            metadata = cache.get_metadata('new')
+            assert_equals(httplib2._decode_cache_entry(metadata), ({'status': '200', 'etag': '"abc"'}, ''))
+            assert_equals(cache.get_body('new', metadata), 'body\r\n\r\nmore')
+
+            metadata = cache.get_metadata('old')
+            assert_equals(metadata, 'status: 200\r\netag: "abc"\r\n\r\n')
+            assert_equals(cache.get_body('old', metadata), 'old body')
+
+            # the entry was replaced since its headers were read
+            cache.set('new', httplib2._encode_cache_entry(200, [('etag', '"def"')], 'other'))
+            assert_equals(cache.get_body('new', metadata), None)
+    finally:
+        shutil.rmtree(directory)
+
+def test_file_caches_map_large_bodies_into_memory():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.FileCache(directory, mmap_threshold=100)
+        cache.set('large', httplib2._encode_cache_entry(200, [], 'x' * 1000))
+        cache.set('small', httplib2._encode_cache_entry(200, [], 'small'))
+
+        metadata = cache.get_metadata('large')
+        body = cache.get_body('large', metadata)
+        assert isinstance(body, buffer)
+        assert_equals(str(body), 'x' * 1000)
+        assert_equals(cache.get_body('small', cache.get_metadata('small')), 'small')
+
+        # storing the entry again leaves the mapped body as it was
+        cache.set('large', httplib2._encode_cache_entry(200, [], 'y' * 1000))
+        assert_equals(str(body), 'x' * 1000)
+        assert_equals(httplib2._decode_cache_entry(
+            httplib2._encode_cache_entry(200, [], body)), ({'status': '200'}, 'x' * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+def test_mapped_bodies_are_passed_through_and_streamed():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory, mmap_threshold=1)
+        cache.set('http://somewhere.com/page', httplib2._encode_cache_entry(
+            200, [('date', _http_date(time.time())), ('cache-control', 'max-age=3600')], 'cached body'))
+        http = httplib2.Http(cache=cache)
+        response, content = http.request('http://somewhere.com/page')
+        assert isinstance(content, buffer)
+        assert_equals(str(content), 'cached body')
+
+        response, content = http.request('http://somewhere.com/page', stream=True)
+        assert_equals(content.read(6), 'cached')
+        assert_equals(content.read(), ' body')
+    finally:
+        shutil.rmtree(directory)
+
+class PartsRecordingCache(httplib2.ShardedFileCache):
+    parts = None
+    def set_parts(self, key, parts):
+        self.parts = parts
+        httplib2.ShardedFileCache.set_parts(self, key, parts)
+
+def test_mapped_bodies_are_written_back_without_copies_on_304():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = PartsRecordingCache(directory, mmap_threshold=1)
+        cache.set('http://somewhere.com/page', httplib2._encode_cache_entry(
+            200, [('etag', '"abc"'), ('cache-control', 'no-cache')], 'cached body'))
+        CannedConnection.responses = [
+            'HTTP/1.1 304 Not Modified\r\nETag: "abc"\r\nX-Fresh: yes\r\n\r\n',
+        ]
+        http = httplib2.Http(cache=cache)
+        response, content = http.request('http://somewhere.com/page',
+                                          connection_type=CannedConnection)
+        assert_equals(str(content), 'cached body')
+        assert isinstance(cache.parts[1], buffer)
+
+        info, body = httplib2._decode_cache_entry(cache.get('http://somewhere.com/page'))
+        assert_equals((info['x-fresh'], body), ('yes', 'cached body'))
+    finally:
+        shutil.rmtree(directory)
+
+class BodyCountingCache(httplib2.ShardedFileCache):
+    bodies = 0
+    def get_body(self, key, metadata):
+        self.bodies += 1
+        return httplib2.ShardedFileCache.get_body(self, key, metadata)
+
+def test_stale_entries_are_replaced_without_reading_their_bodies():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = BodyCountingCache(directory)
+        cache.set('http://somewhere.com/page', httplib2._encode_cache_entry(
+            200, [('etag', '"abc"'), ('cache-control', 'no-cache')], 'old body'))
+        CannedConnection.responses = [
+            'HTTP/1.1 200 OK\r\nETag: "def"\r\nContent-Length: 8\r\n\r\nnew body',
+        ]
+        http = httplib2.Http(cache=cache)
+        response, content = http.request('http://somewhere.com/page',
+                                         connection_type=CannedConnection)
+        assert_equals(content, 'new body')
+        assert_equals(cache.bodies, 0)
+    finally:
+        shutil.rmtree(directory)
+
+def test_fresh_entries_that_went_away_are_fetched_again():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.ShardedFileCache(directory)
+        cache.get_body = lambda key, metadata: None
+        cache.set('http://somewhere.com/page', httplib2._encode_cache_entry(
+            200, [('date', _http_date(time.time())), ('cache-control', 'max-age=3600')], 'old body'))
+        CannedConnection.responses = [
+            'HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\nnew body',
+        ]
+        http = httplib2.Http(cache=cache)
+        response, content = http.request('http://somewhere.com/page',
+                                         connection_type=CannedConnection)
+        assert_equals((response.fromcache, content), (False, 'new body'))
+    finally:
+        shutil.rmtree(directory)
+
+def _http_date(timestamp):
+    return email.Utils.formatdate(timestamp, usegmt=True)
+
+def test_sqlite_cache_get_set_delete():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.SqliteCache(os.path.join(directory, 'cache.db'))
+        entry = httplib2._encode_cache_entry(200, [('etag', '"abc"')], 'body\x00\xff')
+        cache.set('http://somewhere.com/', entry)
+        assert_equals(cache.get('http://somewhere.com/'), entry)
+        cache.set('http://somewhere.com/', 'not an entry')
+        assert_equals(cache.get('http://somewhere.com/'), 'not an entry')
+        assert_equals((len(cache), cache.size), (1, len('not an entry')))
+
+        cache.delete('http://somewhere.com/')
+        assert_equals(cache.get('http://somewhere.com/'), None)
+        assert_equals((len(cache), cache.size), (0, 0))
+
+        cache.set('http://somewhere.com/', entry)
+        metadata = cache.get_metadata('http://somewhere.com/')
+        assert_equals(httplib2._decode_cache_entry(metadata)[0], {'status': '200', 'etag': '"abc"'})
+        assert_equals(cache.get_body('http://somewhere.com/', metadata), 'body\x00\xff')
+        assert_equals(cache.get_body('http://somewhere.com/', 'other headers'), None)
+        cache.delete('http://somewhere.com/')
+
+        mode = cache._connection().execute("PRAGMA journal_mode").fetchone()[0]
+        assert_equals(mode, 'wal')
+    finally:
+        shutil.rmtree(directory)
+
+def test_sqlite_cache_evicts_expired_entries_then_least_recently_used():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.SqliteCache(os.path.join(directory, 'cache.db'))
+        now = time.time()
+        def entry(max_age):
+            return httplib2._encode_cache_entry(200, [
+                ('date', _http_date(now)),
+                ('cache-control', 'max-age=%d' % max_age)], 'x' * 1000)
+        cache.set('fresh-old', entry(3600))
+        cache.set('expired', entry(0))
+        cache.set('fresh-new', entry(3600))
+        connection = cache._connection()
+        connection.execute("UPDATE entries SET accessed = ? WHERE key = 'fresh-old'", (now - 100,))
+
+        assert_equals(cache.evict(cache.size - 1, now + 1), 1)
+        assert_equals(cache.get('expired'), None)
+        assert_equals(cache.evict(cache.size - 1, now + 1), 1)
+        assert_equals(cache.get('fresh-old'), None)
+        assert cache.get('fresh-new')
+
+        # without a budget only expired entries go
+        assert_equals(cache.evict(now=now + 1), 0)
+        assert_equals(cache.evict(now=now + 7200), 1)
+    finally:
+        shutil.rmtree(directory)
+
+def test_sqlite_cache_reads_do_not_wait_for_writers():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'cache.db')
+        cache = httplib2.SqliteCache(path, timeout=10)
+        cache.set('key', 'value')
+        connection = cache._connection()
+        connection.execute("UPDATE entries SET accessed = 0 WHERE key = 'key'")
+
+        writer = httplib2.sqlite3.connect(path, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            started = time.time()
+            assert_equals(cache.get('key'), 'value')
+            assert time.time() - started < 1
+        finally:
+            writer.execute("ROLLBACK")
+            writer.close()
+        assert_equals(connection.execute("PRAGMA busy_timeout").fetchone()[0], 10000)
+    finally:
+        shutil.rmtree(directory)
+
+def test_sqlite_cache_keeps_to_its_budget():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.SqliteCache(os.path.join(directory, 'cache.db'), max_bytes=10000)
+        for number in range(30):
+            cache.set('key%d' % number, 'x' * 1000)
+        assert cache.size <= 10000
+        assert cache.get('key29')
+    finally:
+        shutil.rmtree(directory)
+
+def test_sqlite_cache_is_shared_between_threads():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.SqliteCache(os.path.join(directory, 'cache.db'))
+        def write(number):
+            for item in range(20):
+                cache.set('key%d-%d' % (number, item), 'value')
+        threads = [threading.Thread(target=write, args=(number,)) for number in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equals(len(cache), 80)
+        assert_equals(cache.get('key3-19'), 'value')
+    finally:
+        shutil.rmtree(directory)
+
+def test_http_answers_from_the_sqlite_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = httplib2.SqliteCache(os.path.join(directory, 'cache.db'))
+        CannedConnection.responses = [
+            'HTTP/1.1 200 OK\r\nDate: %s\r\nCache-Control: max-age=3600\r\n'
+            'Content-Length: 5\r\n\r\nhello' % _http_date(time.time()),
+        ]
+        http = httplib2.Http(cache=cache)
+        http.request('http://somewhere.com/page', connection_type=CannedConnection)
+        response, content = http.request('http://somewhere.com/page',
+                                         connection_type=CannedConnection)
+        assert_equals((response.fromcache, content), (True, 'hello'))
+        expires = cache._connection().execute("SELECT expires - stored_at FROM entries").fetchone()[0]
+        assert 3590 < expires <= 3600
+    finally:
+        shutil.rmtree(directory)
+
+def _stale_entry(cache_control, stale_for=10):
+    return httplib2._encode_cache_entry(200, [
+        ('date', _http_date(time.time() - 60 - stale_for)), ('etag', '"abc"'),
+        ('cache-control', 'max-age=60, ' + cache_control)], 'stale body')
+
+def _wait_for_revalidation(http):
+    for attempt in range(200):
+        if not http._revalidating:
+            return
+        time.sleep(0.01)
+    raise AssertionError('the revalidation did not finish')
+
+def test_stale_while_revalidate_serves_the_entry_and_revalidates_it_later():
+    cache = httplib2.MemoryCache()
+    cache.set('http://somewhere.com/page', _stale_entry('stale-while-revalidate=30'))
+    CannedConnection.responses = [
+        'HTTP/1.1 304 Not Modified\r\nETag: "abc"\r\nX-Fresh: yes\r\n\r\n',
+    ]
+    http = httplib2.Http(cache=cache)
+    response, content = http.request('http://somewhere.com/page', connection_type=CannedConnection)
+    assert_equals((response.fromcache, response.stale, content), (True, True, 'stale body'))
+
+    _wait_for_revalidation(http)
+    assert_equals(CannedConnection.responses, [])
+    info, content = httplib2._decode_cache_entry(cache.get('http://somewhere.com/page'))
+    assert_equals((info['x-fresh'], content), ('yes', 'stale body'))
+
+def test_stale_while_revalidate_has_a_limit():
+    for cache_control, override in [('stale-while-revalidate=5', None),
+                                    ('stale-while-revalidate=30, must-revalidate', None),
+                                    ('stale-while-revalidate=30', 0)]:
+        cache = httplib2.MemoryCache()
+        cache.set('http://somewhere.com/page', _stale_entry(cache_control))
+        CannedConnection.responses = [
+            'HTTP/1.1 200 OK\r\nContent-Length: 9\r\n\r\nnew body!',
+        ]
+        http = httplib2.Http(cache=cache, stale_while_revalidate=override)
+        response, content = http.request('http://somewhere.com/page', connection_type=CannedConnection)
+        assert_equals((response.stale, content), (False, 'new body!'))
+
+def test_client_can_allow_stale_while_revalidate():
+    cache = httplib2.MemoryCache()
+    cache.set('http://somewhere.com/page', _stale_entry('public'))
+    CannedConnection.responses = [
+        'HTTP/1.1 304 Not Modified\r\nETag: "abc"\r\n\r\n',
+    ]
+    http = httplib2.Http(cache=cache, stale_while_revalidate=60)
+    response, content = http.request('http://somewhere.com/page', connection_type=CannedConnection)
+    assert_equals((response.stale, content), (True, 'stale body'))
+    _wait_for_revalidation(http)
+
+class UnreachableConnection(CannedConnection):
+    def connect(self):
+        raise socket.error(111, 'Connection refused')
+
+def test_stale_if_error_serves_the_entry_when_the_server_fails():
+    cache = httplib2.MemoryCache()
+    cache.set('http://somewhere.com/page', _stale_entry('stale-if-error=600'))
+    CannedConnection.responses = [
+        'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 4\r\n\r\nbusy',
+    ]
+    http = httplib2.Http(cache=cache)
+    response, content = http.request('http://somewhere.com/page', connection_type=CannedConnection)
+    assert_equals((response.status, response.stale, content), (200, True, 'stale body'))
+
+    http = httplib2.Http(cache=cache)
+    response, content = http.request('http://somewhere.com/page', connection_type=UnreachableConnection)
+    assert_equals((response.status, response.stale, content), (200, True, 'stale body'))
+
+    http.stale_if_error = 0
+    assert_raises(socket.error, http.request, 'http://somewhere.com/page',
+                  connection_type=UnreachableConnection)
+
+def test_stale_if_error_frees_the_connection_of_a_streamed_error():
+    cache = httplib2.MemoryCache()
+    cache.set('http://somewhere.com/page', _stale_entry('stale-if-error=600'))
+    CannedConnection.responses = [
+        'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 4\r\n\r\nbusy',
+    ]
+    http = httplib2.Http(cache=cache, max_connections_per_host=1, pool_block=False)
+    response, content = http.request('http://somewhere.com/page', stream=True,
+                                     connection_type=CannedConnection)
+    assert_equals((response.status, response.stale, content.read()), (200, True, 'stale body'))
+    assert_equals(len(http.connections), 0)
+
+class GatedConnection(CannedConnection):
+    """Connects once 'gate' is set"""
+    gate = threading.Event()
+    def connect(self):
+        GatedConnection.gate.wait(5)
+        CannedConnection.connect(self)
+
+def _request_from_threads(http, count, **kw):
+    results = []
+    def request():
+        try:
+            results.append(http.request('http://somewhere.com/page',
+                                        connection_type=GatedConnection, **kw))
+        except Exception, e:
+            results.append(e)
+    threads = [threading.Thread(target=request) for number in range(count)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    GatedConnection.gate.set()
+    for thread in threads:
+        thread.join()
+    GatedConnection.gate.clear()
+    return results
+
+def test_identical_requests_in_flight_are_coalesced():
+    CannedConnection.connects = 0
+    CannedConnection.responses = [
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    ]
+    http = httplib2.Http(cache=httplib2.MemoryCache())
+    results = _request_from_threads(http, 5)
+
+    assert_equals(CannedConnection.connects, 1)
+    assert_equals([content for response, content in results], ['hello'] * 5)
+    responses = [response for response, content in results]
+    assert_equals(len(set(map(id, responses))), 5)
+    assert_equals(sorted([response.timings.coalesced for response in responses]),
+                  [False, True, True, True, True])
+    assert_equals(http._flights, {})
+
+def test_coalesced_requests_share_failures():
+    CannedConnection.connects = 0
+    CannedConnection.responses = []
+    results = _request_from_threads(httplib2.Http(cache=httplib2.MemoryCache()), 3)
+    assert_equals([type(result) for result in results], [IndexError] * 3)
+    assert_equals(CannedConnection.connects, 1)
+
+def test_requests_that_differ_are_not_coalesced():
+    CannedConnection.connects = 0
+    CannedConnection.responses = [
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    ]
+    http = httplib2.Http(cache=httplib2.MemoryCache())
+    http.coalesce_requests = False
+    results = _request_from_threads(http, 2)
+    assert_equals(CannedConnection.connects, 2)
+    assert_equals([content for response, content in results], ['hello'] * 2)
+
+    CannedConnection.responses = [
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    ]
+    http = httplib2.Http(cache=httplib2.MemoryCache())
+    key = ('GET', 'http://somewhere.com/page', ())
+    http._flights[key] = httplib2._Flight()
+    response, content = http.request('http://somewhere.com/page', headers={'accept': 'text/plain'},
+                                     connection_type=CannedConnection)
+    assert_equals(content, 'hello')
+
+def test_requests_the_cache_could_not_answer_are_not_coalesced():
+    CannedConnection.responses = [
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhit %d' % number for number in range(1, 7)
+    ]
+    results = _request_from_threads(httplib2.Http(), 3)
+    results += _request_from_threads(httplib2.Http(cache=httplib2.MemoryCache()), 3,
+                                     headers={'cache-control': 'no-store'})
+    assert_equals(sorted([content for response, content in results]),
+                  ['hit %d' % number for number in range(1, 7)])
+
+def test_responses_that_may_not_be_shared_are_fetched_again():
+    CannedConnection.responses = [
+        'HTTP/1.1 200 OK\r\nCache-Control: %s\r\nContent-Length: 5\r\n\r\nhit %d'
+        % (number % 2 and 'no-store' or 'private', number) for number in range(1, 5)
+    ]
+    http = httplib2.Http(cache=httplib2.MemoryCache())
+    results = _request_from_threads(http, 4)
+    assert_equals(sorted([content for response, content in results]),
+                  ['hit %d' % number for number in range(1, 5)])
+    assert_equals([response.timings.coalesced for response, content in results], [False] * 4)
+
+def _counting_getaddrinfo(calls, fail=()):
+    def fake_getaddrinfo(host, port, *args):
+        calls.append(host)
+        if host in fail:
+            raise socket.gaierror(-2, 'Name or service not known')
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', port))]
+    return fake_getaddrinfo
+
+def test_dns_cache_answers_repeated_lookups():
+    calls = []
+    old_getaddrinfo = socket.getaddrinfo
+    socket.getaddrinfo = _counting_getaddrinfo(calls)
+    try:
+        cache = httplib2.DNSCache()
+        first = cache.getaddrinfo('Somewhere.com', 80, 0, socket.SOCK_STREAM)
+        second = cache.getaddrinfo('somewhere.com', 80, 0, socket.SOCK_STREAM)
+        cache.getaddrinfo('somewhere.com', 443, 0, socket.SOCK_STREAM)
+    finally:
+        socket.getaddrinfo = old_getaddrinfo
+
+    assert first is second
+    assert_equals(calls, ['Somewhere.com', 'somewhere.com'])
+    stats = cache.stats()
+    assert_equals((stats['hits'], stats['misses'], stats['entries']), (1, 2, 2))
+
+def test_dns_cache_remembers_failures_for_a_while():
+    calls = []
+    old_getaddrinfo = socket.getaddrinfo
+    socket.getaddrinfo = _counting_getaddrinfo(calls, fail=['nowhere.com'])
+    try:
+        cache = httplib2.DNSCache(negative_ttl=5)
+        assert_raises(socket.gaierror, cache.getaddrinfo, 'nowhere.com', 80)
+        assert_raises(socket.gaierror, cache.getaddrinfo, 'nowhere.com', 80)
+        uncached = httplib2.DNSCache(negative_ttl=0)
+        assert_raises(socket.gaierror, uncached.getaddrinfo, 'nowhere.com', 80)
+        assert_raises(socket.gaierror, uncached.getaddrinfo, 'nowhere.com', 80)
+    finally:
+        socket.getaddrinfo = old_getaddrinfo
+
+    assert_equals(len(calls), 3)
+    assert_equals(cache.stats()['negative_hits'], 1)
+
+def test_dns_cache_expires_and_forgets_entries():
+    calls = []
+    old_getaddrinfo = socket.getaddrinfo
+    socket.getaddrinfo = _counting_getaddrinfo(calls)
+    try:
+        cache = httplib2.DNSCache(ttl=300, max_entries=2)
+        cache.getaddrinfo('a.com', 80)
+        cache._entries[('a.com', 80, 0, 0, 0, 0)] = (0, [])
+        cache.getaddrinfo('a.com', 80)
+        cache.forget('a.com')
+        cache.getaddrinfo('a.com', 80)
+        cache.getaddrinfo('b.com', 80)
+        cache.getaddrinfo('c.com', 80)
+    finally:
+        socket.getaddrinfo = old_getaddrinfo
+
+    assert_equals(calls, ['a.com', 'a.com', 'a.com', 'b.com', 'c.com'])
+    assert_equals(len(cache._entries), 2)
+
+def test_dns_cache_overrides_resolve_to_given_addresses():
+    cache = httplib2.DNSCache()
+    cache.add_override('somewhere.com', '127.0.0.1')
+    addresses = cache.getaddrinfo('somewhere.com', 80, 0, socket.SOCK_STREAM)
+    assert_equals([address[4] for address in addresses], [('127.0.0.1', 80)])
+    stats = cache.stats()
+    assert_equals((stats['hits'], stats['misses']), (1, 0))
+    cache.remove_override('somewhere.com')
+    assert_equals(cache.stats()['overrides'], 0)
+
+def test_connections_resolve_through_the_dns_cache():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    try:
+        http = httplib2.Http()
+        http.dns_cache.add_override('somewhere.com', '127.0.0.1')
+        conn = HTTPConnectionWithTimeout('somewhere.com', listener.getsockname()[1],
+                                         dns_cache=http.dns_cache)
+        conn.connect()
+        assert_equals(conn.sock.getpeername(), listener.getsockname())
+        conn.close()
+    finally:
+        listener.close()
+
+class FakeSocksSocket(object):
+    connected = []
+    def __init__(self, *args):
+        pass
+    def setproxy(self, *args):
+        pass
+    def settimeout(self, timeout):
+        pass
+    def connect(self, address):
+        FakeSocksSocket.connected.append(address)
+    def setsockopt(self, *args):
+        pass
+
+class FakeSocks(object):
+    socksocket = FakeSocksSocket
+
+def test_proxies_with_remote_dns_resolve_host_names_themselves():
+    calls = []
+    FakeSocksSocket.connected = []
+    old_getaddrinfo, old_socks = socket.getaddrinfo, httplib2.socks
+    socket.getaddrinfo = _counting_getaddrinfo(calls)
+    httplib2.socks = FakeSocks
+    try:
+        proxy_info = httplib2.ProxyInfo(3, 'proxy.com', 1080, proxy_rdns=True)
+        for klass in (HTTPConnectionWithTimeout, httplib2.HTTPSConnectionWithTimeout):
+            conn = klass('somewhere.com', 443, proxy_info=proxy_info,
+                         dns_cache=httplib2.DNSCache())
+            httplib2._open_socket(conn)
+    finally:
+        socket.getaddrinfo, httplib2.socks = old_getaddrinfo, old_socks
+
+    assert_equals(calls, [])
+    assert_equals(FakeSocksSocket.connected, [('somewhere.com', 443)] * 2)
+
+class PipeliningServer(object):
+    """Accepts connections one at a time and, on each, waits for
+    'expect' requests to have arrived before answering 'answer' of them
+    and hanging up, or keeping the connection when 'answer' is None."""
+    def __init__(self, script):
+        self.script = list(script)
+        self.received = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.base = 'http://127.0.0.1:%d' % self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        for expect, answer in self.script:
+            conn, address = self.listener.accept()
+            conn.settimeout(5)
+            data = ''
+            while data.count('\r\n\r\n') < expect:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            paths = [line.split(' ')[1] for line in data.split('\r\n')
+                     if line.startswith('GET ')]
+            self.received.append(paths)
+            for path in paths[:answer]:
+                body = 'body of %s' % path
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+            if answer is not None:
+                conn.close()
+            else:
+                self.kept = conn
+
+    def close(self):
+        self.thread.join(5)
+        self.listener.close()
+
+def test_pipeline_writes_requests_before_reading_responses():
+    server = PipeliningServer([(4, None)])
+    try:
+        http = httplib2.Http(timeout=5)
+        seen = []
+        http.add_timing_hook(seen.append)
+        results = http.pipeline([server.base + '/%d' % number for number in range(4)],
+                                depth=4)
+    finally:
+        server.close()
+
+    # the server only answers once all four requests have arrived
+    assert_equals(server.received, [['/0', '/1', '/2', '/3']])
+    assert_equals([content for response, content in results],
+                  ['body of /0', 'body of /1', 'body of /2', 'body of /3'])
+    assert_equals(seen, [response.timings for response, content in results])
+    assert_equals(len(http.connections), 1)
+
+def test_pipeline_sends_unanswered_requests_again():
+    server = PipeliningServer([(3, 2), (3, 1), (2, None)])
+    try:
+        http = httplib2.Http(timeout=5)
+        results = http.pipeline([server.base + '/%d' % number for number in range(5)],
+                                depth=3)
+    finally:
+        server.close()
+
+    assert_equals(server.received, [['/0', '/1', '/2'], ['/2', '/3', '/4'],
+                                    ['/3', '/4']])
+    assert_equals([content for response, content in results],
+                  ['body of /%d' % number for number in range(5)])
+
+def test_pipeline_gives_up_when_nothing_is_answered():
+    server = PipeliningServer([(1, 0), (1, 0)])
+    try:
+        http = httplib2.Http(timeout=5)
+        assert_raises(httplib.BadStatusLine, http.pipeline, [server.base + '/'])
+    finally:
+        server.close()
+
+class RecordingAuthorization(object):
+    def __init__(self):
+        self.requests = []
+    def request(self, method, request_uri, headers, content):
+        self.requests.append((method, request_uri))
+
+def test_pipeline_authorizes_requests_like_request_does():
+    server = PipeliningServer([(2, None)])
+    authorization = RecordingAuthorization()
+    try:
+        http = httplib2.Http(timeout=5)
+        asked = []
+        def authorization_for(uri):
+            asked.append(uri.request_uri)
+            return uri.request_uri == '/private' and authorization or None
+        http._authorization_for = authorization_for
+        http.pipeline([server.base + '/public', server.base + '/private'])
+    finally:
+        server.close()
+
+    assert_equals(asked, ['/public', '/private'])
+    assert_equals(authorization.requests, [('GET', '/private')])
+
+def test_pipeline_only_takes_idempotent_methods():
+    assert_raises(ValueError, httplib2.Http().pipeline, ['http://somewhere.com/'],
+                  method='POST')
+
+def test_normalize_uri_takes_uris_apart_once():
+    normalized = httplib2.normalize_uri(u'HTTP://Somewhere.COM/caf\xe9?q=1#top')
+    assert_equals(normalized.uri, 'http://Somewhere.COM/caf%C3%A9?q=1#top')
+    assert_equals((normalized.scheme, normalized.authority), ('http', 'somewhere.com'))
+    assert_equals((normalized.path, normalized.query), ('/caf%C3%A9', 'q=1'))
+    assert_equals(normalized.request_uri, '/caf%C3%A9?q=1')
+    assert_equals(normalized.defrag_uri, 'http://somewhere.com/caf%C3%A9?q=1')
+    assert httplib2.normalize_uri(u'HTTP://Somewhere.COM/caf\xe9?q=1#top') is normalized
+    assert_raises(httplib2.RelativeURIError, httplib2.normalize_uri, '/relative')
+
+def test_normalize_uri_parses_a_uri_once():
+    parsed = []
+    parse_uri = httplib2.parse_uri
+    def counting_parse_uri(uri):
+        parsed.append(uri)
+        return parse_uri(uri)
+    httplib2.parse_uri = counting_parse_uri
+    try:
+        normalized = httplib2.normalize_uri('http://somewhere.com/parsed-once?q=1')
+    finally:
+        httplib2.parse_uri = parse_uri
+    assert_equals(parsed, ['http://somewhere.com/parsed-once?q=1'])
+    assert_equals(httplib2.urlnorm(normalized.uri),
+                  (normalized.scheme, normalized.authority,
+                   normalized.request_uri, normalized.defrag_uri))
+
+def test_normalize_uri_keeps_str_and_unicode_apart():
+    from_unicode = httplib2.normalize_uri(u'http://somewhere.com/either')
+    from_str = httplib2.normalize_uri('http://somewhere.com/either')
+    assert from_str is not from_unicode
+    assert_equals(type(from_str.uri), str)
+    assert_equals(type(from_unicode.uri), unicode)
+
+def test_normalize_uri_forgets_least_recently_used():
+    old_size = httplib2.URI_CACHE_SIZE
+    httplib2.URI_CACHE_SIZE = 4
+    try:
+        first = httplib2.normalize_uri('http://somewhere.com/1')
+        httplib2.normalize_uri('http://somewhere.com/2')
+        httplib2.normalize_uri('http://somewhere.com/3')
+        # moves back to the recent generation
+        assert httplib2.normalize_uri('http://somewhere.com/1') is first
+        httplib2.normalize_uri('http://somewhere.com/4')
+        httplib2.normalize_uri('http://somewhere.com/5')
+        assert httplib2.normalize_uri('http://somewhere.com/1') is first
+        remembered = set(httplib2._recent_uris) | set(httplib2._older_uris)
+        assert (str, 'http://somewhere.com/2') not in remembered
+        assert len(remembered) <= 4
+    finally:
+        httplib2.URI_CACHE_SIZE = old_size
+
+def test_authorizations_take_normalized_uris():
+    normalized = httplib2.normalize_uri('http://somewhere.com/private/area/page?q=1')
+    authorization = httplib2.BasicAuthentication(('admin', 'secret'), 'somewhere.com',
+                                                 '/private/', {}, {}, '', None)
+    assert authorization.inscope('somewhere.com', normalized)
+    assert_equals(authorization.depth(normalized),
+                  authorization.depth('/private/area/page?q=1'))
+    assert not authorization.inscope('elsewhere.com', normalized)
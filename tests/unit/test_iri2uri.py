@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import random
+import sys
+import urlparse
+from nose.tools import assert_equals
+
+from bolacha.httplib2.iri2uri import escape_range, encode, iri2uri
+
+def reference_encode(c):
+    """encode() as it was, scanning escape_range for every character"""
+    retval = c
+    i = ord(c)
+    for low, high in escape_range:
+        if i < low:
+            break
+        if i >= low and i <= high:
+            retval = "".join(["%%%2X" % ord(o) for o in c.encode('utf-8')])
+            break
+    return retval
+
+def reference_iri2uri(uri):
+    if isinstance(uri ,unicode):
+        (scheme, authority, path, query, fragment) = urlparse.urlsplit(uri)
+        authority = authority.encode('idna')
+        uri = urlparse.urlunsplit((scheme, authority, path, query, fragment))
+        uri = "".join([reference_encode(c) for c in uri])
+    return uri
+
+def outcome(function, uri):
+    try:
+        return None, function(uri)
+    except Exception, e:
+        return type(e), None
+
+def interesting_characters():
+    characters = [unichr(i) for i in range(0x20, 0x7f)]
+    characters += [unichr(i) for i in range(0x80, 0xa0, 7)]
+    for low, high in escape_range:
+        for i in (low - 1, low, low + 1, high - 1, high, high + 1):
+            if i <= sys.maxunicode and not 0xd800 <= i <= 0xdfff:
+                characters.append(unichr(i))
+    return characters + list(u'://?#@[]%')
+
+def test_encode_matches_the_linear_scan_for_every_bmp_character():
+    for i in range(0x10000):
+        if 0xd800 <= i <= 0xdfff:
+            continue
+        c = unichr(i)
+        assert_equals(encode(c), reference_encode(c))
+
+def test_iri2uri_matches_the_original_on_random_iris():
+    generator = random.Random(1)
+    characters = interesting_characters()
+    for number in range(3000):
+        parts = []
+        for part in range(generator.randint(0, 4)):
+            parts.append(u''.join([generator.choice(characters)
+                                   for count in range(generator.randint(0, 12))]))
+        iri = generator.choice([u'http://', u'HTTPS://', u'', u'ftp:', u'//']) + \
+              generator.choice([u'example.com', u'\N{COMET}.com', u'']) + \
+              u'/'.join(parts)
+        assert_equals(outcome(iri2uri, iri), outcome(reference_iri2uri, iri), repr(iri))
+
+def test_iri2uri_leaves_byte_strings_alone():
+    uri = u'http://example.com/\N{COMET}'.encode('utf-8')
+    assert iri2uri(uri) is uri
+
+def test_iri2uri_checks_host_names_like_the_idna_codec():
+    for host in [u'example.com.', u'a..b', u'.a', u'x' * 64 + u'.com', u'x' * 63,
+                 u'\N{COMET}.com', u'', u'.']:
+        iri = u'http://%s/path' % host
+        assert_equals(outcome(iri2uri, iri), outcome(reference_iri2uri, iri), repr(iri))
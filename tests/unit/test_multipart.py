@@ -17,6 +17,10 @@
 # License along with this program; if not, write to the
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
+import codecs
+import io
+import tempfile
+from StringIO import StringIO
 from mox import Mox
 from nose.tools import assert_equals
 from utils import assert_raises
@@ -62,6 +66,84 @@ def test_guess_mime_fallsback_to_octet_stream():
     finally:
         multipart.guess_type = old_guess_type
 
+def test_file_size_of_real_file():
+    f = tempfile.TemporaryFile()
+    f.write('0123456789')
+    f.seek(4)
+    assert_equals(multipart.file_size(f), 6)
+
+def test_file_size_of_seekable_file():
+    f = StringIO('0123456789')
+    f.seek(2)
+    assert_equals(multipart.file_size(f), 8)
+    assert_equals(f.tell(), 2)
+
+def test_file_size_of_unsized_file():
+    class FakeFile(object):
+        def read(self):
+            pass
+
+    assert_equals(multipart.file_size(FakeFile()), None)
+
+def test_multipart_encoder_matches_encode_multipart():
+    f = tempfile.NamedTemporaryFile(suffix='.txt')
+    f.write('FILE CONTENT' * 1000)
+
+    def data():
+        f.seek(0)
+        return {'name': u'Gabriel Falcão', 'age': 21, 'my_file': f}
+
+    expected = multipart.encode_multipart('some-boundary', data())
+    encoder = multipart.MultipartEncoder('some-boundary', data(),
+                                         chunk_size=100)
+
+    assert encoder.is_streaming
+    assert_equals(len(encoder), len(expected))
+    assert_equals(''.join(encoder), expected)
+
+def test_multipart_encoder_reads_in_chunks_and_rewinds():
+    f = StringIO('0123456789')
+    f.name = '/path/to/file'
+    encoder = multipart.MultipartEncoder('b', {'file': f})
+    expected = encoder.read()
+
+    encoder.rewind()
+    chunks = [encoder.read(7) for x in range(len(expected) / 7 + 2)]
+
+    assert_equals(set([len(c) for c in chunks[:-2]]), set([7]))
+    assert_equals(chunks[-1], '')
+    assert_equals(''.join(chunks), expected)
+
+def test_multipart_encoder_buffers_unsized_files():
+    class FileStub(object):
+        name = '/path/to/file'
+        def read(self):
+            return 'FileStubContent'
+
+    encoder = multipart.MultipartEncoder('b', {'file': FileStub()})
+
+    assert not encoder.is_streaming
+    assert 'FileStubContent' in encoder.read()
+
+def test_multipart_encoder_encodes_files_read_as_unicode():
+    f = tempfile.NamedTemporaryFile(suffix='.txt')
+    f.write(u'caf\xe9 ' .encode('utf-8') * 1000)
+    f.flush()
+
+    for text_file in (codecs.open(f.name, encoding='utf-8'),
+                      io.open(f.name, encoding='utf-8')):
+        expected = multipart.encode_multipart('b', {'file': text_file})
+        text_file.seek(0)
+        encoder = multipart.MultipartEncoder('b', {'file': text_file})
+
+        assert not encoder.is_streaming
+        body = encoder.read()
+        assert isinstance(body, str)
+        assert_equals(len(encoder), len(body))
+        assert_equals(body, expected)
+        assert u'caf\xe9 '.encode('utf-8') * 1000 in body
+        text_file.close()
+
 def test_encode_file():
     mocker = Mox()
 
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import shutil
+import stat
+import tempfile
+from nose.tools import assert_equals
+
+from bolacha import Bolacha
+from bolacha.httplib2 import DigestAuthentication
+from bolacha.session import SessionFile
+
+directory = None
+
+def setup():
+    global directory
+    directory = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(directory)
+
+def test_session_file_round_trip():
+    store = SessionFile(os.path.join(directory, 'round-trip'))
+    assert_equals(store.load(), None)
+
+    store.save({'cookies': [{'name': 'a', 'value': u'caf\xe9'}], 'version': 1})
+    state = store.load()
+    assert_equals(state, {'cookies': [{'name': 'a', 'value': 'caf\xc3\xa9'}],
+                          'version': 1})
+    assert isinstance(state['cookies'][0]['name'], str)
+    assert_equals(stat.S_IMODE(os.stat(store.path).st_mode), 0600)
+    assert_equals(sorted(os.listdir(directory)), ['round-trip', 'round-trip.lock'])
+
+def test_session_file_ignores_damaged_files():
+    path = os.path.join(directory, 'damaged')
+    open(path, 'w').write('{"version": ')
+    assert_equals(SessionFile(path).load(), None)
+
+def test_sessions_saved_to_the_same_file_are_merged():
+    path = os.path.join(directory, 'merged')
+    first = Bolacha()
+    first.cookies.set_from_header('http://somewhere.com/', 'sid=1, theme=dark')
+    first.http.add_credentials('admin', 'secret')
+    first.http.authorizations.append(_digest_authorization(first.http))
+    second = Bolacha()
+    second.cookies.set_from_header('http://elsewhere.com/', 'sid=2')
+    second.cookies.set_from_header('http://somewhere.com/', 'theme=light')
+
+    first.save_session(path)
+    second.save_session(path)
+
+    third = Bolacha()
+    third.http.add_credentials('admin', 'secret')
+    assert third.load_session(path)
+    assert_equals(third.cookies.cookies_for('http://somewhere.com/'),
+                  {'sid': '1', 'theme': 'light'})
+    assert_equals(third.cookies.cookies_for('http://elsewhere.com/'), {'sid': '2'})
+    assert_equals(len(third.http.authorizations), 1)
+
+def test_cookies_deleted_and_saved_stay_deleted():
+    path = os.path.join(directory, 'deleted')
+    b = Bolacha()
+    b.cookies.set_from_header('http://somewhere.com/', 'sid=1, theme=dark')
+    b.save_session(path)
+    b.cookies.set_from_header('http://somewhere.com/', 'sid=; Max-Age=0')
+    b.save_session(path)
+
+    again = Bolacha()
+    assert again.load_session(path)
+    assert_equals(again.cookies.cookies_for('http://somewhere.com/'), {'theme': 'dark'})
+
+def test_sessions_keep_what_each_process_changed_since_loading():
+    path = os.path.join(directory, 'three-way')
+    first = Bolacha()
+    first.cookies.set_from_header('http://somewhere.com/', 'sid=1, theme=dark')
+    first.save_session(path)
+
+    second = Bolacha()
+    second.load_session(path)
+    second.cookies.set_from_header('http://elsewhere.com/', 'sid=2')
+
+    # logs out and changes the theme, which the second one doesn't know
+    first.cookies.set_from_header('http://somewhere.com/', 'sid=; Max-Age=0, theme=light')
+    first.save_session(path)
+    second.save_session(path)
+
+    third = Bolacha()
+    assert third.load_session(path)
+    assert_equals(third.cookies.cookies_for('http://somewhere.com/'), {'theme': 'light'})
+    assert_equals(third.cookies.cookies_for('http://elsewhere.com/'), {'sid': '2'})
+
+def _digest_authorization(http):
+    response = {'www-authenticate': 'Digest realm="site", nonce="abc", qop="auth"'}
+    return DigestAuthentication(('admin', 'secret'), 'somewhere.com',
+                                'http://somewhere.com/private/', {}, response, '', http)
+
+def test_bolacha_saves_and_loads_cookies_and_authorizations():
+    path = os.path.join(directory, 'session')
+    first = Bolacha()
+    first.cookies.set_from_header('http://somewhere.com/', 'sid=123, kept=1; Max-Age=60')
+    first.http.add_credentials('admin', 'secret')
+    first.http.authorizations.append(_digest_authorization(first.http))
+    first.save_session(path)
+    assert 'secret' not in open(path).read()
+
+    second = Bolacha()
+    second.http.add_credentials('admin', 'secret')
+    assert second.load_session(path)
+    assert_equals(second.cookies.header_for('http://somewhere.com/'), 'sid=123; kept=1')
+
+    authorization = second.http.authorizations[0]
+    assert isinstance(authorization, DigestAuthentication)
+    assert_equals(authorization.A1, 'admin:site:secret')
+    headers = {}
+    authorization.request('GET', '/private/', headers, '')
+    assert 'nonce="abc"' in headers['Authorization']
+
+    # loading again doesn't add the same authorization twice
+    second.load_session(path)
+    assert_equals(len(second.http.authorizations), 1)
+
+def test_bolacha_loads_authorizations_only_with_credentials():
+    path = os.path.join(directory, 'no-credentials')
+    first = Bolacha()
+    first.http.add_credentials('admin', 'secret')
+    first.http.authorizations.append(_digest_authorization(first.http))
+    first.save_session(path)
+
+    second = Bolacha()
+    second.http.add_credentials('someone else', 'secret')
+    assert second.load_session(path)
+    assert_equals(second.http.authorizations, [])
+    assert not Bolacha().load_session(os.path.join(directory, 'missing'))